@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times getHref answering from the cache with instrumentation disabled against a build of the same lookup with the
+# check for instrumentation removed, and with hooks which do nothing and with ClientMetrics. Each variant is timed in
+# turn on every round, so that anything else slowing the machine down affects them alike, and the overheads reported
+# are the medians of the differences between variants within each round, along with their interquartile range.
+#
+# Usage: python benchmarks/bench_client_instrumentation.py [rounds] [services]
+
+from __future__ import print_function, division
+
+import inspect
+import logging
+import sys
+import textwrap
+import timeit
+
+from mdnsbridge import mdnsbridgeclient
+from mdnsbridge.mdnsbridgeclient import IppmDNSBridge, Instrumentation, ClientMetrics
+
+ROUNDS = 200
+SERVICES = 2000
+SRV_TYPE = "nmos-registration"
+# As it appears in the method's source once dedented
+HIT_HOOK = """        if self.instrumentation is not None:
+            self.instrumentation.hit(srv_type)
+"""
+
+
+def uninstrumented_lookup():
+    """Returns getHrefWithException compiled without the check for instrumentation on a hit"""
+    source = textwrap.dedent(inspect.getsource(IppmDNSBridge.getHrefWithException))
+    if HIT_HOOK not in source:
+        raise RuntimeError("Couldn't find the instrumentation check in getHrefWithException")
+    namespace = {}
+    exec(source.replace(HIT_HOOK, ""), vars(mdnsbridgeclient), namespace)
+    return namespace["getHrefWithException"]
+
+
+class UninstrumentedIppmDNSBridge(IppmDNSBridge):
+    getHrefWithException = uninstrumented_lookup()
+
+
+def make_client(cls, count, instrumentation):
+    client = cls(instrumentation=instrumentation)
+    client.config.update({"priority": 0, "https_mode": "disabled", "prefer_hostnames": False})
+    representation = {"representation": [
+        {"name": "registry-{}".format(index), "address": "10.0.{}.{}".format(index // 256, index % 256),
+         "port": 80, "hostname": None, "priority": 0, "versions": ["v1.0", "v1.1", "v1.2"], "protocol": "http"}
+        for index in range(count)
+    ]}
+    return client, representation
+
+
+def time_round(client, representation, count):
+    # Every lookup is answered from the cache, which is refilled beforehand
+    client._setRepresentation(SRV_TYPE, representation)
+    return timeit.timeit(lambda: client.getHrefWithException(SRV_TYPE), number=count) / count
+
+
+def quartiles(values):
+    values = sorted(values)
+    return [values[len(values) * quarter // 4] for quarter in (1, 2, 3)]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else ROUNDS
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else SERVICES
+    # Each lookup logs the priority it uses, which would otherwise swamp what is being measured
+    logging.disable(logging.CRITICAL)
+    variants = [
+        ("check removed", make_client(UninstrumentedIppmDNSBridge, count, None)),
+        ("disabled", make_client(IppmDNSBridge, count, None)),
+        ("no-op hooks", make_client(IppmDNSBridge, count, Instrumentation())),
+        ("ClientMetrics", make_client(IppmDNSBridge, count, ClientMetrics())),
+    ]
+    times = dict((name, []) for name, _ in variants)
+    for _ in range(rounds):
+        for name, (client, representation) in variants:
+            times[name].append(time_round(client, representation, count))
+
+    baseline = times["check removed"]
+    print("{} rounds of {} lookups from the cache".format(rounds, count))
+    print("  {:<14} {:>12} {:>32}".format("variant", "us/lookup", "overhead ns (25%, median, 75%)"))
+    for name, _ in variants:
+        median = quartiles(times[name])[1]
+        overhead = quartiles([time - base for time, base in zip(times[name], baseline)])
+        print("  {:<14} {:12.3f} {:>10.1f} {:>10.1f} {:>10.1f}   ({:+.2%})".format(
+            name, median * 1e6, *[value * 1e9 for value in overhead] + [overhead[1] / quartiles(baseline)[1]]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Simulates many clients picking from one tier of services with each selection strategy, and reports how evenly the
+# picks spread (the busiest service against the mean, and the coefficient of variation), how closely weighted picks
+# follow the TXT weights, how many affinity keys move when a service goes away, and the cost of each pick.
+#
+# Usage: python benchmarks/bench_selection_strategies.py [services] [picks]
+
+from __future__ import print_function, division
+
+import random
+import sys
+import timeit
+from collections import Counter
+
+from mdnsbridge.mdnsbridgeclient import _Tier
+from mdnsbridge.mdnsbridgerecord import ServiceRecord
+from mdnsbridge.mdnsbridgeselection import RandomStrategy, LatencyStrategy, WeightedStrategy, HashStrategy
+
+SERVICES = 20
+PICKS = 100000
+
+
+def make_tier(count, rng):
+    # Services of uneven size and speed: weights of 1, 2 or 4 and latencies spread over an order of magnitude
+    tier = _Tier()
+    for index in range(count):
+        tier.append(ServiceRecord(name="registry-{}".format(index), address="10.0.0.{}".format(index), port=80,
+                                  txt={"weight": str(2 ** (index % 3))}, rtt=rng.uniform(0.001, 0.01)))
+    return tier
+
+
+def spread(counts, count):
+    loads = [counts.get(index, 0) for index in range(count)]
+    mean = sum(loads) / count
+    variance = sum((load - mean) ** 2 for load in loads) / count
+    return max(loads) / mean, variance ** 0.5 / mean
+
+
+def simulate(strategy, tier, picks, rng, affinity=None):
+    latency = (lambda service: service.rtt)
+    return Counter(strategy.select(tier, rng, latency, affinity(pick) if affinity else None) for pick in range(picks))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else SERVICES
+    picks = int(sys.argv[2]) if len(sys.argv) > 2 else PICKS
+    rng = random.Random(0)
+    tier = make_tier(count, rng)
+    keys = ["node-{}".format(index) for index in range(picks)]
+
+    strategies = [
+        ("random", RandomStrategy(), None),
+        ("latency (p2c)", LatencyStrategy(), None),
+        ("weighted", WeightedStrategy(), None),
+        ("hash", HashStrategy(), keys.__getitem__),
+    ]
+    print("{} services, {} picks".format(count, picks))
+    print("  {:<14} {:>9} {:>7} {:>12}".format("strategy", "max/mean", "cv", "us per pick"))
+    results = {}
+    for name, strategy, affinity in strategies:
+        counts = results[name] = simulate(strategy, tier, picks, rng, affinity)
+        peak, cv = spread(counts, count)
+        key = keys[0] if affinity else None
+        cost = min(timeit.repeat(lambda: strategy.select(tier, rng, lambda service: service.rtt, key),
+                                 number=10000, repeat=3)) / 10000 * 1e6
+        print("  {:<14} {:9.2f} {:7.3f} {:12.2f}".format(name, peak, cv, cost))
+
+    # Weighted picks against each service's share of the total weight
+    weights = [float(dict(service.txt)["weight"]) for service in tier.services]
+    error = max(abs(results["weighted"][index] / picks - weight / sum(weights)) / (weight / sum(weights))
+                for index, weight in enumerate(weights))
+    print("weighted: worst relative error from TXT weights {:.1%}".format(error))
+
+    # Latency picks go to faster services more often
+    fastest = sorted(range(count), key=lambda index: tier.services[index].rtt)
+    half = count // 2
+    print("latency: fastest half of services took {:.1%} of picks".format(
+        sum(results["latency (p2c)"][index] for index in fastest[:half]) / picks))
+
+    # Keys which move when one service goes away, against the share that service held
+    strategy = HashStrategy()
+    before = dict((key, tier.services[strategy.select(tier, rng, None, key)].name) for key in keys)
+    gone = tier.services[0].name
+    tier.remove(tier.services[0])
+    after = dict((key, tier.services[strategy.select(tier, rng, None, key)].name) for key in keys)
+    moved = sum(before[key] != after[key] for key in keys) / picks
+    held = sum(name == gone for name in before.values()) / picks
+    print("hash: {:.1%} of keys moved when a service holding {:.1%} of them went away".format(moved, held))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the memory held by the bridge's ServiceRecords for a set of announced services against the dicts that it
+# built for them previously. Needs Python 3 for tracemalloc.
+#
+# Usage: python benchmarks/bench_service_record.py [records]
+
+from __future__ import print_function
+
+import sys
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+from mdnsbridge.mdnsbridge import _service_record
+
+RECORDS = 10000
+SRV_TYPE = "nmos-registration"
+
+
+def legacy_entry(data):
+    """The previous entry for an announced service, a dict holding its own copy of the TXT record"""
+    priority = 0
+    versions = ["v1.0"]
+    protocol = "http"
+    authorization = False
+    txt_data = {}
+    for key, value in data["txt"].items():
+        if type(key) is not str:
+            key = key.decode('ascii')
+        if type(value) not in (str, bool):
+            value = value.decode('ascii')
+        txt_data[key] = value
+    if "pri" in txt_data:
+        if txt_data["pri"].isdigit():
+            priority = int(txt_data["pri"])
+    if "api_ver" in txt_data:
+        versions = txt_data["api_ver"].split(",")
+    if "api_proto" in txt_data:
+        protocol = txt_data["api_proto"]
+    if "api_auth" in txt_data:
+        if txt_data["api_auth"] in [True, "true"]:
+            authorization = True
+    return {
+        "name": data["name"], "address": data["address"], "port": data["port"], "txt": txt_data,
+        "priority": priority, "versions": versions, "protocol": protocol, "hostname": data["hostname"],
+        "authorization": authorization
+    }
+
+
+def make_announcements(count):
+    # TXT records arrive from the mDNS engine as bytes, as they do on Python 3
+    return [{
+        "type": "_{}._tcp".format(SRV_TYPE), "action": "add", "name": "registry-{}".format(index),
+        "address": "10.{}.{}.{}".format(index // 65536 % 256, index // 256 % 256, index % 256), "port": 80,
+        "hostname": "registry-{}.example.com".format(index),
+        "txt": {b"pri": str(index % 3 * 10).encode('ascii'), b"api_ver": b"v1.0,v1.1,v1.2", b"api_proto": b"http",
+                b"api_auth": b"false"}
+    } for index in range(count)]
+
+
+def measure(build, announcements):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = [build(data) for data in announcements]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # The list holding the entries is the same size either way
+    return (used - sys.getsizeof(entries)) / float(len(entries))
+
+
+def main():
+    if tracemalloc is None:
+        print("tracemalloc is not available on this version of Python")
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else RECORDS
+    announcements = make_announcements(count)
+
+    legacy = measure(legacy_entry, announcements)
+    slotted = measure(_service_record, announcements)
+
+    print("{} announced services (bytes per service, excluding strings shared with the announcement)".format(count))
+    print("  dict:          {:8.0f}".format(legacy))
+    print("  ServiceRecord: {:8.0f}".format(slotted))
+    print("  saving:        {:8.0f} ({:.0%})".format(legacy - slotted, 1 - slotted / legacy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Calls IppmDNSBridge.getHref with a mix of filters against a cache of synthetic services, refilled from memory rather
+# than the bridge, and compares it against the list-scanning selection that the client used previously.
+#
+# Usage: python benchmarks/bench_service_selection.py [calls] [services]
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+import mock
+
+from mdnsbridge.mdnsbridgeclient import IppmDNSBridge, NoService, EndOfServiceList
+
+CALLS = 20000
+SERVICES = 1000
+SRV_TYPE = "nmos-registration"
+VERSIONS = ["v1.0", "v1.1", "v1.2", "v1.3"]
+
+
+class NullLogger(object):
+    def writeDebug(self, message):
+        pass
+
+    writeInfo = writeWarning = writeDebug
+
+
+class ListSelector(object):
+    """The previous selection, which scanned the whole cached list on every call"""
+
+    def __init__(self, representation, config):
+        self.representation = representation
+        self.config = config
+        self.services = {}
+
+    def updateServices(self, srv_type):
+        self.services[srv_type] = list(self.representation)
+
+    def getHref(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None):
+        try:
+            try:
+                return self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth)
+            except EndOfServiceList:
+                return self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth)
+        except NoService:
+            return ""
+
+    def getHrefWithException(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None):
+        if srv_type not in self.services:
+            self.services[srv_type] = []
+        valid_services = self._getValidServices(srv_type, priority, api_ver, api_proto, api_auth)
+        if len(valid_services) == 0:
+            self.updateServices(srv_type)
+            valid_services = self._getValidServices(srv_type, priority, api_ver, api_proto, api_auth)
+            if len(valid_services) == 0:
+                raise NoService
+            else:
+                raise EndOfServiceList
+        random.seed()
+        service = valid_services[random.randint(0, len(valid_services) - 1)]
+        self.services[srv_type].remove(service)
+        return "{}://{}:{}".format(service["protocol"], service["address"], service["port"])
+
+    def _getValidServices(self, srv_type, priority, api_ver=None, api_proto=None, api_auth=None):
+        current_priority = 99
+        valid_services = []
+        for service in self.services[srv_type]:
+            if api_ver is not None and api_ver not in service["versions"]:
+                continue
+            if api_proto is not None and api_proto != service["protocol"]:
+                continue
+            if api_auth is not None and api_auth != service.get("authorization", False):
+                continue
+            if priority >= 100:
+                if service["priority"] == priority:
+                    valid_services.append(service)
+            else:
+                if service["priority"] < current_priority:
+                    current_priority = service["priority"]
+                    valid_services = []
+                if service["priority"] == current_priority:
+                    valid_services.append(service)
+        return valid_services
+
+
+def make_services(count, seed=0):
+    rng = random.Random(seed)
+    services = []
+    for index in range(count):
+        services.append({
+            "name": "registry-{}".format(index), "address": "10.0.{}.{}".format(index // 256, index % 256),
+            "port": 80, "hostname": None, "protocol": "http", "authorization": rng.random() < 0.5,
+            "priority": rng.choice([0, 10, 20, 100, 100, 150]), "versions": VERSIONS[:rng.randint(1, len(VERSIONS))]
+        })
+    return services
+
+
+def make_calls(count, seed=0):
+    rng = random.Random(seed)
+    return [(rng.choice([0, 0, 100]), rng.choice([None, "v1.0", "v1.2", "v1.3"]), rng.choice([None, "http"]),
+             rng.choice([None, None, False, True])) for _ in range(count)]
+
+
+def run(bridge, calls):
+    start = time.time()
+    for priority, api_ver, api_proto, api_auth in calls:
+        bridge.getHref(SRV_TYPE, priority, api_ver, api_proto, api_auth)
+    return time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    services = make_services(int(sys.argv[2]) if len(sys.argv) > 2 else SERVICES)
+    calls = make_calls(count)
+    config = {"priority": 0, "https_mode": "disabled", "prefer_hostnames": False}
+
+    legacy_time = run(ListSelector(services, config), calls)
+
+    with mock.patch('mdnsbridge.mdnsbridgeclient.Logger'):
+        bridge = IppmDNSBridge()
+    bridge.config = config
+    bridge.logger = NullLogger()
+    bridge.updateServices = lambda srv_type: bridge._setRepresentation(srv_type, {"representation": services})
+    indexed_time = run(bridge, calls)
+
+    print("{} getHref calls against {} services".format(count, len(services)))
+    print("  list scan:     {:8.3f} s".format(legacy_time))
+    print("  filter index:  {:8.3f} s".format(indexed_time))
+    print("  speedup:       {:8.1f}x".format(legacy_time / indexed_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Replays a burst of synthetic mDNS add/remove events through mDNSBridge._mdns_callback and compares it against the
+# list-scanning store that the bridge used previously.
+#
+# Usage: python benchmarks/bench_service_table.py [events]
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+import mock
+
+from mdnsbridge.mdnsbridge import mDNSBridge
+
+EVENTS = 10000
+SRV_TYPE = "nmos-registration"
+
+
+class ListServiceTable(object):
+    """The previous store, which held each type's services in a plain list"""
+
+    def __init__(self):
+        self.services = []
+
+    def _mdns_callback(self, data):
+        if data["action"] == "add":
+            service_entry = {"name": data["name"], "address": data["address"], "port": data["port"]}
+            for service in self.services:
+                if service["name"] == data["name"] and service["address"] == data["address"]:
+                    service.update(service_entry)
+                    return
+            self.services.append(service_entry)
+        elif data["action"] == "remove":
+            for service in self.services:
+                if service["name"] == data["name"]:
+                    self.services.remove(service)
+                    break
+
+
+def make_events(count, seed=0):
+    rng = random.Random(seed)
+    live = []
+    events = []
+    for index in range(count):
+        # Bias towards adds so the table grows to a couple of thousand entries, as during a facility-wide browse storm
+        if live and rng.random() < 0.3:
+            name, address = live.pop(rng.randrange(len(live)))
+            action = "remove"
+        elif live and rng.random() < 0.3:
+            name, address = rng.choice(live)
+            action = "add"
+        else:
+            name = "registry-{}".format(index)
+            address = "10.{}.{}.{}".format(index // 65536 % 256, index // 256 % 256, index % 256)
+            live.append((name, address))
+            action = "add"
+        events.append({
+            "type": "_{}._tcp".format(SRV_TYPE), "action": action, "name": name, "address": address,
+            "port": 80, "hostname": name + ".example.com", "txt": {"pri": "100", "api_ver": "v1.0,v1.1,v1.2"}
+        })
+    return events
+
+
+def replay(callback, events):
+    start = time.time()
+    for event in events:
+        callback(event)
+    return time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else EVENTS
+    events = make_events(count)
+
+    legacy = ListServiceTable()
+    legacy_time = replay(legacy._mdns_callback, events)
+
+    with mock.patch('mdnsbridge.mdnsbridge.MDNSEngine'):
+        bridge = mDNSBridge()
+    with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+        indexed_time = replay(bridge._mdns_callback, events)
+
+    print("Replayed {} events, {} services remaining".format(count, len(bridge.get_services(SRV_TYPE))))
+    print("  list scan:     {:8.3f} s".format(legacy_time))
+    print("  keyed index:   {:8.3f} s".format(indexed_time))
+    print("  speedup:       {:8.1f}x".format(legacy_time / indexed_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the round-trip latency of fetching a type resource from a running mDNS Bridge over its Unix domain socket,
+# directly over TCP, and through the Apache proxy. Transports which aren't available on this host are skipped.
+#
+# Usage: python benchmarks/bench_transport.py [requests] [type]
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+from nmoscommon.nmoscommonconfig import config as _config
+
+from mdnsbridge.mdnsbridgeclient import BRIDGE_PORT, BRIDGE_SOCKET, _newSession
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+REQUESTS = 2000
+SRV_TYPE = "nmos-registration"
+PATH = "/x-ipstudio/mdnsbridge/v1.0/{}/"
+
+
+def transports(srv_type, socket_path):
+    path = PATH.format(srv_type)
+    return [
+        ("unix socket", "http+unix://" + quote(socket_path or "", safe="") + path),
+        ("direct tcp", "http://127.0.0.1:{}{}".format(BRIDGE_PORT, path)),
+        ("apache", "http://127.0.0.1" + path),
+    ]
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(url, count):
+    session = _newSession()
+    session.get(url, timeout=0.5, proxies={'http': ''}).raise_for_status()
+    samples = []
+    for _ in range(count):
+        start = time.time()
+        session.get(url, timeout=0.5, proxies={'http': ''})
+        samples.append(time.time() - start)
+    session.close()
+    return sorted(samples)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    srv_type = sys.argv[2] if len(sys.argv) > 2 else SRV_TYPE
+    print("{} requests for {} per transport (times in microseconds)".format(count, srv_type))
+    print("  {:<12} {:>8} {:>8} {:>8}".format("transport", "median", "p99", "mean"))
+    socket_path = _config.get("mdnsbridge_socket", BRIDGE_SOCKET)
+    for name, url in transports(srv_type, socket_path):
+        if url.startswith("http+unix://") and not (socket_path and os.path.exists(socket_path)):
+            print("  {:<12} skipped: {} does not exist".format(name, socket_path))
+            continue
+        try:
+            samples = measure(url, count)
+        except Exception as e:
+            print("  {:<12} skipped: {}".format(name, e))
+            continue
+        print("  {:<12} {:>8.0f} {:>8.0f} {:>8.0f}".format(
+            name, percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6, sum(samples) / len(samples) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
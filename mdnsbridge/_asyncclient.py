@@ -0,0 +1,146 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The asyncio client uses syntax which Python 2 can't parse, so it lives here and is imported by mdnsbridgeclient
+# only on Python 3. Import AsyncIppmDNSBridge from mdnsbridgeclient rather than from this module.
+
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .mdnsbridgeclient import _IppmDNSBridgeBase, _ServiceIndex, NoService, EndOfServiceList
+
+
+class AsyncIppmDNSBridge(_IppmDNSBridgeBase):
+    """An asyncio equivalent of IppmDNSBridge, whose getHref and updateServices are coroutines. An instance should
+    only be used from one event loop, and closed with close() when finished with."""
+
+    def __init__(self, logger=None, strategy=None, instrumentation=None):
+        if aiohttp is None:
+            raise ImportError("AsyncIppmDNSBridge requires aiohttp")
+        super(AsyncIppmDNSBridge, self).__init__(logger, strategy, instrumentation)
+        # Requests share a pooled session, which is replaced if the bridge's Unix domain socket appears or goes away,
+        # or a request made with it fails. Sessions which have been replaced are closed once the fetches using them
+        # have finished, which are counted here.
+        self._session = None
+        self._sessionSocket = None
+        self._sessionUsers = {}
+        # Only one refresh of each type is made at a time, with other callers awaiting its result
+        self._refreshing = {}
+
+    async def getHref(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None, affinity=None):
+        try:
+            while True:
+                try:
+                    return await self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth, affinity)
+                except EndOfServiceList:
+                    self.logger.writeInfo("End of DNS-SD service list, reloading")
+        except NoService:
+            self._warnNoService(srv_type, priority, api_ver, api_proto, api_auth)
+            return ""
+
+    async def getHrefWithException(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None,
+                                   affinity=None):
+        priority = self._priority(priority)
+
+        services = self.services.setdefault(srv_type, _ServiceIndex())
+        href = self._takeHref(services, priority, api_ver, api_proto, api_auth, affinity)
+        if href is not None:
+            if self.instrumentation is not None:
+                self.instrumentation.hit(srv_type)
+            return href
+        self._checkBackoff(srv_type, priority, api_ver, api_proto, api_auth)
+
+        await self.updateServices(srv_type)
+        self._checkUpdated(srv_type, services, priority, api_ver, api_proto, api_auth)
+
+    async def updateServices(self, srv_type):
+        refreshed = self._refreshing.get(srv_type)
+        if refreshed is not None:
+            # Shielded so that a caller being cancelled doesn't cancel the refresh for everyone else
+            await asyncio.shield(refreshed)
+            return
+        refreshed = self._refreshing[srv_type] = asyncio.get_event_loop().create_future()
+        try:
+            with self._refreshSpan(srv_type):
+                await self._updateServices(srv_type)
+        finally:
+            del self._refreshing[srv_type]
+            refreshed.set_result(None)
+
+    async def _updateServices(self, srv_type):
+        if self._updateFromSnapshot(srv_type):
+            return
+        try:
+            status_code, etag, body = await self._fetch(srv_type)
+            self._applyResponse(srv_type, status_code, etag, body)
+        except Exception as e:
+            self.logger.writeWarning("Exception updating services: {}".format(e))
+
+    async def _fetch(self, srv_type):
+        session = await self._currentSession()
+        socket_path = self._sessionSocket
+        self._sessionUsers[session] = self._sessionUsers.get(session, 0) + 1
+        try:
+            if socket_path is not None:
+                url = "http://localhost/x-ipstudio/mdnsbridge/v1.0/{}/".format(srv_type)
+            else:
+                url = self._requestUrl(srv_type)
+            async with session.get(url, params=self._requestParams(), headers=self._requestHeaders(srv_type),
+                                   timeout=aiohttp.ClientTimeout(total=0.5)) as r:
+                body = self._decode(r.content_type, await r.read()) if r.status == 200 else None
+                return r.status, r.headers.get("ETag"), body
+        except Exception:
+            # Don't risk reusing a connection left in a bad state. Only this session is replaced, since fetches of
+            # other types may be using a newer one.
+            if self._session is session:
+                self._session = None
+            raise
+        finally:
+            self._sessionUsers[session] -= 1
+            if not self._sessionUsers[session]:
+                del self._sessionUsers[session]
+                if session is not self._session:
+                    await session.close()
+
+    async def _currentSession(self):
+        socket_path = self._socketPath()
+        if self._session is None or self._sessionSocket != socket_path:
+            replaced = self._session
+            if socket_path is not None:
+                connector = aiohttp.UnixConnector(path=socket_path)
+            else:
+                connector = aiohttp.TCPConnector()
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._sessionSocket = socket_path
+            if replaced is not None and replaced not in self._sessionUsers:
+                await replaced.close()
+        return self._session
+
+    async def close(self):
+        """Closes the current session. Any being used by fetches in progress are closed when those finish."""
+        if self._session is not None:
+            session = self._session
+            self._session = None
+            if session not in self._sessionUsers:
+                await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -15,24 +15,105 @@
 # limitations under the License.
 
 import gevent
-from nmoscommon.webapi import WebAPI, route
+import gevent.socket
+import json
+import re
+import socket
+import time
+import uuid
+from collections import OrderedDict, deque
+from gevent.event import Event
+from gevent.pool import Pool
+from gevent.queue import Queue, Empty, Full
+from nmoscommon.webapi import WebAPI, IppResponse, route
 from nmoscommon.mdns import MDNSEngine
+from .mdnsbridgesnapshot import SnapshotWriter
+from .mdnsbridgerecord import ServiceRecord, REPRESENTATION_FIELDS
+from .mdnsbridgemetrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, clock
 
-from flask import abort
+from flask import Response, abort, g, request
+from werkzeug.http import quote_etag
 from nmoscommon import nmoscommonconfig
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
 VALID_TYPES = ["nmos-query", "nmos-registration", "nmos-auth", "nmos-register"]
+# The form of the API versions which type resources can be filtered by
+API_VERSION = re.compile(r"v[0-9]+\.[0-9]+\Z")
 
 APINAMESPACE = "x-ipstudio"
 APINAME = "mdnsbridge"
 APIVERSION = "v1.0"
 APIBASE = "/{}/{}/{}/".format(APINAMESPACE, APINAME, APIVERSION)
 
+# Default and maximum time in seconds that a watch request is held open waiting for a change
+WATCH_TIMEOUT = 30
+WATCH_TIMEOUT_MAX = 120
+# Watches through Apache, which adds X-Forwarded-For, are held for less than its proxy timeout
+PROXIED_WATCH_TIMEOUT_MAX = 8
+
+# Number of recent change events kept for clients resuming an event stream, the number of events that may be queued
+# for a single subscriber before it is dropped, and the interval in seconds between keep-alives on an idle stream,
+# which must be well within Apache's proxy timeout for streams through it to stay open
+EVENT_HISTORY = 1024
+SUBSCRIBER_QUEUE_SIZE = 256
+EVENT_KEEPALIVE = 5
+
+# Default time in seconds for which announcements are queued and collapsed before being applied, or 0 to apply each
+# one as it arrives
+DEBOUNCE_WINDOW = 0
+
+# Default time in seconds after which a service which hasn't been announced again is dropped, or None to only drop
+# services when they are removed. Expiry is checked on a timer wheel of EXPIRY_SLOTS slots, each EXPIRY_RESOLUTION
+# seconds long.
+SERVICE_TTL = None
+EXPIRY_RESOLUTION = 1
+EXPIRY_SLOTS = 512
+
+# Default interval in seconds between probes of every service's address and port, or None not to probe them, along
+# with how long each probe waits for a connection and how many are made at once
+PROBE_INTERVAL = None
+PROBE_TIMEOUT = 1
+PROBE_CONCURRENCY = 32
+
+# Compact alternative to JSON for type resources, served to clients which ask for it if msgpack is installed. Each
+# service is encoded as a list of values, in the order given by REPRESENTATION_FIELDS, which is sent once per
+# representation.
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
 
 class mDNSBridgeAPI(WebAPI):
     def __init__(self, mdns):
         self.mdns = mdns
+        # Generations restart from zero with the process, so qualify ETags with something unique to this instance
+        self._etag_prefix = uuid.uuid4().hex[:8]
         super(mDNSBridgeAPI, self).__init__()
+        # Requests are counted and timed by route and type, so that clients polling too often stand out
+        self.metrics = Metrics()
+        self._requests = self.metrics.counter("mdnsbridge_http_requests", "HTTP requests by route, type and status",
+                                              ("route", "type", "status"))
+        self._latency = self.metrics.histogram("mdnsbridge_http_request_duration_seconds",
+                                               "Time taken to respond to HTTP requests, by route and type",
+                                               ("route", "type"))
+        self.app.before_request(self._start_timer)
+        self.app.after_request(self._record_request)
+
+    def _start_timer(self):
+        g.mdnsbridge_started = clock()
+
+    def _record_request(self, response):
+        started = getattr(g, "mdnsbridge_started", None)
+        route = request.url_rule.rule if request.url_rule is not None else ""
+        srv_type = (request.view_args or {}).get("path")
+        # Unknown types are only labelled as such, so that they can't add labels without limit
+        srv_type = srv_type if srv_type in VALID_TYPES else ""
+        self._requests.inc(route, srv_type, str(response.status_code))
+        if started is not None:
+            self._latency.observe(clock() - started, route, srv_type)
+        return response
 
     @route("/")
     def namespace_resource(self):
@@ -50,64 +131,314 @@ class mDNSBridgeAPI(WebAPI):
     def base_resource(self):
         return {"resources": [value + "/" for value in VALID_TYPES]}
 
+    @route("/metrics", auto_json=False)
+    def metrics_resource(self):
+        return Response(self.mdns.metrics.render() + self.metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+    @route(APIBASE + 'events/', auto_json=False)
+    def events_resource(self):
+        last_event_id = request.headers.get("Last-Event-ID", request.args.get("lastEventId"))
+        backlog, subscriber = self.mdns.subscribe(last_event_id)
+
+        def stream():
+            try:
+                for message in backlog:
+                    yield message
+                # A dropped subscriber still receives whatever was queued before it fell behind, and can then
+                # reconnect with the last ID it saw
+                while not (subscriber.dropped and subscriber.queue.empty()):
+                    try:
+                        yield subscriber.queue.get(timeout=EVENT_KEEPALIVE)
+                    except Empty:
+                        yield ": keep-alive\n\n"
+            finally:
+                self.mdns.unsubscribe(subscriber)
+
+        return Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @route(APIBASE + 'batch/')
+    def batch_resource(self):
+        # Several types' representations in one response, keyed by type, so that clients needing more than one don't
+        # have to make a request for each. Each type's cached encoding is reused as it is.
+        types = request.args.get("types")
+        types = list(OrderedDict.fromkeys(types.split(","))) if types else VALID_TYPES
+        if any(srv_type not in VALID_TYPES for srv_type in types):
+            abort(400)
+        try:
+            filters = _filter_args(request.args)
+        except ValueError:
+            abort(400)
+        representations = [(srv_type,) + self.mdns.get_representation(srv_type, **filters) for srv_type in types]
+        etag = "{}-{}".format(self._etag_prefix, ".".join(str(generation) for _, generation, _ in representations))
+        if request.if_none_match.contains(etag):
+            return IppResponse(status=304, headers={"ETag": quote_etag(etag)})
+        body = b"{" + b", ".join(json.dumps(srv_type).encode('utf-8') + b": " + encoded
+                                 for srv_type, _, encoded in representations) + b"}"
+        return IppResponse(body, mimetype='application/json', headers={"ETag": quote_etag(etag)})
+
     @route(APIBASE + '<path>/')
     def type_resource(self, path):
         if path not in VALID_TYPES:
             abort(404)
-        return {"representation": self.mdns.get_services(path)}
+        if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+            # Leave browsers to the pretty-printed HTML rendering
+            return {"representation": self.mdns.get_services(path)}
+        try:
+            filters = _filter_args(request.args)
+        except ValueError:
+            abort(400)
+        if request.args.get("watch") == "true":
+            try:
+                since = int(request.args["since"])
+                timeout = float(request.args.get("timeout", WATCH_TIMEOUT))
+                # NaN fails any comparison, so is rejected here rather than getting past the caps below to wait forever
+                if not 0 <= timeout < float("inf"):
+                    raise ValueError(timeout)
+                timeout = min(timeout, WATCH_TIMEOUT_MAX)
+                if "X-Forwarded-For" in request.headers:
+                    timeout = min(timeout, PROXIED_WATCH_TIMEOUT_MAX)
+            except (KeyError, ValueError):
+                abort(400)
+            self.mdns.wait_for_change(path, since, timeout)
+        mimetype = 'application/json'
+        accepted = request.accept_mimetypes.best_match([mimetype, MSGPACK_MIMETYPE])
+        if msgpack is not None and accepted == MSGPACK_MIMETYPE:
+            mimetype = MSGPACK_MIMETYPE
+            filters["encoding"] = "msgpack"
+        generation, body = self.mdns.get_representation(path, **filters)
+        # Each encoding needs an ETag of its own
+        etag = "{}-{}".format(self._etag_prefix, generation)
+        if mimetype == MSGPACK_MIMETYPE:
+            etag += "-msgpack"
+        headers = {"ETag": quote_etag(etag), "Vary": "Accept"}
+        if request.if_none_match.contains(etag):
+            return IppResponse(status=304, headers=headers)
+        return IppResponse(body, mimetype=mimetype, headers=headers)
+
+
+def _filter_args(args):
+    # Parses the optional query parameters which select a subset of a type's services, using the same rules as
+    # IppmDNSBridge.getHref
+    filters = {}
+    if "api_ver" in args:
+        if not API_VERSION.match(args["api_ver"]):
+            raise ValueError("api_ver must be a version such as v1.0")
+        filters["api_ver"] = args["api_ver"]
+    if "api_proto" in args:
+        if args["api_proto"] not in ("http", "https"):
+            raise ValueError("api_proto must be http or https")
+        filters["api_proto"] = args["api_proto"]
+    if "api_auth" in args:
+        if args["api_auth"] not in ("true", "false"):
+            raise ValueError("api_auth must be true or false")
+        filters["api_auth"] = args["api_auth"] == "true"
+    if "priority" in args:
+        filters["priority"] = int(args["priority"])
+    return filters
+
+
+def _service_record(data, ttl=None, last_seen=None):
+    # Builds the record for a service announced by the mDNS engine, using the defaults of the NMOS specifications for
+    # anything missing from its TXT record
+    priority = 0
+    versions = ["v1.0"]
+    protocol = "http"
+    authorization = False
+    txt_data = {}
+    # Convert txt data from binary data in python3
+    for key, value in data["txt"].items():
+        if type(key) is not str:
+            key = key.decode('ascii')
+        if type(value) not in (str, bool):
+            value = value.decode('ascii')
+        txt_data[key] = value
+    if "pri" in txt_data:
+        if txt_data["pri"].isdigit():
+            priority = int(txt_data["pri"])
+    if "api_ver" in txt_data:
+        versions = txt_data["api_ver"].split(",")
+    if "api_proto" in txt_data:
+        protocol = txt_data["api_proto"]
+    if "api_auth" in txt_data:
+        if txt_data["api_auth"] in [True, "true"]:
+            authorization = True
+    return ServiceRecord(name=data["name"], address=data["address"], port=data["port"], hostname=data["hostname"],
+                         txt=txt_data, priority=priority, versions=versions, protocol=protocol,
+                         authorization=authorization, ttl=ttl, last_seen=last_seen)
+
+
+class _TimerWheel(object):
+    """A hashed timer wheel: a ring of slots, each holding the items due in one tick, so that scheduling an item and
+    finding those which are due take constant time however many are scheduled. Items due further ahead than the ring
+    reaches come round early, so callers check each item returned and schedule it again if it isn't yet due."""
+
+    def __init__(self, slots, resolution, now):
+        self._slots = [set() for _ in range(slots)]
+        self._resolution = resolution
+        self._tick = int(now // resolution)
+
+    def schedule(self, item, deadline):
+        tick = max(int(deadline // self._resolution), self._tick + 1)
+        self._slots[tick % len(self._slots)].add(item)
+
+    def advance(self, now):
+        """Returns the items in every slot passed since the last call"""
+        due = []
+        target = int(now // self._resolution)
+        # Once a whole revolution has passed every slot is due, so there's no need to go round more than once
+        self._tick = max(self._tick, target - len(self._slots))
+        while self._tick < target:
+            self._tick += 1
+            slot = self._slots[self._tick % len(self._slots)]
+            if slot:
+                due.extend(slot)
+                slot.clear()
+        return due
+
+
+class _Subscriber(object):
+    def __init__(self):
+        self.queue = Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
 
 
 class mDNSBridge(object):
     def __init__(self, domain=None):
         self.mdns = MDNSEngine()
         self.mdns.start()
+        # Services are indexed by (name, address) in announcement order, with a secondary index from each name to
+        # its set of addresses so that removals don't need to scan the whole table
         self.services = {}
+        self._names = {}
+        # Each type's generation is bumped on every change to its services, which also discards its index of services
+        # by filter and priority and the cached encodings of its representation, both in full and for each selection
+        # of services which has been asked for. Indexes are rebuilt by the first request after a change.
+        self.generations = {}
+        self._indexes = {}
+        self._representations = {}
+        # Watchers block on the current event for a type, which is set and replaced whenever that type changes
+        self._changed = {}
+        # Every change is also published as an event to stream subscribers. Event IDs are qualified with a token
+        # unique to this instance so that clients resuming after a restart are told to start again.
+        self._instance = uuid.uuid4().hex[:8]
+        self._event_id = 0
+        self._history = deque(maxlen=EVENT_HISTORY)
+        self._subscribers = set()
+        # Representations are also published to shared memory if a directory has been configured for them
+        snapshot_dir = nmoscommonconfig.config.get('mdnsbridge_snapshot_dir')
+        self._snapshots = SnapshotWriter(snapshot_dir) if snapshot_dir else None
+        # Announcements can optionally be queued for a short window, so that a burst of them for the same services is
+        # collapsed into the net change and applied with a single generation bump per type. The window runs from the
+        # first queued announcement, so a long burst can't hold back changes indefinitely.
+        self._debounce_window = nmoscommonconfig.config.get('mdnsbridge_debounce_window', DEBOUNCE_WINDOW)
+        self._pending = OrderedDict()
+        self._pending_names = {}
+        self._flusher = None
+        # Services are stamped with when they were last announced, and dropped if configured to expire and not
+        # announced again in time. MDNSEngine offers no way to ask for a particular service again, so a service
+        # which goes away without saying goodbye is only noticed by it not being announced.
+        self._ttl = nmoscommonconfig.config.get('mdnsbridge_service_ttl', SERVICE_TTL)
+        self._expiry = _TimerWheel(EXPIRY_SLOTS, EXPIRY_RESOLUTION, time.time())
+        self._expirer = gevent.spawn(self._run_expiry) if self._ttl else None
+        # Services can also be probed, to tell clients which are answering and how quickly. A service which answers
+        # counts as having been seen, so probing also keeps live services from expiring.
+        self._probe_interval = nmoscommonconfig.config.get('mdnsbridge_probe_interval', PROBE_INTERVAL)
+        self._prober = gevent.spawn(self._run_probes) if self._probe_interval else None
+        # Announcements are counted as they arrive, to show up browse storms, along with those dropped for having
+        # addresses of the family not in use. Table sizes are read when scraped.
+        self.metrics = Metrics()
+        self._announcements = self.metrics.counter("mdnsbridge_mdns_announcements",
+                                                   "Announcements received from the mDNS engine, by type and action",
+                                                   ("type", "action"))
+        self._filtered = self.metrics.counter("mdnsbridge_mdns_filtered",
+                                              "Announced services dropped by the IPv4/IPv6 address filter, by type "
+                                              "and address family", ("type", "family"))
+        self.metrics.gauge("mdnsbridge_services", "Services held, by type", ("type",),
+                           lambda: [((srv_type,), len(self.services[srv_type])) for srv_type in VALID_TYPES])
+        self.metrics.gauge("mdnsbridge_generation", "Changes made to each type's services since starting", ("type",),
+                           lambda: [((srv_type,), self.generations[srv_type]) for srv_type in VALID_TYPES])
+        self.metrics.gauge("mdnsbridge_event_subscribers", "Clients subscribed to the event stream", (),
+                           lambda: [((), len(self._subscribers))])
         self.domain = domain
         for srv_type in VALID_TYPES:
-            self.services[srv_type] = []
+            self.services[srv_type] = OrderedDict()
+            self._names[srv_type] = {}
+            self.generations[srv_type] = 0
+            self._indexes[srv_type] = None
+            self._representations[srv_type] = {}
+            self._changed[srv_type] = Event()
+            if self._snapshots is not None:
+                self._snapshots.publish(srv_type, self.get_representation(srv_type)[1])
             self.mdns.callback_on_services("_" + srv_type + "._tcp", self._mdns_callback,
                                            registerOnly=False, domain=self.domain)
 
     def _mdns_callback(self, data):
         srv_type = data["type"][1:].split(".")[0]
+        self._announcements.inc(srv_type, data["action"])
+        if self._debounce_window:
+            self._queue(srv_type, data)
+            return
+        changes = []
+        self._apply(srv_type, data, changes)
+        if changes:
+            self._mutated(srv_type, changes)
+
+    def _queue(self, srv_type, data):
+        # Only the latest announcement of each (type, name, address) is kept. A removal supersedes everything queued
+        # for its name, and is kept in place ahead of any later announcements for it, since it also removes whatever
+        # addresses the name already has.
+        names = self._pending_names.setdefault(srv_type, {})
         if data["action"] == "add":
-            priority = 0
-            versions = ["v1.0"]
-            protocol = "http"
-            authorization = False
-            txt_data = {}
-            # Convert txt data from binary data in python3
-            for key, value in data["txt"].items():
-                if type(key) is not str:
-                    key = key.decode('ascii')
-                if type(value) not in (str, bool):
-                    value = value.decode('ascii')
-                txt_data[key] = value
-            if "pri" in txt_data:
-                if txt_data["pri"].isdigit():
-                    priority = int(txt_data["pri"])
-            if "api_ver" in txt_data:
-                versions = txt_data["api_ver"].split(",")
-            if "api_proto" in txt_data:
-                protocol = txt_data["api_proto"]
-            if "api_auth" in txt_data:
-                if txt_data["api_auth"] in [True, "true"]:
-                    authorization = True
-            service_entry = {
-                "name": data["name"], "address": data["address"], "port": data["port"], "txt": txt_data,
-                "priority": priority, "versions": versions, "protocol": protocol, "hostname": data["hostname"],
-                "authorization": authorization
-            }
-            for service in self.services[srv_type]:
-                if service["name"] == data["name"] and service["address"] == data["address"]:
-                    service.update(service_entry)
-                    return
+            key = (srv_type, data["name"], data["address"])
+            names.setdefault(data["name"], set()).add(key)
+        elif data["action"] == "remove":
+            for key in names.pop(data["name"], ()):
+                self._pending.pop(key, None)
+            key = (srv_type, data["name"], None)
+        else:
+            return
+        self._pending[key] = data
+        if self._flusher is None:
+            self._flusher = gevent.spawn_later(self._debounce_window, self._flush)
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._pending_names = {}
+        self._flusher = None
+        changes = OrderedDict()
+        for (srv_type, _, _), data in pending.items():
+            self._apply(srv_type, data, changes.setdefault(srv_type, []))
+        for srv_type, type_changes in changes.items():
+            if type_changes:
+                self._mutated(srv_type, type_changes)
+
+    def _apply(self, srv_type, data, changes):
+        # Applies an announcement to the service table, appending the resulting (action, service) pairs to changes
+        if data["action"] == "add":
+            service_entry = _service_record(data, self._ttl, time.time())
+            key = (data["name"], data["address"])
+            existing = self.services[srv_type].get(key)
+            if existing is not None:
+                # Replacing an existing key keeps its place in the announcement order. Announcements which change
+                # nothing just record that the service has been seen, and keep the results of probing it.
+                if existing != service_entry:
+                    changes.append(("update", service_entry))
+                elif existing.healthy is not None:
+                    service_entry = service_entry.replace(healthy=existing.healthy, rtt=existing.rtt)
+                self.services[srv_type][key] = service_entry
+                return
             if nmoscommonconfig.config.get('prefer_ipv6', False) is False:
                 if ":" not in data["address"]:
-                    self.services[srv_type].append(service_entry)
+                    self._add_service(srv_type, key, service_entry, changes)
+                else:
+                    self._filtered.inc(srv_type, "ipv6")
             else:
                 if not data["address"].startswith("fe80::") and "." not in data["address"]:
-                    self.services[srv_type].append(service_entry)
+                    self._add_service(srv_type, key, service_entry, changes)
+                else:
+                    self._filtered.inc(srv_type, "ipv4" if "." in data["address"] else "ipv6-link-local")
             # TODO: Due to issues with python requests library, IPv6 link local
             # addresses are not compatable with requests.request().
             # Therefore, IPv6 Global addresses must be used for nodes to register
@@ -115,21 +446,228 @@ class mDNSBridge(object):
             # Below code will allow link-local addresses to be used if requests bug is fixed
             # else:
             #     service_entry["address"] = str(data["address"])+str("%%")+str(if_indextoname(data["interface"]))
-            #     self.services[srv_type].append(service_entry)
+            #     self._add_service(srv_type, key, service_entry, changes)
 
         elif data["action"] == "remove":
-            for service in self.services[srv_type]:
-                if service["name"] == data["name"]:
-                    self.services[srv_type].remove(service)
-                    break
+            for address in self._names[srv_type].pop(data["name"], ()):
+                del self.services[srv_type][(data["name"], address)]
+                changes.append(("remove", {"name": data["name"], "address": address}))
+
+    def _add_service(self, srv_type, key, service_entry, changes):
+        name, address = key
+        self.services[srv_type][key] = service_entry
+        self._names[srv_type].setdefault(name, set()).add(address)
+        changes.append(("add", service_entry))
+        if service_entry.ttl:
+            self._expiry.schedule((srv_type, key), service_entry.last_seen + service_entry.ttl)
+
+    def _run_expiry(self):
+        while True:
+            gevent.sleep(EXPIRY_RESOLUTION)
+            self._expire(time.time())
+
+    def _expire(self, now):
+        # Services announced again since they were scheduled are rescheduled for their new expiry time
+        changes = OrderedDict()
+        for srv_type, key in self._expiry.advance(now):
+            service = self.services[srv_type].get(key)
+            if service is None or not service.ttl:
+                continue
+            if not service.expired(now):
+                self._expiry.schedule((srv_type, key), service.last_seen + service.ttl)
+                continue
+            name, address = key
+            del self.services[srv_type][key]
+            addresses = self._names[srv_type][name]
+            addresses.discard(address)
+            if not addresses:
+                del self._names[srv_type][name]
+            changes.setdefault(srv_type, []).append(("expire", {"name": name, "address": address}))
+        for srv_type, type_changes in changes.items():
+            self._mutated(srv_type, type_changes)
+
+    def _run_probes(self):
+        pool = Pool(PROBE_CONCURRENCY)
+        while True:
+            self._probe_all(pool)
+            gevent.sleep(self._probe_interval)
+
+    def _probe_all(self, pool):
+        # Services whose health changes are announced as updated, with a single generation bump per type. Changes
+        # to round trip times alone are left to show up as cached representations are refreshed.
+        targets = [(srv_type, key, service.port) for srv_type in VALID_TYPES
+                   for key, service in self.services[srv_type].items()]
+        changes = OrderedDict()
+        for (srv_type, key, port), rtt in pool.imap_unordered(self._probe, targets):
+            service = self.services[srv_type].get(key)
+            if service is None or service.port != port:
+                # Gone or changed while being probed
+                continue
+            healthy = rtt is not None
+            probed = service.replace(healthy=healthy, rtt=rtt,
+                                     last_seen=time.time() if healthy else service.last_seen)
+            self.services[srv_type][key] = probed
+            if healthy != service.healthy:
+                changes.setdefault(srv_type, []).append(("update", probed))
+        for srv_type, type_changes in changes.items():
+            self._mutated(srv_type, type_changes)
+
+    def _probe(self, target):
+        # Returns the target along with how long it took to accept a connection, or None if it didn't
+        _, (_, address), port = target
+        start = time.time()
+        try:
+            connection = gevent.socket.create_connection((address, port), timeout=PROBE_TIMEOUT)
+        except (socket.error, socket.timeout):
+            return target, None
+        rtt = time.time() - start
+        connection.close()
+        return target, round(rtt, 6)
+
+    def _mutated(self, srv_type, changes):
+        self.generations[srv_type] += 1
+        self._indexes[srv_type] = None
+        self._representations[srv_type] = {}
+        changed = self._changed[srv_type]
+        self._changed[srv_type] = Event()
+        changed.set()
+        if self._snapshots is not None:
+            self._snapshots.publish(srv_type, self.get_representation(srv_type)[1])
+        self._publish(srv_type, changes)
+
+    def _publish(self, srv_type, changes):
+        # Events are only encoded when someone is listening, once per event rather than per subscriber. Publishing
+        # never blocks: a subscriber whose queue is full is dropped rather than holding up the mDNS callback.
+        for action, service in changes:
+            self._event_id += 1
+            event = (self._event_id, action, srv_type, self.generations[srv_type], service)
+            self._history.append(event)
+            if not self._subscribers:
+                continue
+            message = self._encode_event(*event)
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.queue.put_nowait(message)
+                except Full:
+                    subscriber.dropped = True
+                    self._subscribers.discard(subscriber)
+
+    def _encode_event(self, event_id, action, srv_type, generation, service):
+        if isinstance(service, ServiceRecord):
+            service = service.to_json()
+        data = json.dumps({"type": srv_type, "generation": generation, "service": service})
+        return "id: {}-{}\nevent: {}\ndata: {}\n\n".format(self._instance, event_id, action, data)
+
+    def subscribe(self, last_event_id=None):
+        """Registers a new event stream subscriber, returning it along with any events it has missed since
+        `last_event_id`. If those are no longer available the backlog is a single `reset` event, telling the client
+        to fetch the type resources again."""
+        subscriber = _Subscriber()
+        backlog = []
+        if last_event_id is not None:
+            try:
+                instance, event_id = last_event_id.rsplit("-", 1)
+                event_id = int(event_id)
+            except ValueError:
+                instance, event_id = None, None
+            oldest = self._history[0][0] if self._history else self._event_id + 1
+            if instance != self._instance or event_id > self._event_id or event_id < oldest - 1:
+                backlog.append("id: {}-{}\nevent: reset\ndata: {{}}\n\n".format(self._instance, self._event_id))
+            else:
+                backlog = [self._encode_event(*event) for event in self._history if event[0] > event_id]
+        self._subscribers.add(subscriber)
+        return backlog, subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
 
     def get_services(self, srv_type):
         if srv_type not in VALID_TYPES:
             return None
-        return self.services[srv_type]
+        return [service.to_json() for service in self.services[srv_type].values()]
+
+    def get_representation(self, srv_type, api_ver=None, api_proto=None, api_auth=None, priority=None,
+                           encoding="json"):
+        """Returns the current generation of the given type along with its representation encoded as JSON, or
+        msgpack if requested, bytes. The representation may be limited to the services matching the given filters,
+        and to the tier that IppmDNSBridge.getHref would choose from for the given priority. Encodings are cached
+        until the type's services next change, so that each generation is served with the same bytes."""
+        if srv_type not in VALID_TYPES:
+            return None
+        # Encodings are cached by the selection made rather than the filters asked for, so there are only as many as
+        # there are sets of services which can be selected
+        selection, services = self._select(srv_type, api_ver, api_proto, api_auth, priority)
+        key = (selection, encoding)
+        cached = self._representations[srv_type].get(key)
+        if cached is not None:
+            return cached
+        generation = self.generations[srv_type]
+        if encoding == "msgpack":
+            body = msgpack.packb({
+                "fields": REPRESENTATION_FIELDS,
+                "services": [service.to_values() for service in services],
+                "generation": generation
+            }, use_bin_type=True)
+        else:
+            body = json.dumps({"representation": [service.to_json() for service in services],
+                               "generation": generation}).encode('utf-8')
+        if generation == self.generations[srv_type]:
+            self._representations[srv_type][key] = (generation, body)
+        return generation, body
+
+    def _select(self, srv_type, api_ver, api_proto, api_auth, priority):
+        # Returns the services matching the filters, and a key identifying that selection, which is None if it's empty
+        index = self._indexes[srv_type]
+        if index is None:
+            index = self._indexes[srv_type] = self._index(srv_type)
+        filters = (api_ver, api_proto, api_auth)
+        bucket = index.get(filters)
+        if bucket is None:
+            return None, []
+        services, tiers, priorities = bucket
+        if priority is None:
+            return (filters, None), services
+        if priority >= 100:
+            chosen = priority if priority in tiers else None
+        else:
+            chosen = priorities[0] if priorities[0] <= 99 else None
+        if chosen is None:
+            return None, []
+        return (filters, chosen), tiers[chosen]
+
+    def _index(self, srv_type):
+        # Buckets the type's services, in announcement order, under every set of filters which matches them, each
+        # split into tiers by priority. Filters which match no services have no bucket.
+        index = {}
+        for service in self.services[srv_type].values():
+            for api_ver in set([None] + list(service.versions)):
+                for api_proto in (None, service.protocol):
+                    for api_auth in (None, service.authorization):
+                        services, tiers = index.setdefault((api_ver, api_proto, api_auth), ([], {}))
+                        services.append(service)
+                        tiers.setdefault(service.priority, []).append(service)
+        return dict((filters, (services, tiers, sorted(tiers))) for filters, (services, tiers) in index.items())
+
+    def wait_for_change(self, srv_type, since, timeout=None):
+        """Blocks until the generation of the given type differs from `since` or the timeout expires, returning
+        whether it changed."""
+        if self.generations[srv_type] == since:
+            self._changed[srv_type].wait(timeout)
+        return self.generations[srv_type] != since
 
     def stop(self):
         self.mdns.stop()
+        if self._flusher is not None:
+            self._flusher.kill()
+            self._flusher = None
+        if self._expirer is not None:
+            self._expirer.kill()
+            self._expirer = None
+        if self._prober is not None:
+            self._prober.kill()
+            self._prober = None
+        if self._snapshots is not None:
+            self._snapshots.close()
 
 
 if __name__ == "__main__":  # pragma: no cover
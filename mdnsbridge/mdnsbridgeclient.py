@@ -15,11 +15,78 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import json
+import os
 import requests
 import random
+import socket
+import sys
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+try:
+    from urllib.parse import quote, unquote, urlparse
+except ImportError:
+    from urllib import quote, unquote
+    from urlparse import urlparse
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 from nmoscommon.nmoscommonconfig import config as _config
 from nmoscommon.logger import Logger
+from .mdnsbridgesnapshot import SnapshotReader
+from .mdnsbridgerecord import ServiceRecord
+from .mdnsbridgeselection import (SelectionStrategy, RandomStrategy, LatencyStrategy,  # noqa: F401
+                                  WeightedStrategy, HashStrategy)
+from .mdnsbridgeinstrumentation import Instrumentation, ClientMetrics, SpanInstrumentation, _NO_SPAN  # noqa: F401
+
+
+# Port on which mDNSBridgeService serves the API directly, bypassing the Apache proxy on port 80. This must match
+# mdnsbridgeservice.PORT, which isn't imported here to avoid pulling in the service's dependencies.
+BRIDGE_PORT = 12352
+
+# Unix domain socket on which mDNSBridgeService also serves the API by default. Clients use it in preference to TCP
+# whenever it exists. This must match mdnsbridgeservice.SOCKET_PATH.
+BRIDGE_SOCKET = "/run/mdnsbridge/mdnsbridge.sock"
+
+# Compact encoding of representations which the bridge serves as an alternative to JSON, and which is asked for
+# whenever msgpack is installed. This must match mdnsbridge.MSGPACK_MIMETYPE.
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+# Time in seconds that a watch request asks the bridge to wait for a change. Requests through Apache ask for less than
+# its proxy timeout, which would otherwise cut them off. Watches are started no more often than the minimum interval,
+# so that a bridge which answers straight away, such as one without watch support, isn't asked as fast as the client
+# can manage, and back off for the retry interval after a failure.
+WATCH_TIMEOUT = 30
+PROXIED_WATCH_TIMEOUT = 8
+WATCH_MIN_INTERVAL = 1
+WATCH_RETRY_INTERVAL = 1
+
+# Default random variation in seconds applied to each background refresh when mdnsbridge_refresh_interval is set, so
+# that clients started together don't all refresh together
+REFRESH_JITTER = 1
+
+# Bounds in seconds on how long a lookup which found no services is answered from the negative cache before asking the
+# bridge again, doubling each time it still finds none, and the minimum interval between warnings about each lookup
+NO_SERVICE_BACKOFF_MIN = 1
+NO_SERVICE_BACKOFF_MAX = 60
+NO_SERVICE_LOG_INTERVAL = 60
+
+# Default number of consecutive failures reported with markFailed after which an href is no longer handed out, and
+# the time in seconds before it is tried again. Each such trial holds it back for the same time again until its
+# outcome is reported.
+BREAKER_FAILURES = 3
+BREAKER_INTERVAL = 30
+
+# Weight given to each latency reported with markSucceeded in the moving average kept for its href
+LATENCY_SMOOTHING = 0.2
 
 
 class NoService(Exception):
@@ -30,110 +97,679 @@ class EndOfServiceList(Exception):
     pass
 
 
-class IppmDNSBridge(object):
-    def __init__(self, logger=None):
+class _UnixHTTPConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        self.socket_path = kwargs.pop("socket_path")
+        super(_UnixHTTPConnection, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class _UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _UnixHTTPConnection
+
+
+class _UnixHTTPAdapter(HTTPAdapter):
+    """Transport adapter for "http+unix://" URLs, whose host is the percent-encoded path of a Unix domain socket"""
+
+    def __init__(self, *args, **kwargs):
+        self._pools = {}
+        super(_UnixHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        if socket_path not in self._pools:
+            self._pools[socket_path] = _UnixHTTPConnectionPool("localhost", socket_path=socket_path)
+        return self._pools[socket_path]
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super(_UnixHTTPAdapter, self).close()
+        for pool in self._pools.values():
+            pool.close()
+        self._pools = {}
+
+
+class _Tier(object):
+    """Services of the same priority within a bucket, held in an array along with each one's position in it so that
+    any of them can be removed in constant time by moving the last into its place. Selection strategies may keep
+    whatever they precompute for the tier in its cache, which is cleared whenever its services change. Strategies
+    which don't consume services count their uses of the tier instead, and it offers no more once it has been used as
+    many times as it has services."""
+    __slots__ = ("services", "cache", "uses", "_positions")
+
+    def __init__(self):
+        self.services = []
+        self.cache = None
+        self.uses = 0
+        self._positions = {}
+
+    def available(self):
+        return len(self.services) > self.uses
+
+    def append(self, service):
+        self.cache = None
+        self._positions[id(service)] = len(self.services)
+        self.services.append(service)
+
+    def remove(self, service):
+        self.cache = None
+        index = self._positions.pop(id(service))
+        last = self.services.pop()
+        if last is not service:
+            self.services[index] = last
+            self._positions[id(last)] = index
+
+
+class _Breaker(object):
+    """Consecutive failures reported for an href, and the time until which it isn't handed out once they have
+    tripped the breaker"""
+    __slots__ = ("failures", "until")
+
+    def __init__(self):
+        self.failures = 0
+        self.until = 0
+
+
+class _ServiceIndex(object):
+    """The services cached for one type, bucketed on demand by the filters that getHref is called with. Each bucket
+    maps priorities to the services which have them, so that finding candidates doesn't need to scan the whole cache.
+    Refreshes replace the whole index, so the only changes made to one are those made under its lock."""
+
+    def __init__(self, services=()):
+        self.lock = threading.Lock()
+        self._services = list(services)
+        self._taken = set()
+        self._buckets = {}
+        # The tiers that each service has been bucketed into, by id
+        self._tiers = {}
+
+    def __len__(self):
+        return len(self._services) - len(self._taken)
+
+    def __iter__(self):
+        return (service for service in self._services if id(service) not in self._taken)
+
+    def _bucket(self, api_ver, api_proto, api_auth, healthy):
+        key = (api_ver, api_proto, api_auth, healthy)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # Tiers are kept for every priority which matched, even if all its services have already been taken
+            tiers = {}
+            for service in self._services:
+                if healthy and service.healthy is False:
+                    continue
+                if api_ver is not None and api_ver not in service.versions:
+                    continue
+                if api_proto is not None and api_proto != service.protocol:
+                    continue
+                if api_auth is not None and api_auth != service.authorization:
+                    continue
+                tier = tiers.get(service.priority)
+                if tier is None:
+                    tier = tiers[service.priority] = _Tier()
+                if id(service) in self._taken:
+                    continue
+                tier.append(service)
+                self._tiers.setdefault(id(service), []).append(tier)
+            bucket = (tiers, sorted(tiers))
+            self._buckets[key] = bucket
+        return bucket
+
+    def candidates(self, priority, api_ver=None, api_proto=None, api_auth=None, healthy=False):
+        """Returns the tier of services which getHref should choose between, or None if there are none. A priority of
+        100 or more must be matched exactly, otherwise the lowest priority up to 99 is chosen. If healthy is set,
+        services which the bridge found weren't answering are left out."""
+        tiers, priorities = self._bucket(api_ver, api_proto, api_auth, healthy)
+        if priority >= 100:
+            tier = tiers.get(priority)
+            if tier is not None and tier.available():
+                return tier
+            return None
+        for tier_priority in priorities:
+            if tier_priority > 99:
+                break
+            if tiers[tier_priority].available():
+                return tiers[tier_priority]
+        return None
+
+    def matches(self, priority, api_ver=None, api_proto=None, api_auth=None, healthy=False):
+        """Returns whether any service in the index, whether or not it has been taken, would have been a candidate"""
+        tiers, priorities = self._bucket(api_ver, api_proto, api_auth, healthy)
+        if priority >= 100:
+            return priority in tiers
+        return bool(priorities) and priorities[0] <= 99
+
+    def take(self, tier, index):
+        """Removes and returns the service at the given index of a tier returned by candidates, along with every other
+        bucket it appears in. The last service in each of those tiers takes its place."""
+        service = tier.services[index]
+        self._taken.add(id(service))
+        for other in self._tiers.pop(id(service)):
+            other.remove(service)
+        return service
+
+    def use(self, tier, index):
+        """Returns the service at the given index of a tier returned by candidates, leaving it in place. Once a tier has
+        been used as many times as it has services it is passed over like an empty one, so that lookups using it are
+        refreshed as often as if every service had been taken."""
+        tier.uses += 1
+        return tier.services[index]
+
+
+# The default strategies, which have no state of their own so can be shared. Services which the bridge has probed
+# are consumed in order of how fast they answered it, as far as two random choices can tell.
+_RANDOM = RandomStrategy()
+_FASTER_OF_TWO = LatencyStrategy(consumes=True)
+
+
+def _newSession():
+    session = requests.Session()
+    session.mount("http+unix://", _UnixHTTPAdapter())
+    return session
+
+
+class _IppmDNSBridgeBase(object):
+    """Caching, selection and filtering shared by the blocking and asyncio clients, which differ only in how they
+    make requests to the bridge"""
+
+    def __init__(self, logger=None, strategy=None, instrumentation=None):
         self.logger = Logger("mdnsbridge", logger)
+        # How getHref chooses between equally preferred services. If not set, services are chosen at random, or by
+        # latency if mdnsbridge_prefer_healthy is set.
+        self.strategy = strategy
+        # Hooks told about lookups and refreshes, if any. Checked for on each call rather than defaulting to hooks
+        # which do nothing, so that lookups cost nothing extra without them.
+        self.instrumentation = instrumentation
         self.services = {}
+        # The last full representation fetched for each type, along with the ETag it was served with, so that it
+        # can be restored when the bridge reports nothing has changed
+        self._representations = {}
+        self._etags = {}
+        self._generations = {}
+        self._snapshots = None
+        self._snapshotBodies = {}
+        # Lookups which recently found no services, keyed by type and filters, mapped to the time until which they
+        # aren't retried and the backoff that time was chosen with, along with when each was last warned about
+        self._noService = {}
+        self._noServiceWarned = {}
+        # Circuit breakers for hrefs which callers have reported failures of
+        self._breakers = {}
+        self._breakerLock = threading.Lock()
+        # Moving averages of the latencies reported for hrefs
+        self._latencies = {}
+        # Seeded once from the OS, rather than on every selection
+        self._random = random.Random()
         self.config = {}
         self.config.update(_config)
 
-    def getHref(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None):
-        try:
-            try:
-                return self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth)
-            except EndOfServiceList:
-                self.logger.writeInfo("End of DNS-SD service list, reloading")
-                # Re-try after cache has been updated
-                return self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth)
-        except NoService:
-            self.logger.writeWarning(
-                "No DNS-SD service for {}, priority={}, api_ver={}, api_proto={}, api_auth={}".format(
-                    srv_type, priority, api_ver, api_proto, api_auth))
-            return ""
-
-    def getHrefWithException(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None):
+    def _priority(self, priority):
         if priority is None:
             priority = self.config["priority"]
 
         if self.logger is not None:
             self.logger.writeDebug("IppmDNSBridge priority = {}".format(priority))
+        return priority
 
-        # Check if type is in services. If not add it
-        if srv_type not in self.services:
-            self.services[srv_type] = []
+    def _takeHref(self, services, priority, api_ver, api_proto, api_auth, affinity=None):
+        # Choose a service with the selection strategy, deleting it from the cached list of services if the strategy
+        # consumes them, and return it
+        with services.lock:
+            healthy = self.config.get("mdnsbridge_prefer_healthy", False)
+            # Services which aren't answering are only used if there aren't any others
+            if healthy and not services.matches(priority, api_ver, api_proto, api_auth, healthy=True):
+                healthy = False
+            strategy = self._selectionStrategy()
+            # Services whose circuit breakers are open are set aside, and only used if there's nothing else
+            tripped = None
+            while True:
+                valid_services = services.candidates(priority, api_ver, api_proto, api_auth, healthy)
+                if valid_services is None:
+                    return tripped
+                index = strategy.select(valid_services, self._random, self._latency, affinity)
+                href = self._createHref(valid_services.services[index])
+                if not self._allowHref(href):
+                    services.take(valid_services, index)
+                    if tripped is None:
+                        tripped = href
+                    continue
+                if strategy.consumes:
+                    services.take(valid_services, index)
+                else:
+                    services.use(valid_services, index)
+                return href
 
-        # Check if there are any of that type of service, if not do a request
-        valid_services = self._getValidServices(srv_type, priority, api_ver, api_proto, api_auth)
+    def _selectionStrategy(self):
+        if self.strategy is not None:
+            return self.strategy
+        if self.config.get("mdnsbridge_prefer_healthy", False):
+            return _FASTER_OF_TWO
+        return _RANDOM
 
-        if len(valid_services) == 0:
-            self.updateServices(srv_type)
-            valid_services = self._getValidServices(srv_type, priority, api_ver, api_proto, api_auth)
+    def _latency(self, service):
+        # The latency reported for a service if there is one, otherwise how long it took to answer the bridge's probe
+        latency = self._latencies.get(self._createHref(service))
+        return service.rtt if latency is None else latency
 
-            if len(valid_services) == 0:
-                raise NoService
-            else:
-                raise EndOfServiceList
-
-        # Randomise selection. Delete entry from the cached list of services and return it
-        random.seed()
-        index = random.randint(0, len(valid_services) - 1)
-        service = valid_services[index]
-        href = self._createHref(service)
-        self.services[srv_type].remove(service)
-
-        return href
-
-    def _getValidServices(self, srv_type, priority, api_ver=None, api_proto=None, api_auth=None):
-        current_priority = 99
-        valid_services = []
-        for service in self.services[srv_type]:
-            if api_ver is not None and api_ver not in service["versions"]:
-                continue
-            if api_proto is not None and api_proto != service["protocol"]:
-                continue
-            if api_auth is not None and api_auth != service.get("authorization", False):
-                continue
-            if priority >= 100:
-                if service["priority"] == priority:
-                    valid_services.append(service)
-            else:
-                if service["priority"] < current_priority:
-                    current_priority = service["priority"]
-                    valid_services = []
-                if service["priority"] == current_priority:
-                    valid_services.append(service)
+    def _allowHref(self, href):
+        with self._breakerLock:
+            breaker = self._breakers.get(href)
+            if breaker is None or breaker.failures < self.config.get("mdnsbridge_breaker_failures", BREAKER_FAILURES):
+                return True
+            now = time.time()
+            if now < breaker.until:
+                return False
+            # Half open: let this one through as a trial, and hold back everyone else until it's reported on
+            breaker.until = now + self.config.get("mdnsbridge_breaker_interval", BREAKER_INTERVAL)
+            return True
+
+    def markFailed(self, href):
+        """Reports that a request to an href returned by getHref failed. Once enough consecutive failures have been
+        reported, the href isn't returned again for a while, unless there's nothing else."""
+        with self._breakerLock:
+            breaker = self._breakers.setdefault(href, _Breaker())
+            breaker.failures += 1
+            if breaker.failures >= self.config.get("mdnsbridge_breaker_failures", BREAKER_FAILURES):
+                breaker.until = time.time() + self.config.get("mdnsbridge_breaker_interval", BREAKER_INTERVAL)
+
+    def markSucceeded(self, href, latency=None):
+        """Reports that a request to an href returned by getHref succeeded, closing its circuit breaker, optionally
+        along with how long it took in seconds for selection strategies which take latency into account"""
+        with self._breakerLock:
+            self._breakers.pop(href, None)
+            if latency is not None:
+                average = self._latencies.get(href)
+                if average is not None:
+                    latency = average + LATENCY_SMOOTHING * (latency - average)
+                self._latencies[href] = latency
+
+    def _checkBackoff(self, srv_type, priority, api_ver, api_proto, api_auth):
+        # Raises NoService without asking the bridge if this lookup recently found nothing
+        backoff = self._noService.get((srv_type, priority, api_ver, api_proto, api_auth))
+        if backoff is not None and time.time() < backoff[0]:
+            if self.instrumentation is not None:
+                self.instrumentation.noService(srv_type)
+            raise NoService
+
+    def _checkUpdated(self, srv_type, services, priority, api_ver, api_proto, api_auth):
+        # Called once the cached services have been updated after running out, to raise the appropriate exception
+        key = (srv_type, priority, api_ver, api_proto, api_auth)
+        updated = self.services[srv_type]
+        if updated is not services:
+            with updated.lock:
+                if updated.matches(priority, api_ver, api_proto, api_auth):
+                    self._noService.pop(key, None)
+                    if self.instrumentation is not None:
+                        self.instrumentation.endOfServiceList(srv_type)
+                    raise EndOfServiceList
+        previous = self._noService.get(key)
+        backoff = min(previous[1] * 2, NO_SERVICE_BACKOFF_MAX) if previous else NO_SERVICE_BACKOFF_MIN
+        self._noService[key] = (time.time() + self._random.uniform(backoff / 2.0, backoff), backoff)
+        if self.instrumentation is not None:
+            self.instrumentation.noService(srv_type)
+        raise NoService
+
+    def _refreshSpan(self, srv_type):
+        if self.instrumentation is None:
+            return _NO_SPAN
+        return self.instrumentation.refresh(srv_type)
+
+    def _clearBackoff(self, srv_type, services):
+        # Forget about lookups of this type which would now find something
+        for key in list(self._noService):
+            if key[0] == srv_type and services.matches(*key[1:]):
+                self._noService.pop(key, None)
 
-        return valid_services
+    def _warnNoService(self, srv_type, priority, api_ver, api_proto, api_auth):
+        key = (srv_type, priority, api_ver, api_proto, api_auth)
+        now = time.time()
+        warned, suppressed = self._noServiceWarned.get(key, (None, 0))
+        if warned is not None and now - warned < NO_SERVICE_LOG_INTERVAL:
+            self._noServiceWarned[key] = (warned, suppressed + 1)
+            return
+        self._noServiceWarned[key] = (now, 0)
+        message = "No DNS-SD service for {}, priority={}, api_ver={}, api_proto={}, api_auth={}".format(
+            srv_type, priority, api_ver, api_proto, api_auth)
+        if suppressed:
+            message += " ({} similar warnings suppressed)".format(suppressed)
+        self.logger.writeWarning(message)
 
     def _createHref(self, service):
-        proto = service['protocol']
-        if service.get('hostname') is not None and self.config["prefer_hostnames"]:
-            address = service['hostname']
+        proto = service.protocol
+        if service.hostname is not None and self.config["prefer_hostnames"]:
+            address = service.hostname
         else:
-            address = service['address']
+            address = service.address
             if ":" in address:
                 address = "[" + address + "]"
-        port = service['port']
+        port = service.port
         return '{}://{}:{}'.format(proto, address, port)
 
+    def _socketPath(self):
+        # The bridge's Unix domain socket, if it is configured and exists
+        socket_path = self.config.get("mdnsbridge_socket", BRIDGE_SOCKET)
+        if socket_path and os.path.exists(socket_path):
+            return socket_path
+        return None
+
+    def _requestUrl(self, srv_type):
+        socket_path = self._socketPath()
+        if socket_path is not None:
+            return "http+unix://{}/x-ipstudio/mdnsbridge/v1.0/{}/".format(quote(socket_path, safe=""), srv_type)
+        if self.config.get("mdnsbridge_direct", False):
+            return "http://127.0.0.1:{}/x-ipstudio/mdnsbridge/v1.0/{}/".format(BRIDGE_PORT, srv_type)
+        return "http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/"
+
+    def _requestParams(self):
+        # Services whose protocol doesn't match https_mode are never used, so ask the bridge to leave them out. Other
+        # filters vary from call to call so are still applied here, to the whole cached representation.
+        return {"api_proto": "https" if self.config.get("https_mode") == "enabled" else "http"}
+
+    def _requestHeaders(self, srv_type):
+        headers = {}
+        if msgpack is not None:
+            # Bridges which don't support msgpack ignore this and send JSON
+            headers["Accept"] = "{}, application/json;q=0.5".format(MSGPACK_MIMETYPE)
+        if srv_type in self._etags:
+            headers["If-None-Match"] = self._etags[srv_type]
+        return headers
+
+    def _updateFromSnapshot(self, srv_type):
+        # Read the representation straight from the bridge's shared memory snapshot, if configured and available
+        snapshot_dir = self.config.get("mdnsbridge_snapshot_dir")
+        if not snapshot_dir:
+            return False
+        if self._snapshots is None or self._snapshots.directory != snapshot_dir:
+            self._snapshots = SnapshotReader(snapshot_dir)
+        try:
+            body = self._snapshots.read(srv_type)
+        except Exception as e:
+            self.logger.writeWarning("Exception reading services snapshot: {}".format(e))
+            return False
+        if body is None:
+            return False
+        if body is self._snapshotBodies.get(srv_type):
+            # The reader hands back the same object until the snapshot changes
+            self.services[srv_type] = _ServiceIndex(self._representations[srv_type])
+        else:
+            self._setRepresentation(srv_type, body)
+            self._snapshotBodies[srv_type] = body
+        return True
+
+    def _decode(self, content_type, content):
+        # Returns the body of a 200 response in the same shape whichever encoding it was sent with
+        if msgpack is not None and content_type is not None and content_type.startswith(MSGPACK_MIMETYPE):
+            body = msgpack.unpackb(content, raw=False)
+            fields = body["fields"]
+            return {"representation": [dict(zip(fields, values)) for values in body["services"]],
+                    "generation": body.get("generation")}
+        return json.loads(content.decode('utf-8'))
+
+    def _applyResponse(self, srv_type, status_code, etag, body=None):
+        if status_code == 304:
+            self.services[srv_type] = _ServiceIndex(self._representations[srv_type])
+        elif status_code == 200:
+            self._setRepresentation(srv_type, body)
+            if etag is not None:
+                self._etags[srv_type] = etag
+            else:
+                self._etags.pop(srv_type, None)
+
+    def _setRepresentation(self, srv_type, body):
+        # If any results, put them in self.services
+        services = []
+        for dns_data in body["representation"]:
+            if self.config["https_mode"] == "enabled" and dns_data["protocol"] == "https":
+                services.append(ServiceRecord.from_json(dns_data))
+            elif self.config["https_mode"] != "enabled" and dns_data["protocol"] == "http":
+                services.append(ServiceRecord.from_json(dns_data))
+            else:
+                self.logger.writeDebug(("Ignoring service with IP {} as protocol '{}' doesn't match the "
+                                        "current mode").format(dns_data["address"], dns_data["protocol"]))
+        index = _ServiceIndex(services)
+        self._clearBackoff(srv_type, index)
+        self.services[srv_type] = index
+        self._representations[srv_type] = services
+        self._generations[srv_type] = body.get("generation")
+
+
+class IppmDNSBridge(_IppmDNSBridgeBase):
+    def __init__(self, logger=None, strategy=None, instrumentation=None):
+        super(IppmDNSBridge, self).__init__(logger, strategy, instrumentation)
+        self._watchers = {}
+        # Requests to the bridge share a pooled session so that connections are kept alive between refreshes
+        self._session = _newSession()
+        # Only one refresh of each type is made at a time, with other callers waiting on it to finish
+        self._refreshing = {}
+        self._refreshLock = threading.Lock()
+        self._refreshers = {}
+
+    def getHref(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None, affinity=None):
+        try:
+            while True:
+                try:
+                    return self.getHrefWithException(srv_type, priority, api_ver, api_proto, api_auth, affinity)
+                except EndOfServiceList:
+                    # Re-try after cache has been updated. Other threads may take everything in it first, in which
+                    # case it is updated again.
+                    self.logger.writeInfo("End of DNS-SD service list, reloading")
+        except NoService:
+            self._warnNoService(srv_type, priority, api_ver, api_proto, api_auth)
+            return ""
+
+    def getHrefWithException(self, srv_type, priority=None, api_ver=None, api_proto=None, api_auth=None,
+                             affinity=None):
+        priority = self._priority(priority)
+
+        # Check if type is in services. If not add it
+        services = self.services.setdefault(srv_type, _ServiceIndex())
+        href = self._takeHref(services, priority, api_ver, api_proto, api_auth, affinity)
+        if href is not None:
+            if self.instrumentation is not None:
+                self.instrumentation.hit(srv_type)
+            return href
+        self._checkBackoff(srv_type, priority, api_ver, api_proto, api_auth)
+
+        if self._refreshInterval() and self._representations.get(srv_type):
+            # Start again from the cached representation rather than waiting on a request, and leave keeping it up to
+            # date to a background refresher
+            with self._refreshLock:
+                if self.services[srv_type] is services:
+                    self.services[srv_type] = _ServiceIndex(self._representations[srv_type])
+        else:
+            # If there aren't any of that type of service, do a request
+            self.updateServices(srv_type)
+        if self._refreshInterval():
+            self._startRefreshing(srv_type)
+        self._checkUpdated(srv_type, services, priority, api_ver, api_proto, api_auth)
+
     def updateServices(self, srv_type):
-        req_url = "http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/"
+        with self._refreshLock:
+            refreshed = self._refreshing.get(srv_type)
+            if refreshed is None:
+                refreshed = self._refreshing[srv_type] = threading.Event()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            refreshed.wait()
+            return
+        try:
+            with self._refreshSpan(srv_type):
+                self._updateServices(srv_type)
+        finally:
+            with self._refreshLock:
+                del self._refreshing[srv_type]
+            refreshed.set()
+
+    def _updateServices(self, srv_type):
+        if self._updateFromSnapshot(srv_type):
+            return
+        # Request to localhost/x-ipstudio/mdnsbridge/v1.0/<type>/
+        self._get(self._requestUrl(srv_type), self._requestParams(), self._requestHeaders(srv_type),
+                  lambda r: self._handleResponse(srv_type, r), "updating services")
+
+    def _get(self, url, params, headers, handle, activity):
+        # Makes a request to the bridge with the shared session and returns what handle makes of the response, or None
+        # if either fails
+        session = self._session
+        try:
+            r = session.get(url, params=params, timeout=0.5, proxies={'http': ''}, headers=headers)
+            return handle(r)
+        except Exception as e:
+            self.logger.writeWarning("Exception {}: {}".format(activity, e))
+            # Don't risk reusing a connection left in a bad state
+            with self._refreshLock:
+                if self._session is session:
+                    self._session = _newSession()
+            session.close()
+            return None
+
+    def prefetch(self, types):
+        """Fills the cache for each of the given types, with a single request to the bridge if it supports that, so
+        that the first getHref for each doesn't need to make one of its own."""
+        types = [srv_type for srv_type in types if not self._updateFromSnapshot(srv_type)]
+        # Callers wanting any of the types wait on the batch as they would on a refresh of that type, and types which
+        # are already being refreshed are left to that refresh
+        claimed = []
+        with self._refreshLock:
+            for srv_type in types:
+                if srv_type not in self._refreshing:
+                    self._refreshing[srv_type] = threading.Event()
+                    claimed.append(srv_type)
+        if not claimed:
+            return
+        try:
+            with self._refreshSpan("batch"):
+                fetched = self._get(self._requestUrl("batch"), dict(self._requestParams(), types=",".join(claimed)),
+                                    {}, lambda r: self._applyBatch(claimed, r), "prefetching services")
+            if not fetched:
+                # Bridges which don't support batches, or don't know one of the types, are asked for each type in turn
+                for srv_type in claimed:
+                    with self._refreshSpan(srv_type):
+                        self._updateServices(srv_type)
+        finally:
+            with self._refreshLock:
+                for srv_type in claimed:
+                    self._refreshing.pop(srv_type).set()
+
+    def _applyBatch(self, types, r):
+        if r is None or r.status_code != 200:
+            return False
+        body = r.json()
+        for srv_type in types:
+            self._setRepresentation(srv_type, body[srv_type])
+            # The batch doesn't say what each type's own ETag would be
+            self._etags.pop(srv_type, None)
+        return True
+
+    def _handleResponse(self, srv_type, r):
+        if r is not None and r.status_code == 304:
+            self._applyResponse(srv_type, 304, None)
+        elif r is not None and r.status_code == 200:
+            if msgpack is not None:
+                body = self._decode(r.headers.get("Content-Type"), r.content)
+            else:
+                body = r.json()
+            self._applyResponse(srv_type, 200, r.headers.get("ETag"), body)
+
+    def startWatching(self, srv_type):
+        """Keep the cached services for the given type up to date in the background, using the bridge's watch
+        query to be told about changes as soon as they happen."""
+        if srv_type in self._watchers:
+            return
+        stop = threading.Event()
+        watcher = threading.Thread(target=self._watch, args=(srv_type, stop))
+        watcher.daemon = True
+        self._watchers[srv_type] = stop
+        watcher.start()
+
+    def stopWatching(self):
+        for stop in self._watchers.values():
+            stop.set()
+        self._watchers = {}
+
+    def _refreshInterval(self):
+        # Time in seconds between background refreshes of each type used, or None if they are disabled
+        return self.config.get("mdnsbridge_refresh_interval")
+
+    def _startRefreshing(self, srv_type):
+        with self._refreshLock:
+            if srv_type in self._refreshers:
+                return
+            stop = self._refreshers[srv_type] = threading.Event()
+        refresher = threading.Thread(target=self._refresh, args=(srv_type, stop))
+        refresher.daemon = True
+        refresher.start()
+
+    def stopRefreshing(self):
+        with self._refreshLock:
+            for stop in self._refreshers.values():
+                stop.set()
+            self._refreshers = {}
+
+    def _refresh(self, srv_type, stop):
+        while True:
+            interval = self._refreshInterval()
+            if not interval:
+                break
+            jitter = self.config.get("mdnsbridge_refresh_jitter", REFRESH_JITTER)
+            if stop.wait(max(0, interval + self._random.uniform(-jitter, jitter))):
+                break
+            self.updateServices(srv_type)
+        with self._refreshLock:
+            if self._refreshers.get(srv_type) is stop:
+                del self._refreshers[srv_type]
+
+    def _watch(self, srv_type, stop):
+        # Watchers hold their connection open for long periods, so each gets a session of its own
+        session = _newSession()
+        while not stop.is_set():
+            started = time.time()
+            if not self._watchOnce(srv_type, session):
+                session.close()
+                session = _newSession()
+                stop.wait(WATCH_RETRY_INTERVAL)
+                continue
+            remaining = started + WATCH_MIN_INTERVAL - time.time()
+            if remaining > 0:
+                stop.wait(remaining)
+        session.close()
+
+    def _watchTimeout(self):
+        if self._socketPath() is not None or self.config.get("mdnsbridge_direct", False):
+            return WATCH_TIMEOUT
+        return PROXIED_WATCH_TIMEOUT
+
+    def _watchOnce(self, srv_type, session):
+        params = self._requestParams()
+        timeout = self._watchTimeout()
+        params.update({"watch": "true", "since": self._generations.get(srv_type, -1), "timeout": timeout})
         try:
-            # Request to localhost/x-ipstudio/mdnsbridge/v1.0/<type>/
-            r = requests.get(req_url, timeout=0.5, proxies={'http': ''})
-            if r is not None and r.status_code == 200:
-                # If any results, put them in self.services
-                self.services[srv_type] = []
-                for dns_data in r.json()["representation"]:
-                    if self.config["https_mode"] == "enabled" and dns_data["protocol"] == "https":
-                        self.services[srv_type].append(dns_data)
-                    elif self.config["https_mode"] != "enabled" and dns_data["protocol"] == "http":
-                        self.services[srv_type].append(dns_data)
-                    else:
-                        self.logger.writeDebug(("Ignoring service with IP {} as protocol '{}' doesn't match the "
-                                                "current mode").format(dns_data["address"], dns_data["protocol"]))
+            r = session.get(self._requestUrl(srv_type), params=params, timeout=timeout + 5,
+                            proxies={'http': ''}, headers=self._requestHeaders(srv_type))
+            if r is None or r.status_code not in (200, 304):
+                return False
+            if r.status_code == 200:
+                self._handleResponse(srv_type, r)
+            return True
         except Exception as e:
-            self.logger.writeWarning("Exception updating services: {}".format(e))
+            self.logger.writeWarning("Exception watching services: {}".format(e))
+            return False
+
+
+if sys.version_info >= (3, 5):
+    from ._asyncclient import AsyncIppmDNSBridge  # noqa: E402,F401
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,136 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Hooks through which IppmDNSBridge reports what getHref does: whether each lookup was answered from the cache, how
+# long each refresh of the cache takes, and when lookups end in NoService or EndOfServiceList. Clients are given an
+# instrumentation to call, or None, in which case the only cost is checking for it. Subclass Instrumentation to
+# receive the hooks as callbacks.
+
+from __future__ import absolute_import
+
+import threading
+
+from .mdnsbridgemetrics import Metrics, clock
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation(object):
+    """Hooks called by IppmDNSBridge, which do nothing unless overridden"""
+
+    def hit(self, srv_type):
+        """Called when getHref returns a service from the cache"""
+
+    def noService(self, srv_type):
+        """Called when a lookup finds no services, whether or not it asked the bridge"""
+
+    def endOfServiceList(self, srv_type):
+        """Called when a lookup has used every cached service, and the refreshed cache has more"""
+
+    def refresh(self, srv_type):
+        """Returns a context manager wrapping a refresh of the cache from the bridge"""
+        return _NO_SPAN
+
+
+class _RefreshTimer(object):
+    __slots__ = ("_metrics", "_srv_type", "_started")
+
+    def __init__(self, metrics, srv_type):
+        self._metrics = metrics
+        self._srv_type = srv_type
+
+    def __enter__(self):
+        self._started = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = clock() - self._started
+        with self._metrics.lock:
+            self._metrics.refreshes.inc(self._srv_type)
+            self._metrics.refreshDuration.observe(elapsed, self._srv_type)
+        return False
+
+
+class ClientMetrics(Instrumentation):
+    """Counts lookups by outcome and times refreshes, by type. The metrics can be rendered in the Prometheus text
+    format for an application to serve alongside its own.
+
+    Unlike the bridge, clients are shared between threads, so the metrics are only updated and read while holding a
+    lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self.hits = self.metrics.counter("mdnsbridge_client_hits", "Lookups answered from the cache", ("type",))
+        self.refreshes = self.metrics.counter("mdnsbridge_client_refreshes", "Refreshes of the cache", ("type",))
+        self.noServices = self.metrics.counter("mdnsbridge_client_no_service", "Lookups which found no services",
+                                               ("type",))
+        self.endOfServiceLists = self.metrics.counter("mdnsbridge_client_end_of_service_list",
+                                                      "Lookups which used every cached service", ("type",))
+        self.refreshDuration = self.metrics.histogram("mdnsbridge_client_refresh_duration_seconds",
+                                                      "Time taken to refresh the cache", ("type",))
+
+    def hit(self, srv_type):
+        with self.lock:
+            self.hits.inc(srv_type)
+
+    def noService(self, srv_type):
+        with self.lock:
+            self.noServices.inc(srv_type)
+
+    def endOfServiceList(self, srv_type):
+        with self.lock:
+            self.endOfServiceLists.inc(srv_type)
+
+    def refresh(self, srv_type):
+        return _RefreshTimer(self, srv_type)
+
+    def render(self):
+        with self.lock:
+            return self.metrics.render()
+
+
+class SpanInstrumentation(Instrumentation):
+    """Wraps each refresh in a span from the given tracer, which is used as an OpenTelemetry tracer would be, and
+    records the outcome of each lookup as an event on the current span, if the tracing library provides a way of
+    getting it"""
+
+    def __init__(self, tracer, current_span=None):
+        self.tracer = tracer
+        self.current_span = current_span
+
+    def _event(self, name, srv_type):
+        if self.current_span is not None:
+            self.current_span().add_event(name, {"mdnsbridge.type": srv_type})
+
+    def hit(self, srv_type):
+        self._event("mdnsbridge.hit", srv_type)
+
+    def noService(self, srv_type):
+        self._event("mdnsbridge.no_service", srv_type)
+
+    def endOfServiceList(self, srv_type):
+        self._event("mdnsbridge.end_of_service_list", srv_type)
+
+    def refresh(self, srv_type):
+        return self.tracer.start_as_current_span("mdnsbridge.refresh", attributes={"mdnsbridge.type": srv_type})
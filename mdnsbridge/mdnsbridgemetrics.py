@@ -0,0 +1,144 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Metrics served by the bridge at /metrics in the Prometheus text exposition format. The bridge runs in gevent
+# greenlets, which only switch when they block, so metrics are updated with plain arithmetic rather than under locks,
+# keeping the cost on hot paths to a dict lookup and an addition. Anything which can be read from the bridge's state
+# when scraped, such as the size of each type's table, is only computed then.
+
+from __future__ import absolute_import
+
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds of the buckets of latency histograms, reaching far enough for long polls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# For timing intervals, unaffected by changes to the system clock where available
+clock = getattr(time, "perf_counter", time.time)
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        # The text format names a counter's family after its samples, which end in _total
+        self.name = name + "_total"
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values):
+        self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield self.name, zip(self.labels, label_values), value
+
+
+class Gauge(object):
+    """A value read when scraped, from a function returning (label values, value) pairs"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._collect = collect
+
+    def samples(self):
+        for label_values, value in self._collect():
+            yield self.name, zip(self.labels, label_values), value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Each set of label values has a count per bucket, plus one for values beyond the last, which are only made
+        # cumulative when scraped, and the sum of the values observed
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, *label_values):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] = self._sums.get(label_values, 0) + value
+
+    def count(self, *label_values):
+        return sum(self._counts.get(label_values, ()))
+
+    def samples(self):
+        for label_values, counts in sorted(self._counts.items()):
+            labels = list(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield self.name + "_bucket", labels + [("le", _format_value(float(bound)))], total
+            yield self.name + "_sum", labels, self._sums[label_values]
+            yield self.name + "_count", labels, total
+
+
+class Metrics(object):
+    """A set of metrics, rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels, collect):
+        return self._add(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, _escape(metric.documentation, '')))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                labels = ",".join('{}="{}"'.format(label, _escape(value, '"')) for label, value in labels)
+                lines.append("{}{} {}".format(name, "{" + labels + "}" if labels else "", _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value, quote):
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace(quote, "\\" + quote) if quote else value
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
@@ -0,0 +1,128 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The service records held by both the bridge and its clients. The bridge can hold many thousands of these, so they
+# are slotted rather than dicts, and the strings which are repeated across most services are interned. Records are
+# immutable, so that they can be shared between the service table, the event history and client indexes without
+# copying, and are only turned into the dicts of the JSON representation at the edges.
+#
+# Each record also notes when its service was last announced and how long that announcement is good for, and the
+# result of the bridge's last probe of it, if it probes services. These aren't part of its value: a record re-announced
+# unchanged is equal to the one it replaces.
+
+from __future__ import absolute_import
+
+try:
+    from sys import intern
+except ImportError:  # Python 2, where only byte strings can be interned
+    def intern(value, _intern=intern):  # noqa: F821
+        return _intern(value) if type(value) is str else value
+
+# The fields which make up each service's value, and the fields of each service in the bridge's representations, in
+# the order used by its compact encodings. A service's last_seen is the time in seconds since the epoch when it was
+# last announced, and healthy and rtt are whether it answered the last probe and how long it took in seconds, or None
+# if not probed. Representations are only encoded again when a type's services change, so last_seen and rtt are as of
+# that change rather than of the request, and a re-announcement which changes nothing else doesn't move them on.
+SERVICE_FIELDS = ["name", "address", "port", "hostname", "txt", "priority", "versions", "protocol", "authorization"]
+REPRESENTATION_FIELDS = SERVICE_FIELDS + ["ttl", "last_seen", "healthy", "rtt"]
+
+
+def _intern_value(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+class ServiceRecord(object):
+    """A DNS-SD service advertising an NMOS API. The TXT record is held as a tuple of (key, value) pairs sorted by
+    key, and versions as a tuple, so that records can be compared and hashed by value."""
+    __slots__ = SERVICE_FIELDS + ["ttl", "last_seen", "healthy", "rtt"]
+
+    def __init__(self, name=None, address=None, port=None, hostname=None, txt=(), priority=0, versions=("v1.0",),
+                 protocol="http", authorization=False, ttl=None, last_seen=None, healthy=None, rtt=None):
+        if isinstance(txt, dict):
+            txt = txt.items()
+        set_field = super(ServiceRecord, self).__setattr__
+        set_field("name", name)
+        set_field("address", address)
+        set_field("port", port)
+        set_field("hostname", hostname)
+        set_field("txt", tuple(sorted((intern(key), _intern_value(value)) for key, value in txt)))
+        set_field("priority", priority)
+        set_field("versions", tuple(intern(version) for version in versions))
+        set_field("protocol", intern(protocol))
+        set_field("authorization", authorization)
+        set_field("ttl", ttl)
+        set_field("last_seen", last_seen)
+        set_field("healthy", healthy)
+        set_field("rtt", rtt)
+
+    @classmethod
+    def from_json(cls, service):
+        """Creates a record from a service in the bridge's JSON representation, whose fields may be incomplete if it
+        came from an older bridge"""
+        return cls(service.get("name"), service.get("address"), service.get("port"), service.get("hostname"),
+                   service.get("txt", ()), service.get("priority", 0), service.get("versions", ("v1.0",)),
+                   service.get("protocol", "http"), service.get("authorization", False), service.get("ttl"),
+                   service.get("last_seen"), service.get("healthy"), service.get("rtt"))
+
+    def replace(self, **fields):
+        """Returns a copy of the record with the given fields replaced"""
+        values = dict((field, getattr(self, field)) for field in self.__slots__)
+        values.update(fields)
+        return ServiceRecord(**values)
+
+    def expired(self, now):
+        return self.ttl is not None and self.last_seen is not None and now >= self.last_seen + self.ttl
+
+    def to_json(self):
+        return {
+            "name": self.name, "address": self.address, "port": self.port, "hostname": self.hostname,
+            "txt": dict(self.txt), "priority": self.priority, "versions": list(self.versions),
+            "protocol": self.protocol, "authorization": self.authorization, "ttl": self.ttl,
+            "last_seen": self.last_seen, "healthy": self.healthy, "rtt": self.rtt
+        }
+
+    def to_values(self):
+        """Returns the record's fields in the order of REPRESENTATION_FIELDS, as they appear in its JSON
+        representation"""
+        return [self.name, self.address, self.port, self.hostname, dict(self.txt), self.priority, list(self.versions),
+                self.protocol, self.authorization, self.ttl, self.last_seen, self.healthy, self.rtt]
+
+    def _key(self):
+        return (self.name, self.address, self.port, self.hostname, self.txt, self.priority, self.versions,
+                self.protocol, self.authorization)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ServiceRecord is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ServiceRecord is immutable")
+
+    def __reduce__(self):
+        return (ServiceRecord, self._key() + (self.ttl, self.last_seen, self.healthy, self.rtt))
+
+    def __eq__(self, other):
+        if not isinstance(other, ServiceRecord):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "ServiceRecord({})".format(", ".join(
+            "{}={!r}".format(field, getattr(self, field)) for field in self.__slots__))
@@ -0,0 +1,126 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Strategies with which IppmDNSBridge chooses between the services of a tier: those matching the filters given to
+# getHref with the priority it prefers. A strategy is given the tier, the client's random number generator, a function
+# returning the latency observed for a service (or None if there hasn't been any), and the affinity key given to
+# getHref, if any, and returns the index of the service to use.
+#
+# Strategies which consume services have each service returned at most once between refreshes of the client's cache,
+# as getHref has always done. The others may return a service any number of times, and each tier is passed over once
+# it has been picked from as many times as it has services, as if they had been consumed. Anything a strategy
+# precomputes for a tier is kept in the tier's cache, which is cleared whenever its services change.
+
+from __future__ import absolute_import
+
+import hashlib
+from bisect import bisect_right
+
+# Default TXT record key giving each service's weight for WeightedStrategy, and the number of points each service
+# has on HashStrategy's ring
+WEIGHT_KEY = "weight"
+HASH_REPLICAS = 64
+
+
+class SelectionStrategy(object):
+    consumes = False
+
+    def select(self, tier, random, latency, affinity=None):
+        raise NotImplementedError()
+
+    def _cached(self, tier, build):
+        # Returns what build computes for the tier, only computing it again once the tier has changed
+        if tier.cache is None or tier.cache[0] is not self:
+            tier.cache = (self, build(tier.services))
+        return tier.cache[1]
+
+
+class RandomStrategy(SelectionStrategy):
+    """Chooses uniformly at random, using each service once between refreshes"""
+    consumes = True
+
+    def select(self, tier, random, latency, affinity=None):
+        return random.randint(0, len(tier.services) - 1)
+
+
+class LatencyStrategy(SelectionStrategy):
+    """Chooses the service with the lower latency of two chosen at random, which favours faster services without
+    sending everyone to the fastest. Services whose latency isn't known are taken to be as fast as the other."""
+
+    def __init__(self, consumes=False):
+        self.consumes = consumes
+
+    def select(self, tier, random, latency, affinity=None):
+        index = random.randint(0, len(tier.services) - 1)
+        if len(tier.services) > 1:
+            other = random.randint(0, len(tier.services) - 2)
+            other += other >= index
+            index_latency, other_latency = latency(tier.services[index]), latency(tier.services[other])
+            if index_latency is not None and other_latency is not None and other_latency < index_latency:
+                index = other
+        return index
+
+
+class WeightedStrategy(SelectionStrategy):
+    """Chooses at random in proportion to the weight given in each service's TXT record, which is 1 if it isn't
+    given or isn't a non-negative number"""
+
+    def __init__(self, key=WEIGHT_KEY):
+        self.key = key
+
+    def _weight(self, service):
+        try:
+            weight = float(dict(service.txt).get(self.key, 1))
+        except ValueError:
+            return 1
+        return weight if weight >= 0 else 1
+
+    def _cumulative(self, services):
+        cumulative = []
+        total = 0
+        for service in services:
+            total += self._weight(service)
+            cumulative.append(total)
+        return cumulative
+
+    def select(self, tier, random, latency, affinity=None):
+        cumulative = self._cached(tier, self._cumulative)
+        if not cumulative[-1]:
+            return random.randint(0, len(tier.services) - 1)
+        return min(bisect_right(cumulative, random.random() * cumulative[-1]), len(cumulative) - 1)
+
+
+class HashStrategy(SelectionStrategy):
+    """Chooses by consistent hashing of the affinity key given to getHref, so that callers using the same key keep
+    getting the same service, and only the keys of a service which goes away move elsewhere. Calls without a key are
+    spread at random."""
+
+    def __init__(self, replicas=HASH_REPLICAS):
+        self.replicas = replicas
+
+    def _ring(self, services):
+        ring = sorted((_hash("{}:{}#{}".format(service.address, service.port, replica)), index)
+                      for index, service in enumerate(services) for replica in range(self.replicas))
+        return [point for point, _ in ring], [index for _, index in ring]
+
+    def select(self, tier, random, latency, affinity=None):
+        if affinity is None:
+            return random.randint(0, len(tier.services) - 1)
+        points, indexes = self._cached(tier, self._ring)
+        return indexes[bisect_right(points, _hash(affinity)) % len(points)]
+
+
+def _hash(value):
+    # Stable across processes, unlike hash()
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
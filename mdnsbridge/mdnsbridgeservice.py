@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
+import errno
 import gevent
+import os
 import signal
+import socket
 
 # Handle if systemd is installed instead of newer cysystemd
 try:
@@ -11,6 +14,8 @@ except ImportError:
     from systemd import daemon
     SYSTEMD_READY = "READY=1"
 
+from gevent.pywsgi import WSGIServer
+from nmoscommon import nmoscommonconfig
 from nmoscommon.httpserver import HttpServer
 try:
     from nmosnode.facade import Facade
@@ -24,6 +29,9 @@ monkey.patch_all()
 
 HOST = "127.0.0.1"
 PORT = 12352
+# The API is also served on this Unix domain socket unless the "mdnsbridge_socket" config key overrides it, or is
+# set to an empty value to disable it
+SOCKET_PATH = "/run/mdnsbridge/mdnsbridge.sock"
 
 
 class mDNSBridgeService(object):
@@ -35,6 +43,8 @@ class mDNSBridgeService(object):
         else:
             self.facade = None
         self.domain = domain
+        self.unix_server = None
+        self.socket_path = None
 
     def start(self):
         if self.running:
@@ -53,6 +63,36 @@ class mDNSBridgeService(object):
 
         print("Running on port: {}".format(self.http_server.port))
 
+        socket_path = nmoscommonconfig.config.get('mdnsbridge_socket', SOCKET_PATH)
+        if socket_path:
+            self._start_unix_server(socket_path)
+
+    def _start_unix_server(self, socket_path):
+        # Share the API instance (and so the bridge) with the TCP server
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(socket_path):
+                # Replace a socket left behind by a previous run, but not one another bridge is still serving on
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(socket_path)
+                except socket.error:
+                    os.unlink(socket_path)
+                else:
+                    raise socket.error(errno.EADDRINUSE, "Another bridge is serving on this socket")
+                finally:
+                    probe.close()
+            listener.bind(socket_path)
+            os.chmod(socket_path, 0o666)
+            listener.listen(128)
+            self.unix_server = WSGIServer(listener, self.http_server.api.app)
+            self.unix_server.start()
+            self.socket_path = socket_path
+            print("Running on socket: {}".format(socket_path))
+        except (OSError, socket.error) as e:
+            listener.close()
+            print("Unable to serve on socket {}: {}".format(socket_path, e))
+
     def run(self):
         self.running = True
         self.start()
@@ -76,6 +116,15 @@ class mDNSBridgeService(object):
         self.running = False
 
     def _cleanup(self):
+        if self.unix_server is not None:
+            self.unix_server.stop()
+            self.unix_server = None
+        if self.socket_path is not None:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.socket_path = None
         self.http_server.stop()
         self.mdns_bridge.stop()
         print("Stopped main()")
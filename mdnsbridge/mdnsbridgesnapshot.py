@@ -0,0 +1,177 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared memory snapshots of the bridge's representations, so that processes on the same host can read them without
+# making a request to the bridge.
+#
+# Each service type is published to its own memory-mapped file, laid out as a fixed header followed by the encoded
+# representation. The header's sequence number acts as a seqlock: the writer makes it odd before changing the length
+# or payload and even again afterwards, so a reader which sees the same even number either side of copying them knows
+# that it has a consistent snapshot. When the payload outgrows the file, the writer creates a larger file, renames it
+# into place and flags the old one as superseded, which tells readers to re-open the path. Each writer also stamps its
+# files with a token of its own, since a bridge which is restarted after withdrawing its snapshots starts counting
+# from the beginning again, and readers mustn't mistake its sequence numbers for those they've already read.
+#
+# Python gives no control over memory barriers, so this relies on stores not being reordered with other stores and
+# loads not being reordered with other loads, as on x86.
+
+from __future__ import absolute_import
+
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"MDBS"
+HEADER = struct.Struct("<4sIQQ8s")  # magic, flags, sequence number, payload length, writer token
+FLAGS = struct.Struct("<I")
+FLAGS_OFFSET = 4
+SEQ = struct.Struct("<Q")
+SEQ_OFFSET = 8
+LENGTH = struct.Struct("<Q")
+LENGTH_OFFSET = 16
+TOKEN = struct.Struct("<8s")
+TOKEN_OFFSET = 24
+FLAG_SUPERSEDED = 1
+MIN_CAPACITY = 64 * 1024
+READ_ATTEMPTS = 100
+
+
+class SnapshotWriter(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = {}
+        self._seqs = {}
+        self._token = os.urandom(TOKEN.size)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, srv_type):
+        return os.path.join(self.directory, srv_type)
+
+    def publish(self, srv_type, payload):
+        snapshot = self._maps.get(srv_type)
+        if snapshot is None or len(snapshot) - HEADER.size < len(payload):
+            self._replace(srv_type, payload)
+            return
+        seq = self._seqs[srv_type]
+        SEQ.pack_into(snapshot, SEQ_OFFSET, seq + 1)
+        LENGTH.pack_into(snapshot, LENGTH_OFFSET, len(payload))
+        snapshot[HEADER.size:HEADER.size + len(payload)] = payload
+        SEQ.pack_into(snapshot, SEQ_OFFSET, seq + 2)
+        self._seqs[srv_type] = seq + 2
+
+    def _replace(self, srv_type, payload):
+        path = self._path(srv_type)
+        old = self._maps.pop(srv_type, None)
+        if old is None:
+            # Carry on from whatever a previous writer left behind, so that sequence numbers never go backwards
+            old = _open(path, write=True)
+            if old is not None:
+                self._seqs[srv_type] = SEQ.unpack_from(old, SEQ_OFFSET)[0] | 1
+        seq = (self._seqs.get(srv_type, 0) | 1) + 1
+
+        capacity = max(MIN_CAPACITY, len(payload) * 2)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, 0, seq, len(payload), self._token))
+            f.write(payload)
+            f.truncate(HEADER.size + capacity)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        self._maps[srv_type] = _open(path, write=True)
+        self._seqs[srv_type] = seq
+
+        if old is not None:
+            _supersede(old)
+
+    def close(self):
+        """Withdraws all the snapshots, so that readers fall back to asking the bridge."""
+        for srv_type, snapshot in self._maps.items():
+            try:
+                os.unlink(self._path(srv_type))
+            except OSError:
+                pass
+            _supersede(snapshot)
+        self._maps = {}
+
+
+class SnapshotReader(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = {}
+        self._cache = {}
+
+    def read(self, srv_type):
+        """Returns the decoded representation most recently published for the given type, or None if there isn't
+        one. The representation is only decoded when it has changed since the last read, so callers must treat the
+        returned value as read-only."""
+        for _ in range(READ_ATTEMPTS):
+            snapshot = self._maps.get(srv_type)
+            if snapshot is None:
+                snapshot = _open(os.path.join(self.directory, srv_type))
+                if snapshot is None:
+                    return None
+                if snapshot[:len(MAGIC)] != MAGIC:
+                    snapshot.close()
+                    return None
+                self._maps[srv_type] = snapshot
+                # Whatever was decoded from the previous file may have come from another writer
+                self._cache.pop(srv_type, None)
+            if FLAGS.unpack_from(snapshot, FLAGS_OFFSET)[0] & FLAG_SUPERSEDED:
+                snapshot.close()
+                del self._maps[srv_type]
+                self._cache.pop(srv_type, None)
+                continue
+            seq = SEQ.unpack_from(snapshot, SEQ_OFFSET)[0]
+            if seq & 1:
+                # A write is in progress
+                continue
+            token = TOKEN.unpack_from(snapshot, TOKEN_OFFSET)[0]
+            cached = self._cache.get(srv_type)
+            if cached is not None and cached[0] == (token, seq):
+                return cached[1]
+            length = LENGTH.unpack_from(snapshot, LENGTH_OFFSET)[0]
+            payload = snapshot[HEADER.size:HEADER.size + length]
+            if SEQ.unpack_from(snapshot, SEQ_OFFSET)[0] != seq:
+                continue
+            representation = json.loads(payload.decode('utf-8'))
+            self._cache[srv_type] = ((token, seq), representation)
+            return representation
+        return None
+
+    def close(self):
+        for snapshot in self._maps.values():
+            snapshot.close()
+        self._maps = {}
+        self._cache = {}
+
+
+def _open(path, write=False):
+    try:
+        fd = os.open(path, os.O_RDWR if write else os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        if os.fstat(fd).st_size < HEADER.size:
+            return None
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def _supersede(snapshot):
+    flags = FLAGS.unpack_from(snapshot, FLAGS_OFFSET)[0]
+    FLAGS.pack_into(snapshot, FLAGS_OFFSET, flags | FLAG_SUPERSEDED)
+    snapshot.close()
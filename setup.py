@@ -53,7 +53,7 @@ packages_required = [
 
 setup(
     name="mdnsbridge",
-    version="0.9.4",
+    version="0.10.0",
     description="An API providing a DNS-SD/HTTP bridge for AMWA NMOS service types",
     url='https://github.com/bbc/nmos-mdns-bridge',
     author='Peter Brightwell',
@@ -62,6 +62,12 @@ setup(
     packages=package_names,
     package_dir=packages,
     install_requires=packages_required,
+    extras_require={
+        # Needed by AsyncIppmDNSBridge
+        "async": ["aiohttp; python_version >= '3.5'"],
+        # Lets the bridge and its clients use the compact msgpack encoding of type resources
+        "msgpack": ["msgpack>=0.5.2"]
+    },
     scripts=[],
     data_files=[
         ('/usr/bin', ['bin/nmos-mdnsbridge'])
@@ -0,0 +1,58 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fakes for testing AsyncIppmDNSBridge, kept apart from the tests since Python 2 can't parse coroutines. Only import
+# this on Python 3.5 or later.
+
+import asyncio
+import mock
+
+
+class FakeResponse(object):
+    def __init__(self, response):
+        self.response = response
+
+    async def __aenter__(self):
+        response = self.response
+        if isinstance(response, asyncio.Future):
+            response = await response
+        if isinstance(response, Exception):
+            raise response
+        self.status, self.headers, self.content_type, self.content = response
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.content
+
+
+def fake_aiohttp(responses):
+    """Returns a stand-in for aiohttp, and the list of sessions made with it. Requests to each URL get the next of the
+    given (status, headers, content type, content) responses, or raise it if it's an exception. A response may also be
+    a future, which the request waits for first."""
+    sessions = []
+
+    class FakeSession(object):
+        def __init__(self, connector):
+            self.connector = connector
+            self.get = mock.Mock(side_effect=lambda url, **kwargs: FakeResponse(responses[url].pop(0)))
+            self.closed = False
+            sessions.append(self)
+
+        async def close(self):
+            self.closed = True
+
+    return mock.Mock(ClientSession=FakeSession), sessions
@@ -16,8 +16,20 @@ import unittest
 import mock
 import json
 import six
+import shutil
+import tempfile
+from collections import deque
+
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Queue
+import gevent.socket
 
 from mdnsbridge.mdnsbridge import VALID_TYPES, APINAMESPACE, APINAME, APIVERSION, mDNSBridgeAPI, mDNSBridge
+from mdnsbridge.mdnsbridge import WATCH_TIMEOUT, WATCH_TIMEOUT_MAX, MSGPACK_MIMETYPE, msgpack, _TimerWheel
+from mdnsbridge.mdnsbridge import PROXIED_WATCH_TIMEOUT_MAX
+from mdnsbridge.mdnsbridgesnapshot import SnapshotReader
+from mdnsbridge.mdnsbridgemetrics import Metrics
 
 
 class StubWebAPI(object):
@@ -49,6 +61,10 @@ class TestmDNSBridgeAPI(unittest.TestCase):
             return passedValue
         self.mdns.get_services = behaviour
 
+        def representation(passedValue):
+            return 0, json.dumps({"representation": passedValue}).encode('utf-8')
+        self.mdns.get_representation = representation
+
     def inspect_endpoint(self, path, expected, resourceName):
         # Get reponse from test client, compare to expected
         rv = self.client.get(path)
@@ -105,6 +121,163 @@ class TestmDNSBridgeAPI(unittest.TestCase):
             resourceName="Base"
         )
 
+    def test_type_resource_as_html_bypasses_cached_json(self):
+        with mock.patch.object(self.mdns, "get_representation") as get_representation:
+            self.client.get(self.APIBASE + "nmos-query/", headers={"Accept": "text/html"})
+            get_representation.assert_not_called()
+
+    def test_type_resource_returns_etag(self):
+        rv = self.client.get(self.APIBASE + "nmos-query/")
+        self.assertEqual(rv.status_code, 200)
+        self.assertIsNotNone(rv.headers.get("ETag"))
+
+    def test_type_resource_returns_304_for_matching_etag(self):
+        etag = self.client.get(self.APIBASE + "nmos-query/").headers["ETag"]
+        rv = self.client.get(self.APIBASE + "nmos-query/", headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers["ETag"], etag)
+        self.assertEqual(rv.data, b"")
+
+    def test_type_resource_returns_200_when_generation_has_changed(self):
+        etag = self.client.get(self.APIBASE + "nmos-query/").headers["ETag"]
+        self.mdns.get_representation = lambda passedValue: (1, b'{"representation": []}')
+        rv = self.client.get(self.APIBASE + "nmos-query/", headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers["ETag"], etag)
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {"representation": []})
+
+    def test_type_resource_watch_waits_for_change(self):
+        self.mdns.wait_for_change = mock.MagicMock()
+        rv = self.client.get(self.APIBASE + "nmos-query/?watch=true&since=3&timeout=5")
+        self.assertEqual(rv.status_code, 200)
+        self.mdns.wait_for_change.assert_called_once_with("nmos-query", 3, 5.0)
+
+    def test_type_resource_watch_caps_timeout(self):
+        self.mdns.wait_for_change = mock.MagicMock()
+        self.client.get(self.APIBASE + "nmos-query/?watch=true&since=3&timeout=100000")
+        self.mdns.wait_for_change.assert_called_once_with("nmos-query", 3, WATCH_TIMEOUT_MAX)
+
+    def test_type_resource_watch_caps_timeout_below_proxy_timeout(self):
+        self.mdns.wait_for_change = mock.MagicMock()
+        self.client.get(self.APIBASE + "nmos-query/?watch=true&since=3", headers={"X-Forwarded-For": "127.0.0.1"})
+        self.mdns.wait_for_change.assert_called_once_with("nmos-query", 3, PROXIED_WATCH_TIMEOUT_MAX)
+
+    def test_type_resource_watch_returns_304_on_timeout(self):
+        self.mdns.wait_for_change = mock.MagicMock(return_value=False)
+        etag = self.client.get(self.APIBASE + "nmos-query/").headers["ETag"]
+        rv = self.client.get(self.APIBASE + "nmos-query/?watch=true&since=0", headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.mdns.wait_for_change.assert_called_once_with("nmos-query", 0, WATCH_TIMEOUT)
+
+    def test_type_resource_watch_requires_valid_since(self):
+        for query in ["?watch=true", "?watch=true&since=potato", "?watch=true&since=1&timeout=potato"]:
+            rv = self.client.get(self.APIBASE + "nmos-query/" + query)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_type_resource_watch_rejects_timeouts_which_are_not_finite_and_non_negative(self):
+        self.mdns.wait_for_change = mock.MagicMock()
+        for timeout in ["nan", "inf", "-inf", "-1"]:
+            for headers in [{}, {"X-Forwarded-For": "127.0.0.1"}]:
+                rv = self.client.get(self.APIBASE + "nmos-query/?watch=true&since=3&timeout=" + timeout, headers=headers)
+                self.assertEqual(rv.status_code, 400)
+        self.mdns.wait_for_change.assert_not_called()
+
+    def test_metrics_resource_counts_and_times_requests(self):
+        self.mdns.metrics = Metrics()
+        self.mdns.metrics.counter("mdnsbridge_mdns_announcements", "Announcements").inc()
+        self.client.get(self.APIBASE + "nmos-query/")
+        self.client.get(self.APIBASE + "nmos-query/")
+        self.client.get(self.APIBASE + "potato/")
+        rv = self.client.get("/metrics")
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertIn("mdnsbridge_mdns_announcements_total 1", lines)
+        route = self.APIBASE + "<path>/"
+        self.assertIn('mdnsbridge_http_requests_total{{route="{}",type="nmos-query",status="200"}} 2'.format(route),
+                      lines)
+        self.assertIn('mdnsbridge_http_requests_total{{route="{}",type="",status="404"}} 1'.format(route), lines)
+        self.assertIn('mdnsbridge_http_request_duration_seconds_count{{route="{}",type="nmos-query"}} 2'.format(
+            route), lines)
+
+    def test_batch_resource_returns_requested_types(self):
+        rv = self.client.get(self.APIBASE + "batch/?types=nmos-registration,nmos-query,nmos-registration")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {
+            "nmos-registration": {"representation": "nmos-registration"},
+            "nmos-query": {"representation": "nmos-query"}
+        })
+        self.assertIsNotNone(rv.headers.get("ETag"))
+
+    def test_batch_resource_defaults_to_all_types(self):
+        rv = self.client.get(self.APIBASE + "batch/")
+        self.assertEqual(json.loads(rv.data.decode('utf-8')),
+                         dict((type, {"representation": type}) for type in VALID_TYPES))
+
+    def test_batch_resource_returns_304_until_any_generation_changes(self):
+        path = self.APIBASE + "batch/?types=nmos-registration,nmos-query"
+        etag = self.client.get(path).headers["ETag"]
+        self.assertEqual(self.client.get(path, headers={"If-None-Match": etag}).status_code, 304)
+        representation = self.mdns.get_representation
+        self.mdns.get_representation = lambda type: (1, b'[]') if type == "nmos-query" else representation(type)
+        self.assertEqual(self.client.get(path, headers={"If-None-Match": etag}).status_code, 200)
+
+    def test_batch_resource_rejects_invalid_types(self):
+        rv = self.client.get(self.APIBASE + "batch/?types=nmos-query,nmos-potato")
+        self.assertEqual(rv.status_code, 400)
+
+    def test_type_resource_passes_filters_to_bridge(self):
+        self.mdns.get_representation = mock.MagicMock(return_value=(0, b'{"representation": []}'))
+        rv = self.client.get(self.APIBASE + "nmos-query/?api_ver=v1.2&api_proto=https&api_auth=true&priority=10")
+        self.assertEqual(rv.status_code, 200)
+        self.mdns.get_representation.assert_called_once_with("nmos-query", api_ver="v1.2", api_proto="https",
+                                                             api_auth=True, priority=10)
+        self.mdns.get_representation.reset_mock()
+        self.client.get(self.APIBASE + "batch/?types=nmos-query&api_proto=http")
+        self.mdns.get_representation.assert_called_once_with("nmos-query", api_proto="http")
+
+    def test_type_resource_rejects_invalid_filters(self):
+        for query in ["?api_auth=potato", "?priority=potato", "?api_proto=potato", "?api_ver=potato", "?api_ver=v1.2x"]:
+            self.assertEqual(self.client.get(self.APIBASE + "nmos-query/" + query).status_code, 400)
+            self.assertEqual(self.client.get(self.APIBASE + "batch/" + query).status_code, 400)
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_type_resource_negotiates_msgpack(self):
+        self.mdns.get_representation = mock.MagicMock(return_value=(3, b"\x80"))
+        accept = {"Accept": MSGPACK_MIMETYPE + ", application/json;q=0.5"}
+        rv = self.client.get(self.APIBASE + "nmos-query/?api_proto=http", headers=accept)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, MSGPACK_MIMETYPE)
+        self.assertEqual(rv.data, b"\x80")
+        self.assertEqual(rv.headers["Vary"], "Accept")
+        self.mdns.get_representation.assert_called_once_with("nmos-query", api_proto="http", encoding="msgpack")
+
+        # JSON and msgpack encodings of the same generation have different ETags
+        json_etag = self.client.get(self.APIBASE + "nmos-query/").headers["ETag"]
+        self.assertNotEqual(rv.headers["ETag"], json_etag)
+        self.assertEqual(self.client.get(self.APIBASE + "nmos-query/", headers=dict(accept, **{
+            "If-None-Match": rv.headers["ETag"]})).status_code, 304)
+        self.assertEqual(self.client.get(self.APIBASE + "nmos-query/", headers={
+            "If-None-Match": rv.headers["ETag"]}).status_code, 200)
+
+    def test_type_resource_falls_back_to_json_without_msgpack(self):
+        with mock.patch("mdnsbridge.mdnsbridge.msgpack", None):
+            rv = self.client.get(self.APIBASE + "nmos-query/", headers={"Accept": MSGPACK_MIMETYPE + ", application/json;q=0.5"})
+        self.assertEqual(rv.mimetype, "application/json")
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {"representation": "nmos-query"})
+
+    def test_events_resource_streams_backlog_then_queue(self):
+        subscriber = mock.MagicMock(dropped=True)
+        subscriber.queue = Queue()
+        subscriber.queue.put("id: x-2\nevent: add\ndata: {}\n\n")
+        self.mdns.subscribe = mock.MagicMock(return_value=(["id: x-1\nevent: add\ndata: {}\n\n"], subscriber))
+        rv = self.client.get(self.APIBASE + "events/", headers={"Last-Event-ID": "x-0"})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "text/event-stream")
+        self.assertEqual(rv.data.decode('utf-8'), "id: x-1\nevent: add\ndata: {}\n\nid: x-2\nevent: add\ndata: {}\n\n")
+        self.mdns.subscribe.assert_called_once_with("x-0")
+        self.mdns.unsubscribe.assert_called_once_with(subscriber)
+
     def test_invalid_types(self):
         myPath = self.APIBASE + "potato/"
         rv = self.client.get(myPath)
@@ -139,7 +312,11 @@ class TestmDNSBridge(unittest.TestCase):
                     'txt': {'api_ver': 'v1.0,v1.1,v1.2', 'api_proto': 'http', 'pri': str(priority),
                             'api_auth': 'false'},
                     'port': mock.sentinel.port,
-                    'authorization': False}
+                    'authorization': False,
+                    'ttl': None,
+                    'last_seen': mock.ANY,
+                    'healthy': None,
+                    'rtt': None}
         with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': prefer_ipv6}):
             self.callbacks[type]({"type": "_" + type + "._tcp",
                                   "action": action,
@@ -179,6 +356,24 @@ class TestmDNSBridge(unittest.TestCase):
             'nmos-query', "add", mock.sentinel.name, "bbc1:bbc2::bbc4", prefer_ipv6=True
         )
 
+    def test_metrics_count_announcements_and_filtered_addresses(self):
+        self.assert_registered_callback_correctly_handles_data_from_mdns(
+            'nmos-query', "add", mock.sentinel.name, "192.168.0.1"
+        )
+        self.assert_registered_callback_correctly_handles_data_from_mdns(
+            'nmos-query', "add", mock.sentinel.name2, "bbc1:bbc2::bbc4", expect_no_add=True
+        )
+        self.assert_registered_callback_correctly_handles_data_from_mdns(
+            'nmos-query', "add", mock.sentinel.name3, "192.168.0.3", prefer_ipv6=True, expect_no_add=True
+        )
+        lines = self.UUT.metrics.render().splitlines()
+        self.assertIn('mdnsbridge_mdns_announcements_total{type="nmos-query",action="add"} 3', lines)
+        self.assertIn('mdnsbridge_mdns_filtered_total{type="nmos-query",family="ipv6"} 1', lines)
+        self.assertIn('mdnsbridge_mdns_filtered_total{type="nmos-query",family="ipv4"} 1', lines)
+        self.assertIn('mdnsbridge_services{type="nmos-query"} 1', lines)
+        self.assertIn('mdnsbridge_services{type="nmos-registration"} 0', lines)
+        self.assertIn('mdnsbridge_generation{type="nmos-query"} 1', lines)
+
     def test_nmos_query_callback_can_update_after_adding(self):
         """Should add the given resource to the local store and then replace it."""
         self.assert_registered_callback_correctly_handles_data_from_mdns(
@@ -239,3 +434,366 @@ class TestmDNSBridge(unittest.TestCase):
         self.UUT.mdns.stop.assert_not_called()
         self.UUT.stop()
         self.UUT.mdns.stop.assert_called_once_with()
+
+    def _announce(self, type, action, name, address, priority=100):
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+            self.callbacks[type]({"type": "_" + type + "._tcp",
+                                  "action": action,
+                                  "txt": {"pri": str(priority)},
+                                  "name": name,
+                                  "address": address,
+                                  "hostname": 'test.example.com',
+                                  "port": 80})
+
+    def test_get_services_preserves_announcement_order_across_updates(self):
+        """Updating an existing entry should not move it within the representation."""
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        self._announce('nmos-query', "add", "a", "192.168.0.1", priority=200)
+        services = self.UUT.get_services('nmos-query')
+        self.assertListEqual([(s["name"], s["priority"]) for s in services], [("a", 200), ("b", 100)])
+
+    def test_remove_drops_every_address_for_name(self):
+        """A removal should drop all the addresses held for that name and leave other names alone."""
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "a", "192.168.0.2")
+        self._announce('nmos-query', "add", "b", "192.168.0.3")
+        self._announce('nmos-query', "remove", "a", "192.168.0.1")
+        self.assertListEqual([s["name"] for s in self.UUT.get_services('nmos-query')], ["b"])
+
+    def test_remove_of_unknown_name_is_ignored(self):
+        """Removing a name that was never added should leave the store untouched."""
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "remove", "z", "192.168.0.9")
+        self.assertListEqual([s["name"] for s in self.UUT.get_services('nmos-query')], ["a"])
+
+    def test_get_representation_is_cached_until_services_change(self):
+        """The encoded representation should be reused between changes and rebuilt after them."""
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        generation, body = self.UUT.get_representation('nmos-query')
+        self.assertEqual(json.loads(body.decode('utf-8')),
+                         {"representation": self.UUT.get_services('nmos-query'), "generation": generation})
+        with mock.patch('json.dumps') as dumps:
+            self.assertEqual(self.UUT.get_representation('nmos-query'), (generation, body))
+            dumps.assert_not_called()
+
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        new_generation, new_body = self.UUT.get_representation('nmos-query')
+        self.assertGreater(new_generation, generation)
+        self.assertEqual([s["name"] for s in json.loads(new_body.decode('utf-8'))["representation"]], ["a", "b"])
+
+    def test_generation_only_changes_on_mutation(self):
+        """Repeated identical announcements and unknown removals should leave the generation alone."""
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        generation = self.UUT.generations['nmos-query']
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "remove", "z", "192.168.0.9")
+        self.assertEqual(self.UUT.generations['nmos-query'], generation)
+        self._announce('nmos-query', "add", "a", "192.168.0.1", priority=200)
+        self.assertEqual(self.UUT.generations['nmos-query'], generation + 1)
+        self._announce('nmos-query', "remove", "a", "192.168.0.1")
+        self.assertEqual(self.UUT.generations['nmos-query'], generation + 2)
+        self.assertEqual(self.UUT.generations['nmos-registration'], 0)
+
+    def test_get_representation_filters_and_selects_priority_tier(self):
+        def names(**filters):
+            body = json.loads(self.UUT.get_representation('nmos-query', **filters)[1].decode('utf-8'))
+            return [service["name"] for service in body["representation"]]
+
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+            for name, priority, txt in [("a", 20, {"api_ver": "v1.0,v1.1"}), ("b", 10, {"api_proto": "https"}),
+                                        ("c", 20, {"api_ver": "v1.2", "api_auth": "true"}), ("d", 100, {}),
+                                        ("e", 30, {})]:
+                txt["pri"] = str(priority)
+                self.callbacks['nmos-query']({"type": "_nmos-query._tcp", "action": "add", "txt": txt, "name": name,
+                                              "address": "192.168.0.1", "hostname": 'test.example.com', "port": 80})
+
+        self.assertEqual(names(), ["a", "b", "c", "d", "e"])
+        self.assertEqual(names(api_proto="http"), ["a", "c", "d", "e"])
+        self.assertEqual(names(api_ver="v1.1"), ["a"])
+        self.assertEqual(names(api_auth=True), ["c"])
+        self.assertEqual(names(priority=0), ["b"])
+        self.assertEqual(names(priority=0, api_proto="http"), ["a", "c"])
+        self.assertEqual(names(priority=100), ["d"])
+        self.assertEqual(names(priority=200), [])
+        self.assertEqual(names(priority=0, api_ver="v1.3"), [])
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_get_representation_as_msgpack_lists_fields_once(self):
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "b", "192.168.0.2", priority=10)
+        generation, body = self.UUT.get_representation('nmos-query', encoding="msgpack")
+        packed = msgpack.unpackb(body, raw=False)
+        self.assertEqual(packed["generation"], generation)
+        self.assertEqual([dict(zip(packed["fields"], values)) for values in packed["services"]],
+                         json.loads(self.UUT.get_representation('nmos-query')[1].decode('utf-8'))["representation"])
+        self.assertIs(self.UUT.get_representation('nmos-query', encoding="msgpack")[1], body)
+
+    def test_filtered_representations_are_cached_until_services_change(self):
+        self._announce('nmos-query', "add", "a", "192.168.0.1", priority=0)
+        first = self.UUT.get_representation('nmos-query', api_proto="http", priority=0)
+        self.assertIs(self.UUT.get_representation('nmos-query', api_proto="http", priority=0)[1], first[1])
+        self.assertIsNot(self.UUT.get_representation('nmos-query', api_ver="v1.0", priority=0)[1], first[1])
+        self._announce('nmos-query', "add", "b", "192.168.0.2", priority=0)
+        second = self.UUT.get_representation('nmos-query', api_proto="http", priority=0)
+        self.assertEqual(second[0], first[0] + 1)
+        self.assertEqual([service["name"] for service in json.loads(second[1].decode('utf-8'))["representation"]],
+                         ["a", "b"])
+
+    def test_representations_are_cached_per_selection(self):
+        self._announce('nmos-query', "add", "a", "192.168.0.1", priority=0)
+        first = self.UUT.get_representation('nmos-query', priority=0)
+        # Priorities selecting the same tier share an encoding, and filters selecting no services share one too
+        self.assertIs(self.UUT.get_representation('nmos-query', priority=50)[1], first[1])
+        empty = self.UUT.get_representation('nmos-query', api_ver="v9.9")
+        for priority in range(100, 200):
+            self.assertIs(self.UUT.get_representation('nmos-query', api_ver="v1.{}".format(priority))[1], empty[1])
+            self.assertIs(self.UUT.get_representation('nmos-query', priority=priority)[1], empty[1])
+        self.assertEqual(len(self.UUT._representations['nmos-query']), 2)
+
+    def test_get_representation_fails_with_invalid_type(self):
+        self.assertIsNone(self.UUT.get_representation("nmos-potato"))
+
+    def test_wait_for_change_returns_immediately_if_already_changed(self):
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self.assertTrue(self.UUT.wait_for_change('nmos-query', 0, timeout=0))
+
+    def test_wait_for_change_times_out_without_change(self):
+        self.assertFalse(self.UUT.wait_for_change('nmos-query', 0, timeout=0.01))
+
+    def test_wait_for_change_wakes_on_mutation(self):
+        waiter = gevent.spawn(self.UUT.wait_for_change, 'nmos-query', 0, 5)
+        gevent.sleep(0)
+        self._announce('nmos-registration', "add", "b", "192.168.0.2")
+        gevent.sleep(0)
+        self.assertFalse(waiter.ready())
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self.assertTrue(waiter.get(timeout=1))
+
+    def _events(self, messages):
+        events = []
+        for message in messages:
+            fields = dict(line.split(": ", 1) for line in message.strip().split("\n"))
+            events.append((fields["event"], json.loads(fields["data"])))
+        return events
+
+    def test_subscribers_receive_add_update_and_remove_events(self):
+        backlog, subscriber = self.UUT.subscribe()
+        self.assertEqual(backlog, [])
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "a", "192.168.0.1", priority=200)
+        self._announce('nmos-query', "remove", "a", "192.168.0.1")
+        events = self._events(subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize()))
+        self.assertEqual([(action, data["type"], data["generation"], data["service"]["name"])
+                          for (action, data) in events],
+                         [("add", "nmos-query", 1, "a"), ("update", "nmos-query", 2, "a"),
+                          ("remove", "nmos-query", 3, "a")])
+        self.assertEqual(events[1][1]["service"]["priority"], 200)
+
+    def test_subscribe_replays_missed_events(self):
+        _, subscriber = self.UUT.subscribe()
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        last_event_id = subscriber.queue.get_nowait().split("\n")[0][len("id: "):]
+        self.UUT.unsubscribe(subscriber)
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        self._announce('nmos-registration', "add", "c", "192.168.0.3")
+        backlog, _ = self.UUT.subscribe(last_event_id)
+        self.assertEqual([(action, data["service"]["name"]) for (action, data) in self._events(backlog)],
+                         [("add", "b"), ("add", "c")])
+
+    def test_subscribe_resets_unknown_or_expired_event_ids(self):
+        for last_event_id in ["potato", "deadbeef-1", self.UUT._instance + "-5"]:
+            backlog, _ = self.UUT.subscribe(last_event_id)
+            self.assertEqual([action for (action, data) in self._events(backlog)], ["reset"])
+
+        with mock.patch.object(self.UUT, "_history", deque(maxlen=1)):
+            self._announce('nmos-query', "add", "a", "192.168.0.1")
+            self._announce('nmos-query', "add", "b", "192.168.0.2")
+            backlog, _ = self.UUT.subscribe(self.UUT._instance + "-0")
+            self.assertEqual([action for (action, data) in self._events(backlog)], ["reset"])
+            backlog, _ = self.UUT.subscribe(self.UUT._instance + "-1")
+            self.assertEqual([(action, data["service"]["name"]) for (action, data) in self._events(backlog)],
+                             [("add", "b")])
+
+    def test_slow_subscribers_are_dropped(self):
+        _, slow = self.UUT.subscribe()
+        with mock.patch.object(slow, "queue", Queue(1)):
+            _, fast = self.UUT.subscribe()
+            self._announce('nmos-query', "add", "a", "192.168.0.1")
+            self.assertFalse(slow.dropped)
+            self._announce('nmos-query', "add", "b", "192.168.0.2")
+            self.assertTrue(slow.dropped)
+            self.assertNotIn(slow, self.UUT._subscribers)
+            self.assertIn(fast, self.UUT._subscribers)
+            self.assertEqual(fast.queue.qsize(), 2)
+
+    @mock.patch('mdnsbridge.mdnsbridge.gevent.spawn_later')
+    @mock.patch('mdnsbridge.mdnsbridge.MDNSEngine')
+    def test_debounced_announcements_are_collapsed_and_applied_together(self, MDNSEngine, spawn_later):
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'mdnsbridge_debounce_window': 0.5}):
+            self.UUT = mDNSBridge()
+        callbacks = MDNSEngine.return_value.callback_on_services.mock_calls
+        self.callbacks = {regtype.split('.')[0][1:]: f for (regtype, f) in (call[1] for call in callbacks)}
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        self.UUT._flush()
+        _, subscriber = self.UUT.subscribe()
+        spawn_later.reset_mock()
+
+        # A rack reboots: "a" goes away and comes back, "b" is updated twice, and "c" appears and disappears
+        self._announce('nmos-query', "remove", "a", None)
+        self._announce('nmos-query', "add", "b", "192.168.0.2", priority=10)
+        self._announce('nmos-query', "add", "c", "192.168.0.3")
+        self._announce('nmos-query', "add", "a", "192.168.0.4")
+        self._announce('nmos-query', "add", "b", "192.168.0.2", priority=20)
+        self._announce('nmos-query', "remove", "c", None)
+        self._announce('nmos-registration', "add", "d", "192.168.0.5")
+        spawn_later.assert_called_once_with(0.5, self.UUT._flush)
+        self.assertEqual(self.UUT.generations['nmos-query'], 1)
+        self.assertEqual([s["name"] for s in self.UUT.get_services('nmos-query')], ["a", "b"])
+
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+            self.UUT._flush()
+        self.assertEqual(self.UUT.generations, {'nmos-query': 2, 'nmos-registration': 1, 'nmos-auth': 0,
+                                                'nmos-register': 0})
+        self.assertEqual([(s["name"], s["address"], s["priority"]) for s in self.UUT.get_services('nmos-query')],
+                         [("b", "192.168.0.2", 20), ("a", "192.168.0.4", 100)])
+        events = self._events(subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize()))
+        self.assertEqual([(action, data["generation"], data["service"]["name"]) for (action, data) in events],
+                         [("remove", 2, "a"), ("update", 2, "b"), ("add", 2, "a"), ("add", 1, "d")])
+
+        # Nothing is queued until the next announcement
+        self._announce('nmos-query', "remove", "b", None)
+        self.assertEqual(spawn_later.call_count, 2)
+        self.UUT.stop()
+        spawn_later.return_value.kill.assert_called_once_with()
+
+    @mock.patch('mdnsbridge.mdnsbridge.time.time')
+    @mock.patch('mdnsbridge.mdnsbridge.gevent.spawn')
+    @mock.patch('mdnsbridge.mdnsbridge.MDNSEngine')
+    def test_services_not_announced_again_expire(self, MDNSEngine, spawn, time):
+        time.return_value = 1000
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'mdnsbridge_service_ttl': 30}):
+            self.UUT = mDNSBridge()
+        spawn.assert_called_once_with(self.UUT._run_expiry)
+        callbacks = MDNSEngine.return_value.callback_on_services.mock_calls
+        self.callbacks = {regtype.split('.')[0][1:]: f for (regtype, f) in (call[1] for call in callbacks)}
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        _, subscriber = self.UUT.subscribe()
+
+        # Announcing a service again unchanged only refreshes it
+        time.return_value = 1020
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self.assertEqual(self.UUT.generations['nmos-query'], 2)
+        self.assertEqual([(s["name"], s["ttl"], s["last_seen"]) for s in self.UUT.get_services('nmos-query')],
+                         [("a", 30, 1020), ("b", 30, 1000)])
+
+        self.UUT._expire(1029)
+        self.assertEqual(self.UUT.generations['nmos-query'], 2)
+        self.UUT._expire(1031)
+        self.assertEqual(self.UUT.generations['nmos-query'], 3)
+        self.assertEqual([s["name"] for s in self.UUT.get_services('nmos-query')], ["a"])
+        self.assertNotIn("b", self.UUT._names['nmos-query'])
+        self.UUT._expire(1051)
+        self.assertEqual(self.UUT.get_services('nmos-query'), [])
+        events = self._events(subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize()))
+        self.assertEqual([(action, data["service"]["name"]) for (action, data) in events],
+                         [("expire", "b"), ("expire", "a")])
+
+        # A service which comes back is tracked again
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        self.UUT._expire(1100)
+        self.assertEqual(self.UUT.get_services('nmos-query'), [])
+        self.UUT.stop()
+        spawn.return_value.kill.assert_called_once_with()
+
+    @mock.patch('mdnsbridge.mdnsbridge.time.time')
+    def test_cached_representations_only_change_with_generation(self, time):
+        # Each generation must always be served with the same bytes, since its ETag is strong
+        time.return_value = 1000
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        generation, body = self.UUT.get_representation('nmos-query')
+        self.assertEqual(json.loads(body.decode('utf-8'))["representation"][0]["last_seen"], 1000)
+        time.return_value = 1050
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self.assertEqual(self.UUT.get_representation('nmos-query'), (generation, body))
+
+        self._announce('nmos-query', "add", "b", "192.168.0.2")
+        changed_generation, changed = self.UUT.get_representation('nmos-query')
+        self.assertNotEqual(changed_generation, generation)
+        self.assertEqual([service["last_seen"] for service in json.loads(changed.decode('utf-8'))["representation"]],
+                         [1050, 1050])
+
+    @mock.patch('mdnsbridge.mdnsbridge.gevent.spawn')
+    @mock.patch('mdnsbridge.mdnsbridge.MDNSEngine')
+    def test_prober_records_health_of_services(self, MDNSEngine, spawn):
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'mdnsbridge_probe_interval': 10}):
+            self.UUT = mDNSBridge()
+        spawn.assert_called_once_with(self.UUT._run_probes)
+        callbacks = MDNSEngine.return_value.callback_on_services.mock_calls
+        self.callbacks = {regtype.split('.')[0][1:]: f for (regtype, f) in (call[1] for call in callbacks)}
+
+        listener = gevent.socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        closed = gevent.socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        for name, port in [("live", listener.getsockname()[1]), ("dead", closed_port)]:
+            with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+                self.callbacks['nmos-query']({"type": "_nmos-query._tcp", "action": "add", "txt": {}, "name": name,
+                                              "address": "127.0.0.1", "hostname": name, "port": port})
+        _, subscriber = self.UUT.subscribe()
+
+        self.UUT._probe_all(Pool(2))
+        services = self.UUT.get_services('nmos-query')
+        self.assertEqual([(s["name"], s["healthy"]) for s in services], [("live", True), ("dead", False)])
+        self.assertGreaterEqual(services[0]["rtt"], 0)
+        self.assertIsNone(services[1]["rtt"])
+        self.assertEqual(self.UUT.generations['nmos-query'], 3)
+        events = self._events(subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize()))
+        six.assertCountEqual(self, [(action, data["generation"], data["service"]["healthy"])
+                                    for (action, data) in events], [("update", 3, True), ("update", 3, False)])
+
+        # Health only changes the generation when it changes, and survives services being announced again
+        self.UUT._probe_all(Pool(2))
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'prefer_ipv6': False}):
+            self.callbacks['nmos-query']({"type": "_nmos-query._tcp", "action": "add", "txt": {}, "name": "dead",
+                                          "address": "127.0.0.1", "hostname": "dead", "port": closed_port})
+        self.assertEqual(self.UUT.generations['nmos-query'], 3)
+        self.assertEqual([s["healthy"] for s in self.UUT.get_services('nmos-query')], [True, False])
+        self.UUT.stop()
+        spawn.return_value.kill.assert_called_once_with()
+
+    def test_timer_wheel_returns_items_as_their_slots_come_round(self):
+        wheel = _TimerWheel(8, 1, 100)
+        wheel.schedule("a", 102.5)
+        wheel.schedule("b", 50)
+        wheel.schedule("c", 120)
+        self.assertEqual(wheel.advance(101), ["b"])
+        self.assertEqual(wheel.advance(103), ["a"])
+        # Items beyond the end of the ring come round early, and everything is due after a whole revolution
+        self.assertEqual(wheel.advance(104), ["c"])
+        wheel.schedule("d", 105)
+        self.assertEqual(wheel.advance(1000), ["d"])
+
+    @mock.patch('mdnsbridge.mdnsbridge.MDNSEngine')
+    def test_representations_are_published_to_snapshot_dir(self, MDNSEngine):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch('nmoscommon.nmoscommonconfig.config', {'mdnsbridge_snapshot_dir': tmpdir}):
+            self.UUT = mDNSBridge()
+        callbacks = MDNSEngine.return_value.callback_on_services.mock_calls
+        self.callbacks = {regtype.split('.')[0][1:]: f for (regtype, f) in (call[1] for call in callbacks)}
+        reader = SnapshotReader(tmpdir)
+        self.addCleanup(reader.close)
+
+        self.assertEqual(reader.read('nmos-query'), {"representation": [], "generation": 0})
+        self._announce('nmos-query', "add", "a", "192.168.0.1")
+        self.assertEqual(json.dumps(reader.read('nmos-query')).encode('utf-8'),
+                         self.UUT.get_representation('nmos-query')[1])
+        self.UUT.stop()
+        self.assertIsNone(reader.read('nmos-query'))
@@ -14,29 +14,78 @@
 
 import unittest
 import mock
-from mdnsbridge.mdnsbridgeclient import IppmDNSBridge, NoService, EndOfServiceList
+from mdnsbridge.mdnsbridgeclient import IppmDNSBridge, NoService, EndOfServiceList, WATCH_TIMEOUT, _ServiceIndex
+from mdnsbridge.mdnsbridgeclient import PROXIED_WATCH_TIMEOUT, WATCH_MIN_INTERVAL
+from mdnsbridge.mdnsbridgeclient import NO_SERVICE_BACKOFF_MIN, NO_SERVICE_BACKOFF_MAX, NO_SERVICE_LOG_INTERVAL
+from mdnsbridge.mdnsbridgeclient import BREAKER_FAILURES, BREAKER_INTERVAL, HashStrategy, LatencyStrategy
+from mdnsbridge.mdnsbridgeclient import ClientMetrics, SpanInstrumentation
+from mdnsbridge.mdnsbridgesnapshot import SnapshotWriter
+from mdnsbridge.mdnsbridgerecord import ServiceRecord
 import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
 
 from nmoscommon.nmoscommonconfig import config as _config
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from _asyncfakes import fake_aiohttp
+
 DEFAULT_VERSIONS = ["v1.0", "v1.1", "v1.2"]
 
 
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RepresentationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"representation": self.server.representation}).encode('utf-8')
+        self.server.paths.append(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+
 class TestIppmDNSBridge(unittest.TestCase):
 
     @mock.patch('mdnsbridge.mdnsbridgeclient.Logger')
     def setUp(self, Logger):
+        # Whether msgpack is installed shouldn't change the requests made, except in tests of it
+        patcher = mock.patch('mdnsbridge.mdnsbridgeclient.msgpack', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         with mock.patch.dict(_config, {"test": "active"}):
             self.UUT = IppmDNSBridge(logger=mock.sentinel.logger)
         Logger.assert_called_once_with("mdnsbridge", mock.sentinel.logger)
         self.logger = Logger.return_value
         self.assertIn("test", self.UUT.config)
+        # Nor whether a bridge is running on this host
+        self.UUT.config['mdnsbridge_socket'] = None
 
     def test_init(self):
         pass
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_first_service_with_matching_priority(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -53,8 +102,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[0]["protocol"] + "://" + services[0]["address"] + ":" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_first_service_with_matching_priority_including_ipv6(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -71,8 +120,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[0]["protocol"] + "://[" + services[0]["address"] + "]:" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_only_service_with_matching_priority(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -89,8 +138,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_only_service_with_matching_version(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -108,8 +157,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type, None, "v1.1", None)
         self.assertEqual(href, services[0]["protocol"] + "://" + services[0]["address"] + ":" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_only_service_with_matching_protocol_https(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -126,8 +175,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type, None, None, "https")
         self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_only_service_with_matching_protocol_http(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -144,8 +193,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type, None, None, "http")
         self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_only_service_with_matching_priority_https(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -162,8 +211,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_lowest_priority_service_when_none_match(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 99
@@ -180,8 +229,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[1]["protocol"] + "://" + services[1]["address"] + ":" + str(services[1]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=3)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=3)  # guaranteed random, chosen by roll of fair die
     def test_gethref_when_multiple_services_have_same_priority_return_one_at_random(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 99
@@ -202,8 +251,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[5]["protocol"] + "://" + services[5]["address"] + ":" + str(services[5]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=4)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=4)  # guaranteed random, chosen by roll of fair die
     def test_gethref_when_multiple_high_priority_services_have_same_priority_return_one_at_random(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 102
@@ -224,8 +273,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[6]["protocol"] + "://" + services[6]["address"] + ":" + str(services[6]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_empty_string_when_no_matching_services(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -242,8 +291,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, "")
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_empty_string_when_no_matching_services_https(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -260,8 +309,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, "")
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_empty_string_when_request_fails(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -271,8 +320,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, "")
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_second_call_uses_cache(self, rand, get):
         srv_type = "potato"
         priority = 13
@@ -295,8 +344,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         get.assert_not_called()
         self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_second_call_uses_cache_at_high_priority(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -317,11 +366,12 @@ class TestIppmDNSBridge(unittest.TestCase):
         get.reset_mock()
         href = self.UUT.getHref(srv_type)
         get.assert_not_called()
-        self.assertEqual(href, services[1]["protocol"] + "://" + services[1]["address"] + ":" + str(services[1]["port"]))
+        # The last candidate is moved into the place of the one taken
+        self.assertEqual(href, services[2]["protocol"] + "://" + services[2]["address"] + ":" + str(services[2]["port"]))
 
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_second_call_rechecks_if_only_low_priority_servers_exist(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -343,20 +393,26 @@ class TestIppmDNSBridge(unittest.TestCase):
         getmocks = [mock.MagicMock(name="get1()"), mock.MagicMock(name="get2()")]
         get.side_effect = [getmocks[0], getmocks[1]]
         getmocks[0].status_code = 200
+        getmocks[0].headers = {}
         getmocks[0].json.return_value = {"representation": json.loads(json.dumps(services))}
         getmocks[1].status_code = 200
+        getmocks[1].headers = {}
         getmocks[1].json.return_value = {"representation": json.loads(json.dumps(second_services))}
         href = self.UUT.getHref(srv_type)
-        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", timeout=0.5, proxies={'http': ''})
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", params={'api_proto': 'http'}, timeout=0.5, proxies={'http': ''}, headers={})
         self.assertEqual(href, "")
 
         get.reset_mock()
-        href = self.UUT.getHref(srv_type)
-        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", timeout=0.5, proxies={'http': ''})
+        # The bridge isn't asked again until the lookup's backoff has expired
+        self.assertEqual(self.UUT.getHref(srv_type), "")
+        get.assert_not_called()
+        with mock.patch('time.time', return_value=time.time() + NO_SERVICE_BACKOFF_MIN):
+            href = self.UUT.getHref(srv_type)
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", params={'api_proto': 'http'}, timeout=0.5, proxies={'http': ''}, headers={})
         self.assertEqual(href, second_services[3]["protocol"] + "://" + second_services[3]["address"] + ":" + str(second_services[3]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_handles_missing_hostname(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -371,8 +427,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[0]["protocol"] + "://" + services[0]["address"] + ":" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_handles_prefer_hostnames(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 100
@@ -388,7 +444,7 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHref(srv_type)
         self.assertEqual(href, services[0]["protocol"] + "://" + services[0]["hostname"] + ":" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_gethrefwithexception_does_raises_noservice_exception(self, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -405,8 +461,8 @@ class TestIppmDNSBridge(unittest.TestCase):
         with self.assertRaises(NoService):
             self.UUT.getHrefWithException(srv_type)
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethrefwithexception_does_raises_endofservicelist_exception(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -424,13 +480,73 @@ class TestIppmDNSBridge(unittest.TestCase):
         with self.assertRaises(EndOfServiceList):
             self.UUT.getHrefWithException(srv_type)
 
-        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", timeout=0.5, proxies={'http': ''})
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", params={'api_proto': 'http'}, timeout=0.5, proxies={'http': ''}, headers={})
 
         href = self.UUT.getHrefWithException(srv_type)
         self.assertEqual(href, services[0]["protocol"] + "://" + services[0]["address"] + ":" + str(services[0]["port"]))
 
-    @mock.patch('requests.get')
-    @mock.patch('random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)
+    def test_client_metrics_count_lookups_and_time_refreshes(self, rand, get):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False})
+        self.UUT.instrumentation = ClientMetrics()
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {"representation": [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": None,
+             "versions": DEFAULT_VERSIONS}
+        ]}
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        get.return_value.json.return_value = {"representation": []}
+        self.assertEqual(self.UUT.getHref("potato"), "")
+        self.assertEqual(self.UUT.getHref("potato"), "")
+
+        metrics = self.UUT.instrumentation
+        self.assertEqual(metrics.hits.value("potato"), 1)
+        self.assertEqual(metrics.endOfServiceLists.value("potato"), 1)
+        # The second NoService comes from the backoff, without refreshing again
+        self.assertEqual(metrics.noServices.value("potato"), 2)
+        self.assertEqual(metrics.refreshes.value("potato"), 2)
+        self.assertEqual(metrics.refreshDuration.count("potato"), 2)
+        self.assertIn('mdnsbridge_client_hits_total{type="potato"} 1', metrics.render().splitlines())
+
+    @unittest.skipUnless(hasattr(sys, "setswitchinterval"), "needs Python 3 to control thread switching")
+    def test_client_metrics_count_every_hit_from_many_threads(self):
+        metrics = ClientMetrics()
+
+        def hits():
+            for _ in range(20000):
+                metrics.hit("potato")
+
+        threads = [threading.Thread(target=hits) for _ in range(8)]
+        interval = sys.getswitchinterval()
+        # Switch threads as often as possible, to give lost updates every chance to happen
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(metrics.hits.value("potato"), 8 * 20000)
+
+    @mock.patch('requests.Session.get')
+    def test_span_instrumentation_wraps_refreshes_in_spans(self, get):
+        tracer = mock.MagicMock()
+        current_span = mock.MagicMock()
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled"})
+        self.UUT.instrumentation = SpanInstrumentation(tracer, current_span)
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {"representation": []}
+        self.assertRaises(NoService, self.UUT.getHrefWithException, "potato")
+        tracer.start_as_current_span.assert_called_once_with("mdnsbridge.refresh",
+                                                             attributes={"mdnsbridge.type": "potato"})
+        self.assertEqual(tracer.start_as_current_span.return_value.__enter__.call_count, 1)
+        current_span.return_value.add_event.assert_called_once_with("mdnsbridge.no_service",
+                                                                    {"mdnsbridge.type": "potato"})
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
     def test_gethref_returns_service_with_correct_authorization(self, rand, get):
         srv_type = "potato"
         self.UUT.config['priority'] = 0
@@ -451,3 +567,768 @@ class TestIppmDNSBridge(unittest.TestCase):
         href = self.UUT.getHrefWithException(srv_type, api_auth=True)
         self.assertEqual(href, services[3]["protocol"] + "://" + services[3]["address"] + ":" + str(services[3]["port"]))
 
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('random.Random.randint', return_value=0)  # guaranteed random, chosen by roll of fair die
+    def test_updateservices_revalidates_with_etag_and_restores_cache_on_304(self, rand, get):
+        srv_type = "potato"
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+
+        services = [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": "service_host0", "versions": DEFAULT_VERSIONS},
+        ]
+
+        getmocks = [mock.MagicMock(name="get1()"), mock.MagicMock(name="get2()")]
+        get.side_effect = getmocks
+        getmocks[0].status_code = 200
+        getmocks[0].headers = {"ETag": '"abc-1"'}
+        getmocks[0].json.return_value = {"representation": json.loads(json.dumps(services))}
+        getmocks[1].status_code = 304
+        getmocks[1].headers = {"ETag": '"abc-1"'}
+
+        href = self.UUT.getHref(srv_type)
+        self.assertEqual(href, "http://service_address0:12345")
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", params={'api_proto': 'http'}, timeout=0.5, proxies={'http': ''}, headers={})
+
+        get.reset_mock()
+        href = self.UUT.getHref(srv_type)
+        self.assertEqual(href, "http://service_address0:12345")
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/", params={'api_proto': 'http'}, timeout=0.5, proxies={'http': ''},
+                                    headers={"If-None-Match": '"abc-1"'})
+        getmocks[1].json.assert_not_called()
+
+    @mock.patch('requests.Session.get')
+    def test_watchonce_replaces_cache_with_changed_representation(self, get):
+        srv_type = "potato"
+        self.UUT.config['https_mode'] = "disabled"
+        services = [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": "service_host0", "versions": DEFAULT_VERSIONS},
+        ]
+        get.return_value.status_code = 200
+        get.return_value.headers = {"ETag": '"abc-4"'}
+        get.return_value.json.return_value = {"representation": json.loads(json.dumps(services)), "generation": 4}
+
+        self.assertTrue(self.UUT._watchOnce(srv_type, self.UUT._session))
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/",
+                                    params={"api_proto": "http", "watch": "true", "since": -1, "timeout": PROXIED_WATCH_TIMEOUT},
+                                    timeout=PROXIED_WATCH_TIMEOUT + 5, proxies={'http': ''}, headers={})
+        self.assertEqual(list(self.UUT.services[srv_type]), [ServiceRecord.from_json(service) for service in services])
+
+        get.reset_mock()
+        get.return_value.status_code = 304
+        self.UUT.services[srv_type] = []
+        self.assertTrue(self.UUT._watchOnce(srv_type, self.UUT._session))
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/" + srv_type + "/",
+                                    params={"api_proto": "http", "watch": "true", "since": 4, "timeout": PROXIED_WATCH_TIMEOUT},
+                                    timeout=PROXIED_WATCH_TIMEOUT + 5, proxies={'http': ''},
+                                    headers={"If-None-Match": '"abc-4"'})
+        self.assertEqual(list(self.UUT.services[srv_type]), [])
+
+    @mock.patch('requests.Session.get')
+    def test_watchonce_reports_failure(self, get):
+        get.side_effect = Exception
+        self.assertFalse(self.UUT._watchOnce("potato", self.UUT._session))
+        get.side_effect = None
+        get.return_value.status_code = 500
+        self.assertFalse(self.UUT._watchOnce("potato", self.UUT._session))
+
+    @mock.patch('requests.Session.get')
+    def test_watchonce_asks_for_longer_watches_when_not_proxied(self, get):
+        self.UUT.config['mdnsbridge_direct'] = True
+        get.return_value.status_code = 304
+        self.assertTrue(self.UUT._watchOnce("potato", self.UUT._session))
+        self.assertEqual(get.call_args[1]["params"]["timeout"], WATCH_TIMEOUT)
+        self.assertEqual(get.call_args[1]["timeout"], WATCH_TIMEOUT + 5)
+
+    @mock.patch('mdnsbridge.mdnsbridgeclient.time.time', return_value=1000)
+    def test_watch_waits_minimum_interval_between_watches(self, time):
+        # A bridge without watch support answers every watch straight away
+        stop = mock.MagicMock()
+        stop.is_set.side_effect = [False, False, True]
+        with mock.patch.object(self.UUT, "_watchOnce", return_value=True):
+            self.UUT._watch("potato", stop)
+        self.assertEqual(stop.wait.mock_calls, [mock.call(WATCH_MIN_INTERVAL)] * 2)
+
+    def test_start_and_stop_watching(self):
+        called = threading.Event()
+
+        def watch_once(srv_type, session):
+            called.set()
+            return True
+
+        with mock.patch.object(self.UUT, "_watchOnce", side_effect=watch_once):
+            self.UUT.startWatching("potato")
+            self.UUT.startWatching("potato")
+            self.assertEqual(list(self.UUT._watchers.keys()), ["potato"])
+            self.assertTrue(called.wait(1))
+            stop = self.UUT._watchers["potato"]
+            self.UUT.stopWatching()
+            self.assertTrue(stop.is_set())
+            self.assertEqual(self.UUT._watchers, {})
+
+    @mock.patch('requests.Session.get')
+    def test_gethref_returns_each_service_once_before_refreshing(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        services = [
+            {"priority": 0, "protocol": "http", "address": "service_address{}".format(i), "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+            for i in range(10)
+        ]
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": services}
+        with mock.patch('random.seed') as seed:
+            hrefs = [self.UUT.getHref("potato") for _ in range(len(services) * 2)]
+            seed.assert_not_called()
+        expected = ["http://service_address{}:12345".format(i) for i in range(10)]
+        self.assertEqual(sorted(hrefs[:10]), expected)
+        self.assertEqual(sorted(hrefs[10:]), expected)
+        self.assertEqual(get.call_count, 2)
+
+    def test_gethref_from_many_threads_shares_refreshes(self):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        services = [
+            {"priority": 0, "protocol": "http", "address": "service_address{}".format(i), "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+            for i in range(5)
+        ]
+        expected = set("http://service_address{}:12345".format(i) for i in range(5))
+        lock = threading.Lock()
+        state = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+        def get(*args, **kwargs):
+            with lock:
+                state["requests"] += 1
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.001)
+            with lock:
+                state["in_flight"] -= 1
+            return mock.Mock(status_code=200, headers={}, json=mock.Mock(return_value={"representation": services}))
+
+        threads = 20
+        calls = 50
+        hrefs = []
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(calls):
+                    hrefs.append(self.UUT.getHref("potato"))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch('requests.Session.get', side_effect=get):
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join(10)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(hrefs), threads * calls)
+        self.assertEqual(set(hrefs), expected)
+        self.assertEqual(state["max_in_flight"], 1)
+        # Callers waiting on a refresh share its result rather than each making their own, so nearly every refresh
+        # hands out all the services before the next is made
+        self.assertGreaterEqual(state["requests"], threads * calls // len(services))
+        self.assertLessEqual(state["requests"], 2 * threads * calls // len(services))
+
+    @mock.patch('requests.Session.get')
+    def test_gethref_with_refresh_interval_reuses_cached_representation(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_refresh_interval'] = 60
+        services = [
+            {"priority": 0, "protocol": "http", "address": "service_address{}".format(i), "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+            for i in range(2)
+        ]
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": services}
+        with mock.patch.object(self.UUT, "_startRefreshing") as startRefreshing:
+            hrefs = [self.UUT.getHref("potato") for _ in range(6)]
+            startRefreshing.assert_called_with("potato")
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(sorted(hrefs), sorted(["http://service_address0:12345", "http://service_address1:12345"] * 3))
+
+    @mock.patch('requests.Session.get')
+    def test_gethref_with_refresh_interval_requests_when_cache_is_empty(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_refresh_interval'] = 60
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": []}
+        with mock.patch.object(self.UUT, "_startRefreshing"):
+            self.assertEqual(self.UUT.getHref("potato"), "")
+            with mock.patch('time.time', return_value=time.time() + NO_SERVICE_BACKOFF_MIN):
+                self.assertEqual(self.UUT.getHref("potato"), "")
+        self.assertEqual(get.call_count, 2)
+
+    @mock.patch('requests.Session.get')
+    def test_background_refresher_updates_cache(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_refresh_interval'] = 0.01
+        self.UUT.config['mdnsbridge_refresh_jitter'] = 0
+        refreshed = threading.Event()
+
+        def refresh(*args, **kwargs):
+            if get.call_count >= 3:
+                refreshed.set()
+            return mock.DEFAULT
+        get.side_effect = refresh
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+        ]}
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        try:
+            self.assertTrue(refreshed.wait(5))
+            self.assertIn("potato", self.UUT._refreshers)
+        finally:
+            self.UUT.stopRefreshing()
+        self.assertEqual(self.UUT._refreshers, {})
+
+    @mock.patch('requests.Session.get')
+    def test_gethref_backs_off_exponentially_when_no_service(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": []}
+        now = time.time()
+        backoffs = []
+        with mock.patch('time.time') as clock:
+            for _ in range(10):
+                clock.return_value = now
+                self.assertEqual(self.UUT.getHref("potato", api_ver="v1.2"), "")
+                retry_at, backoff = self.UUT._noService[("potato", 0, "v1.2", None, None)]
+                self.assertGreaterEqual(retry_at, now + backoff / 2.0)
+                self.assertLessEqual(retry_at, now + backoff)
+                backoffs.append(backoff)
+                # Nothing is requested until the backoff expires
+                clock.return_value = retry_at - 0.001
+                self.assertEqual(self.UUT.getHref("potato", api_ver="v1.2"), "")
+                now = retry_at
+        self.assertEqual(get.call_count, 10)
+        self.assertEqual(backoffs[:3], [NO_SERVICE_BACKOFF_MIN, NO_SERVICE_BACKOFF_MIN * 2, NO_SERVICE_BACKOFF_MIN * 4])
+        self.assertEqual(backoffs[-1], NO_SERVICE_BACKOFF_MAX)
+
+    @mock.patch('requests.Session.get')
+    def test_gethref_rate_limits_no_service_warnings(self, get):
+        get.side_effect = Exception
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            for _ in range(5):
+                self.assertEqual(self.UUT.getHref("potato", priority=0), "")
+        self.assertEqual(self.logger.writeWarning.call_count, 2)
+        self.assertEqual(get.call_count, 1)
+        with mock.patch('time.time', return_value=now + NO_SERVICE_LOG_INTERVAL):
+            self.assertEqual(self.UUT.getHref("potato", priority=0), "")
+        self.assertIn("(4 similar warnings suppressed)", self.logger.writeWarning.call_args[0][0])
+
+    @mock.patch('requests.Session.get', side_effect=Exception)
+    def test_new_representation_clears_negative_cache_for_matching_lookups(self, get):
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT._setRepresentation("potato", {"representation": []})
+        self.assertRaises(NoService, self.UUT.getHrefWithException, "potato", 0, "v1.2")
+        self.assertRaises(NoService, self.UUT.getHrefWithException, "potato", 0, "v1.0")
+        self.assertEqual(len(self.UUT._noService), 2)
+        # As the background watcher would on being told about a new service
+        self.UUT._setRepresentation("potato", {"representation": [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": None, "versions": ["v1.2"]}
+        ]})
+        self.assertEqual(list(self.UUT._noService), [("potato", 0, "v1.0", None, None)])
+        self.assertEqual(self.UUT.getHrefWithException("potato", 0, "v1.2"), "http://service_address0:12345")
+
+    @mock.patch('requests.Session.get')
+    def test_prefetch_fills_cache_with_one_request(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT._etags["nmos-query"] = '"abc-1"'
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {
+            "nmos-registration": {"representation": [
+                {"priority": 0, "protocol": "http", "address": "registration", "port": 80, "hostname": None, "versions": DEFAULT_VERSIONS}
+            ], "generation": 3},
+            "nmos-query": {"representation": [
+                {"priority": 0, "protocol": "http", "address": "query", "port": 80, "hostname": None, "versions": DEFAULT_VERSIONS}
+            ], "generation": 5}
+        }
+        self.UUT.prefetch(["nmos-registration", "nmos-query"])
+        get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/batch/",
+                                    params={"types": "nmos-registration,nmos-query", "api_proto": "http"}, timeout=0.5, proxies={'http': ''},
+                                    headers={})
+        self.assertEqual(self.UUT.getHref("nmos-registration"), "http://registration:80")
+        self.assertEqual(self.UUT.getHref("nmos-query"), "http://query:80")
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.UUT._generations, {"nmos-registration": 3, "nmos-query": 5})
+        self.assertEqual(self.UUT._etags, {})
+
+    @mock.patch('requests.Session.get')
+    def test_prefetch_falls_back_to_a_request_per_type(self, get):
+        self.UUT.config['https_mode'] = "disabled"
+        batch = mock.MagicMock(status_code=404)
+        single = mock.MagicMock(status_code=200, headers={})
+        single.json.return_value = {"representation": []}
+        get.side_effect = [batch, single, single]
+        self.UUT.prefetch(["nmos-registration", "potato"])
+        self.assertEqual(get.call_args_list[1:], [
+            mock.call("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/nmos-registration/", params={'api_proto': 'http'},
+                      timeout=0.5, proxies={'http': ''}, headers={}),
+            mock.call("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/potato/", params={'api_proto': 'http'},
+                      timeout=0.5, proxies={'http': ''}, headers={})
+        ])
+        self.assertIn("potato", self.UUT.services)
+
+    @mock.patch('requests.Session.get')
+    def test_prefetch_replaces_session_after_error(self, get):
+        get.side_effect = Exception
+        session = self.UUT._session
+        with mock.patch.object(session, "close") as close:
+            self.UUT.prefetch(["nmos-registration"])
+            close.assert_called_once_with()
+        self.assertIsNot(self.UUT._session, session)
+        # The fallback request was made with the replacement session
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(self.UUT._refreshing, {})
+
+    @mock.patch('requests.Session.get')
+    def test_prefetch_is_shared_with_concurrent_lookups(self, get):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled"})
+        self.UUT.instrumentation = ClientMetrics()
+        started = threading.Event()
+        release = threading.Event()
+
+        def batch(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            response = mock.MagicMock(status_code=200)
+            response.json.return_value = {"nmos-registration": {"representation": [
+                {"priority": 0, "protocol": "http", "address": "registration", "port": 80, "hostname": None,
+                 "versions": DEFAULT_VERSIONS}
+            ]}}
+            return response
+
+        get.side_effect = batch
+        prefetcher = threading.Thread(target=self.UUT.prefetch, args=(["nmos-registration"],))
+        prefetcher.start()
+        self.assertTrue(started.wait(5))
+        # A refresh of the type waits for the batch rather than making a request of its own
+        updater = threading.Thread(target=self.UUT.updateServices, args=("nmos-registration",))
+        updater.start()
+        updater.join(0.2)
+        self.assertTrue(updater.is_alive())
+        release.set()
+        prefetcher.join(5)
+        updater.join(5)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.UUT.getHref("nmos-registration"), "http://registration:80")
+        self.assertEqual(self.UUT.instrumentation.refreshes.value("batch"), 1)
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    @mock.patch('requests.Session.get')
+    def test_updateservices_accepts_msgpack(self, get):
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        fields = ["name", "address", "port", "hostname", "priority", "versions", "protocol"]
+        get.return_value.status_code = 200
+        get.return_value.headers = {"Content-Type": "application/x-msgpack", "ETag": '"abc-2-msgpack"'}
+        get.return_value.content = msgpack.packb({"fields": fields, "services": [
+            ["a", "service_address0", 12345, None, 0, DEFAULT_VERSIONS, "http"],
+            ["b", "service_address1", 12345, None, 0, DEFAULT_VERSIONS, "https"],
+        ], "generation": 2}, use_bin_type=True)
+        with mock.patch('mdnsbridge.mdnsbridgeclient.msgpack', msgpack):
+            self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+            get.assert_called_once_with("http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/potato/", params={'api_proto': 'http'},
+                                        timeout=0.5, proxies={'http': ''},
+                                        headers={"Accept": "application/x-msgpack, application/json;q=0.5"})
+            self.assertEqual(self.UUT._generations["potato"], 2)
+            self.assertEqual(self.UUT._etags["potato"], '"abc-2-msgpack"')
+
+            # Bridges without msgpack support answer in JSON
+            get.return_value.headers = {"Content-Type": "application/json"}
+            get.return_value.content = json.dumps({"representation": [
+                {"priority": 0, "protocol": "http", "address": "service_address2", "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+            ]}).encode('utf-8')
+            self.UUT.updateServices("potato")
+            self.assertEqual(self.UUT.getHref("potato"), "http://service_address2:12345")
+
+    @mock.patch('requests.Session.get')
+    def test_updateservices_reuses_session(self, get):
+        self.UUT.config['https_mode'] = "disabled"
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": []}
+        session = self.UUT._session
+        self.UUT.updateServices("potato")
+        self.UUT.updateServices("potato")
+        self.assertIs(self.UUT._session, session)
+        self.assertEqual(get.call_count, 2)
+
+    @mock.patch('requests.Session.get')
+    def test_updateservices_replaces_session_after_error(self, get):
+        get.side_effect = Exception
+        session = self.UUT._session
+        with mock.patch.object(session, "close") as close:
+            self.UUT.updateServices("potato")
+            close.assert_called_once_with()
+        self.assertIsNot(self.UUT._session, session)
+
+    @mock.patch('requests.Session.get')
+    def test_updateservices_can_bypass_apache(self, get):
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_direct'] = True
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {"representation": []}
+        self.UUT.updateServices("potato")
+        get.assert_called_once_with("http://127.0.0.1:12352/x-ipstudio/mdnsbridge/v1.0/potato/", params={'api_proto': 'http'}, timeout=0.5,
+                                    proxies={'http': ''}, headers={})
+
+    def test_gethref_prefers_unix_socket_when_it_exists(self):
+        tmpdir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmpdir, "mdnsbridge.sock")
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_socket'] = socket_path
+        self.assertTrue(self.UUT._requestUrl("potato").startswith("http://127.0.0.1/"))
+
+        server = UnixHTTPServer(socket_path, RepresentationHandler)
+        server.paths = []
+        server.representation = [
+            {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345, "hostname": "service_host0", "versions": DEFAULT_VERSIONS},
+        ]
+        serving = threading.Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.assertTrue(self.UUT._requestUrl("potato").startswith("http+unix://"))
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        self.assertEqual(server.paths, ["/x-ipstudio/mdnsbridge/v1.0/potato/?api_proto=http"] * 2)
+
+    @mock.patch('requests.Session.get')
+    def test_updateservices_reads_shared_memory_snapshot(self, get):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        writer = SnapshotWriter(tmpdir)
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_snapshot_dir'] = tmpdir
+        get.side_effect = Exception
+
+        service = {"priority": 0, "protocol": "http", "address": "service_address0", "port": 12345,
+                   "hostname": "service_host0", "versions": DEFAULT_VERSIONS}
+        writer.publish("potato", json.dumps({"representation": [service], "generation": 1}).encode('utf-8'))
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address0:12345")
+        get.assert_not_called()
+
+        service["address"] = "service_address1"
+        writer.publish("potato", json.dumps({"representation": [service], "generation": 2}).encode('utf-8'))
+        self.assertEqual(self.UUT.getHref("potato"), "http://service_address1:12345")
+
+        # Once the bridge withdraws its snapshots, clients go back to asking it
+        writer.close()
+        self.assertEqual(self.UUT.getHref("potato"), "")
+        self.assertEqual(get.call_count, 1)
+
+
+    def _probed_services(self, *probes):
+        return {"representation": [
+            {"priority": 0, "protocol": "http", "address": "service_address{}".format(i), "port": 12345,
+             "hostname": None, "versions": DEFAULT_VERSIONS, "healthy": healthy, "rtt": rtt}
+            for i, (healthy, rtt) in enumerate(probes)
+        ]}
+
+    @mock.patch('random.Random.randint', return_value=0)
+    def test_gethref_prefers_healthy_services(self, randint):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False,
+                                'mdnsbridge_prefer_healthy': True})
+        self.UUT._setRepresentation("potato", self._probed_services((False, None), (True, 0.01), (None, None)))
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address2:12345")
+
+        # Once only unhealthy services are left the cache is refreshed, rather than using them
+        with mock.patch.object(self.UUT, "updateServices") as updateServices:
+            self.assertRaises(NoService, self.UUT.getHrefWithException, "potato")
+            updateServices.assert_called_once_with("potato")
+
+        # But they are used if there's nothing else
+        self.UUT._setRepresentation("potato", self._probed_services((False, None)))
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address0:12345")
+
+    @mock.patch('random.Random.randint')
+    def test_gethref_prefers_faster_of_two_healthy_services(self, randint):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False,
+                                'mdnsbridge_prefer_healthy': True})
+        self.UUT._setRepresentation("potato", self._probed_services((True, 0.02), (True, 0.01), (True, 0.03)))
+        # Two different services are compared, skipping over the first choice
+        randint.side_effect = [0, 0]
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+        randint.side_effect = [1, 0]
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address0:12345")
+
+        # Without the option, the first choice is used
+        self.UUT.config['mdnsbridge_prefer_healthy'] = False
+        self.UUT._setRepresentation("potato", self._probed_services((False, None), (True, 0.01)))
+        randint.side_effect = [0]
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address0:12345")
+
+
+    @mock.patch('mdnsbridge.mdnsbridgeclient.time.time', return_value=1000)
+    @mock.patch('random.Random.randint', return_value=0)
+    def test_markfailed_trips_circuit_breaker(self, randint, time):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False})
+        representation = self._probed_services((None, None), (None, None))
+        representation["representation"].append(dict(representation["representation"][0], priority=10,
+                                                     address="service_address2"))
+        self.UUT._setRepresentation("potato", representation)
+        dead = "http://service_address0:12345"
+        for _ in range(BREAKER_FAILURES - 1):
+            self.UUT.markFailed(dead)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), dead)
+
+        # Once tripped, the href is passed over for others, including those of lower priority
+        self.UUT.markFailed(dead)
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+        self.UUT._setRepresentation("potato", representation)
+        for _ in range(BREAKER_FAILURES):
+            self.UUT.markFailed("http://service_address1:12345")
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address2:12345")
+        self.UUT.markSucceeded("http://service_address1:12345")
+
+        # But is used if there's nothing else
+        self.UUT._setRepresentation("potato", self._probed_services((None, None)))
+        self.assertEqual(self.UUT.getHrefWithException("potato"), dead)
+
+        # After the open interval one trial is let through, holding back others until it's reported on
+        time.return_value += BREAKER_INTERVAL
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), dead)
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+        self.UUT.markFailed(dead)
+        time.return_value += BREAKER_INTERVAL - 1
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+
+        # A success closes the breaker
+        self.UUT.markSucceeded(dead)
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), dead)
+        self.UUT.markFailed(dead)
+        self.UUT._setRepresentation("potato", representation)
+        self.assertEqual(self.UUT.getHrefWithException("potato"), dead)
+
+    def test_gethref_uses_strategy_until_as_many_picks_as_services(self):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False})
+        self.UUT.strategy = HashStrategy()
+        self.UUT._setRepresentation("potato", self._probed_services(*[(None, None)] * 3))
+        sticky = self.UUT.getHrefWithException("potato", affinity="node-1")
+        self.assertEqual(self.UUT.getHrefWithException("potato", affinity="node-1"), sticky)
+        self.assertEqual(self.UUT.getHrefWithException("potato", affinity="node-1"), sticky)
+
+        # Services aren't consumed, but the cache is refreshed as often as if they were
+        with mock.patch.object(self.UUT, "updateServices") as updateServices:
+            self.assertRaises(NoService, self.UUT.getHrefWithException, "potato", affinity="node-1")
+            updateServices.assert_called_once_with("potato")
+
+    @mock.patch('random.Random.randint')
+    def test_marksucceeded_latency_steers_latency_strategy(self, randint):
+        self.UUT.config.update({'priority': 0, 'https_mode': "disabled", 'prefer_hostnames': False})
+        self.UUT.strategy = LatencyStrategy()
+        self.UUT._setRepresentation("potato", self._probed_services((True, 0.01), (True, 0.02)))
+        randint.side_effect = [0, 0]
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address0:12345")
+
+        # Latencies reported by the caller take over from the bridge's probes
+        self.UUT.markSucceeded("http://service_address0:12345", latency=0.5)
+        self.UUT.markSucceeded("http://service_address1:12345", latency=0.1)
+        randint.side_effect = [0, 0]
+        self.assertEqual(self.UUT.getHrefWithException("potato"), "http://service_address1:12345")
+
+
+class TestServiceIndex(unittest.TestCase):
+    def setUp(self):
+        self.services = [
+            ServiceRecord(name="a", priority=10, protocol="http", versions=["v1.0", "v1.1"]),
+            ServiceRecord(name="b", priority=5, protocol="https", versions=["v1.1"], authorization=True),
+            ServiceRecord(name="c", priority=10, protocol="http", versions=["v1.1"]),
+            ServiceRecord(name="d", priority=100, protocol="http", versions=["v1.0"]),
+            ServiceRecord(name="e", priority=150, protocol="http", versions=["v1.1"]),
+        ]
+        self.UUT = _ServiceIndex(self.services)
+
+    def names(self, tier):
+        return None if tier is None else [service.name for service in tier.services]
+
+    def test_candidates_are_lowest_priority_up_to_99(self):
+        self.assertEqual(self.names(self.UUT.candidates(0)), ["b"])
+        self.assertEqual(self.names(self.UUT.candidates(0, api_proto="http")), ["a", "c"])
+        self.assertEqual(self.names(self.UUT.candidates(0, api_ver="v1.0")), ["a"])
+        self.assertEqual(self.names(self.UUT.candidates(0, api_auth=False)), ["a", "c"])
+        self.assertIsNone(self.UUT.candidates(0, api_ver="v1.2"))
+
+    def test_candidates_match_high_priorities_exactly(self):
+        self.assertEqual(self.names(self.UUT.candidates(100)), ["d"])
+        self.assertEqual(self.names(self.UUT.candidates(150, api_ver="v1.1")), ["e"])
+        self.assertIsNone(self.UUT.candidates(150, api_ver="v1.0"))
+        self.assertIsNone(self.UUT.candidates(120))
+
+    def test_taken_services_are_removed_from_every_bucket(self):
+        self.assertEqual(self.names(self.UUT.candidates(0, api_ver="v1.1", api_proto="http")), ["a", "c"])
+        tier = self.UUT.candidates(0, api_proto="http")
+        self.assertIs(self.UUT.take(tier, 0), self.services[0])
+        self.assertEqual(self.names(tier), ["c"])
+        self.assertEqual(self.names(self.UUT.candidates(0, api_ver="v1.1", api_proto="http")), ["c"])
+        self.assertIsNone(self.UUT.candidates(0, api_ver="v1.0"))
+        self.assertEqual(len(self.UUT), 4)
+        self.assertEqual([service.name for service in self.UUT], ["b", "c", "d", "e"])
+
+    def test_take_moves_last_service_into_place(self):
+        tier = self.UUT.candidates(0, api_proto="http")
+        self.assertEqual(self.names(tier), ["a", "c"])
+        self.assertIs(self.UUT.take(tier, 0), self.services[0])
+        self.assertEqual(self.names(tier), ["c"])
+        self.assertIs(self.UUT.take(tier, 0), self.services[2])
+        self.assertIsNone(self.UUT.candidates(0, api_proto="http"))
+
+    def test_uses_are_counted_against_each_tier(self):
+        # A lookup matching one service is answered once, as if it had been taken
+        tier = self.UUT.candidates(0, api_ver="v1.0")
+        self.assertIs(self.UUT.use(tier, 0), self.services[0])
+        self.assertIsNone(self.UUT.candidates(0, api_ver="v1.0"))
+        # Using other tiers doesn't use up this one
+        tier = self.UUT.candidates(0, api_proto="http")
+        other = self.UUT.candidates(0)
+        for _ in range(10):
+            self.UUT.use(other, 0)
+        self.assertIs(self.UUT.candidates(0, api_proto="http"), tier)
+        self.UUT.use(tier, 0)
+        self.UUT.use(tier, 0)
+        self.assertIsNone(self.UUT.candidates(0, api_proto="http"))
+        self.assertEqual(len(self.UUT), 5)
+
+    def test_falls_through_to_next_priority_once_lowest_is_exhausted(self):
+        self.UUT.take(self.UUT.candidates(0), 0)
+        self.assertEqual(self.names(self.UUT.candidates(0)), ["a", "c"])
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio client requires Python 3.5")
+class TestAsyncIppmDNSBridge(unittest.TestCase):
+    @mock.patch("mdnsbridge._asyncclient.aiohttp")
+    @mock.patch("mdnsbridge.mdnsbridgeclient.Logger")
+    def setUp(self, Logger, aiohttp):
+        from mdnsbridge.mdnsbridgeclient import AsyncIppmDNSBridge
+        self.UUT = AsyncIppmDNSBridge()
+        self.UUT.config['priority'] = 0
+        self.UUT.config['https_mode'] = "disabled"
+        self.UUT.config['mdnsbridge_socket'] = None
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def services(self, count):
+        return [
+            {"priority": 0, "protocol": "http", "address": "service_address{}".format(i), "port": 12345, "hostname": None, "versions": DEFAULT_VERSIONS}
+            for i in range(count)
+        ]
+
+    def test_requires_aiohttp(self):
+        from mdnsbridge.mdnsbridgeclient import AsyncIppmDNSBridge
+        with mock.patch("mdnsbridge._asyncclient.aiohttp", None):
+            self.assertRaises(ImportError, AsyncIppmDNSBridge)
+
+    def test_gethref_selects_like_blocking_client(self):
+        services = self.services(3)
+        services[0]["priority"] = 10
+        services[1]["protocol"] = "https"
+        fetched = self.loop.create_future()
+        fetched.set_result((200, '"abc-1"', {"representation": services, "generation": 1}))
+        self.UUT._fetch = mock.Mock(return_value=fetched)
+
+        hrefs = [self.loop.run_until_complete(self.UUT.getHref("potato")) for _ in range(3)]
+        self.assertEqual(hrefs, ["http://service_address2:12345", "http://service_address0:12345",
+                                 "http://service_address2:12345"])
+        self.assertEqual(self.UUT._fetch.call_count, 2)
+        self.assertEqual(self.UUT._etags["potato"], '"abc-1"')
+        self.assertEqual(self.loop.run_until_complete(self.UUT.getHref("potato", priority=100)), "")
+
+    def test_concurrent_gethref_calls_share_one_refresh(self):
+        fetched = self.loop.create_future()
+        self.UUT._fetch = mock.Mock(return_value=fetched)
+        self.loop.call_later(0.01, fetched.set_result, (200, None, {"representation": self.services(10)}))
+
+        hrefs = self.loop.run_until_complete(asyncio.gather(*[self.UUT.getHref("potato") for _ in range(10)]))
+        self.assertEqual(sorted(hrefs), sorted("http://service_address{}:12345".format(i) for i in range(10)))
+        self.UUT._fetch.assert_called_once_with("potato")
+        self.assertEqual(self.UUT._refreshing, {})
+
+    def ok(self, count):
+        return (200, {"ETag": '"abc-1"'}, "application/json",
+                json.dumps({"representation": self.services(count), "generation": 1}).encode("utf-8"))
+
+    def test_fetch_uses_pooled_session(self):
+        url = "http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/potato/"
+        aiohttp, sessions = fake_aiohttp({url: [self.ok(1), self.ok(2)]})
+        with mock.patch("mdnsbridge._asyncclient.aiohttp", aiohttp):
+            status, etag, body = self.loop.run_until_complete(self.UUT._fetch("potato"))
+            self.assertEqual((status, etag, len(body["representation"])), (200, '"abc-1"', 1))
+            status, etag, body = self.loop.run_until_complete(self.UUT._fetch("potato"))
+            self.assertEqual(len(body["representation"]), 2)
+        self.assertEqual(len(sessions), 1)
+        self.assertIs(sessions[0].connector, aiohttp.TCPConnector.return_value)
+        self.assertEqual(sessions[0].get.call_args[1]["params"], {"api_proto": "http"})
+        self.assertFalse(sessions[0].closed)
+        self.assertEqual(self.UUT._sessionUsers, {})
+
+    def test_fetch_uses_unix_socket_when_present(self):
+        self.UUT.config['mdnsbridge_socket'] = "/run/potato.sock"
+        url = "http://localhost/x-ipstudio/mdnsbridge/v1.0/potato/"
+        aiohttp, sessions = fake_aiohttp({url: [(304, {}, None, b"")]})
+        with mock.patch("mdnsbridge._asyncclient.aiohttp", aiohttp), \
+                mock.patch("mdnsbridge.mdnsbridgeclient.os.path.exists", return_value=True):
+            self.assertEqual(self.loop.run_until_complete(self.UUT._fetch("potato")), (304, None, None))
+        aiohttp.UnixConnector.assert_called_once_with(path="/run/potato.sock")
+        self.assertIs(sessions[0].connector, aiohttp.UnixConnector.return_value)
+
+    def test_failed_fetch_only_replaces_its_session(self):
+        url = "http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/{}/"
+        pending = self.loop.create_future()
+        aiohttp, sessions = fake_aiohttp({url.format("potato"): [pending, self.ok(1)],
+                                               url.format("tomato"): [Exception("broken")]})
+
+        with mock.patch("mdnsbridge._asyncclient.aiohttp", aiohttp):
+            potato = asyncio.ensure_future(self.UUT._fetch("potato"), loop=self.loop)
+            self.loop.run_until_complete(asyncio.sleep(0))
+            with self.assertRaises(Exception):
+                self.loop.run_until_complete(self.UUT._fetch("tomato"))
+            # The session isn't used again, but isn't closed while the other fetch is still using it
+            self.assertIsNone(self.UUT._session)
+            self.assertFalse(sessions[0].closed)
+            pending.set_result(self.ok(3))
+            status, etag, body = self.loop.run_until_complete(potato)
+            self.assertEqual(len(body["representation"]), 3)
+            self.assertTrue(sessions[0].closed)
+            self.loop.run_until_complete(self.UUT._fetch("potato"))
+        self.assertEqual(len(sessions), 2)
+        self.assertFalse(sessions[1].closed)
+        self.assertEqual(self.UUT._sessionUsers, {})
+
+    def test_gethref_returns_empty_string_when_request_fails(self):
+        aiohttp, sessions = fake_aiohttp({"http://127.0.0.1/x-ipstudio/mdnsbridge/v1.0/potato/": [Exception()]})
+        with mock.patch("mdnsbridge._asyncclient.aiohttp", aiohttp):
+            self.assertEqual(self.loop.run_until_complete(self.UUT.getHref("potato")), "")
+        self.assertTrue(sessions[0].closed)
+        self.assertIsNone(self.UUT._session)
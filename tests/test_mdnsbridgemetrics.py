@@ -0,0 +1,55 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mdnsbridge.mdnsbridgemetrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_renders_counters_with_labels(self):
+        counter = self.metrics.counter("requests", "Requests made", ("route", "status"))
+        counter.inc("/a", "200")
+        counter.inc("/a", "200")
+        counter.inc('/"b"\\', "404")
+        self.assertEqual(counter.value("/a", "200"), 2)
+        self.assertEqual(self.metrics.render(), "\n".join([
+            "# HELP requests_total Requests made",
+            "# TYPE requests_total counter",
+            'requests_total{route="/\\"b\\"\\\\",status="404"} 1',
+            'requests_total{route="/a",status="200"} 2',
+        ]) + "\n")
+
+    def test_renders_gauges_when_scraped(self):
+        sizes = {"a": 1}
+        self.metrics.gauge("size", "Size", ("name",), lambda: [((name,), size) for name, size in sizes.items()])
+        self.assertIn('size{name="a"} 1', self.metrics.render().splitlines())
+        sizes["a"] = 3
+        self.assertIn('size{name="a"} 3', self.metrics.render().splitlines())
+
+    def test_renders_cumulative_histogram_buckets(self):
+        histogram = self.metrics.histogram("latency", "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(self.metrics.render().splitlines()[2:], [
+            'latency_bucket{le="0.1"} 2',
+            'latency_bucket{le="1.0"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 2.65',
+            'latency_count 4',
+        ])
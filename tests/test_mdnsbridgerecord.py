@@ -0,0 +1,87 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import copy
+import json
+import pickle
+
+from mdnsbridge.mdnsbridgerecord import ServiceRecord, REPRESENTATION_FIELDS
+
+
+class TestServiceRecord(unittest.TestCase):
+    def setUp(self):
+        self.service = {
+            "name": "a", "address": "192.168.0.1", "port": 80, "hostname": "a.example.com",
+            "txt": {"pri": "10", "api_ver": "v1.0,v1.1", "api_auth": True}, "priority": 10,
+            "versions": ["v1.0", "v1.1"], "protocol": "http", "authorization": True, "ttl": 30, "last_seen": 95,
+            "healthy": True, "rtt": 0.002
+        }
+
+    def test_round_trips_json_representation(self):
+        record = ServiceRecord.from_json(json.loads(json.dumps(self.service)))
+        self.assertEqual(record.last_seen, 95)
+        self.assertEqual(record.to_json(), self.service)
+        self.assertEqual(record.to_values(), [self.service[field] for field in REPRESENTATION_FIELDS])
+
+    def test_fills_in_fields_missing_from_older_bridges(self):
+        record = ServiceRecord.from_json({"address": "192.168.0.1", "port": 80, "priority": 0, "protocol": "http",
+                                          "versions": ["v1.0"]})
+        self.assertIsNone(record.hostname)
+        self.assertEqual(record.txt, ())
+        self.assertFalse(record.authorization)
+        self.assertIsNone(record.ttl)
+        self.assertIsNone(record.to_json()["last_seen"])
+
+    def test_is_immutable(self):
+        record = ServiceRecord.from_json(self.service)
+        with self.assertRaises(AttributeError):
+            record.priority = 0
+        with self.assertRaises(AttributeError):
+            del record.priority
+        with self.assertRaises(AttributeError):
+            record.extra = 1
+        self.assertFalse(hasattr(record, "__dict__"))
+
+    def test_compares_and_hashes_by_value(self):
+        record = ServiceRecord.from_json(self.service)
+        same = ServiceRecord.from_json(dict(self.service, txt=dict(reversed(list(self.service["txt"].items())))))
+        other = ServiceRecord.from_json(dict(self.service, port=8080))
+        self.assertEqual(record, same)
+        self.assertFalse(record != same)
+        self.assertEqual(hash(record), hash(same))
+        self.assertNotEqual(record, other)
+        self.assertNotEqual(record, self.service)
+
+    def test_last_seen_is_not_part_of_value(self):
+        record = ServiceRecord.from_json(self.service)
+        seen = ServiceRecord.from_json(dict(self.service, last_seen=200))
+        self.assertEqual(seen, record)
+        self.assertEqual((seen.last_seen, seen.ttl), (200, 30))
+        self.assertFalse(seen.expired(229.5))
+        self.assertTrue(seen.expired(230))
+        self.assertFalse(ServiceRecord.from_json(dict(self.service, ttl=None, last_seen=200)).expired(1000))
+
+    def test_interns_repeated_strings(self):
+        first = ServiceRecord.from_json(json.loads(json.dumps(self.service)))
+        second = ServiceRecord.from_json(json.loads(json.dumps(self.service)))
+        self.assertIs(first.protocol, second.protocol)
+        self.assertIs(first.versions[1], second.versions[1])
+        self.assertIs(first.txt[0][0], second.txt[0][0])
+
+    def test_copies_and_pickles(self):
+        record = ServiceRecord.from_json(self.service)
+        self.assertEqual(copy.copy(record), record)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertEqual(pickle.loads(pickle.dumps(record)).last_seen, record.last_seen)
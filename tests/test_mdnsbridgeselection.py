@@ -0,0 +1,82 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import random
+from collections import Counter
+
+from mdnsbridge.mdnsbridgeclient import _Tier
+from mdnsbridge.mdnsbridgerecord import ServiceRecord
+from mdnsbridge.mdnsbridgeselection import RandomStrategy, LatencyStrategy, WeightedStrategy, HashStrategy
+
+
+def make_tier(*txts):
+    tier = _Tier()
+    for index, txt in enumerate(txts):
+        tier.append(ServiceRecord(name="service{}".format(index), address="10.0.0.{}".format(index), port=80,
+                                  txt=txt))
+    return tier
+
+
+class TestSelectionStrategies(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1)
+
+    def pick(self, strategy, tier, picks, latency=lambda service: None, affinity=None):
+        return Counter(strategy.select(tier, self.random, latency, affinity) for _ in range(picks))
+
+    def test_random_strategy_consumes_services(self):
+        tier = make_tier({}, {})
+        self.assertTrue(RandomStrategy().consumes)
+        self.assertEqual(set(self.pick(RandomStrategy(), tier, 100)), set([0, 1]))
+
+    def test_latency_strategy_prefers_lower_latency(self):
+        tier = make_tier({}, {}, {})
+        latencies = {"10.0.0.0": 0.1, "10.0.0.1": 0.2, "10.0.0.2": None}
+        picks = self.pick(LatencyStrategy(), tier, 3000, lambda service: latencies[service.address])
+        self.assertFalse(LatencyStrategy().consumes)
+        self.assertGreater(picks[0], picks[1])
+        # Services without a latency aren't penalised
+        self.assertGreater(picks[2], picks[1])
+
+    def test_weighted_strategy_picks_in_proportion_to_txt_weight(self):
+        tier = make_tier({"weight": "1"}, {"weight": "3"}, {"weight": "0"}, {"weight": "bad"})
+        picks = self.pick(WeightedStrategy(), tier, 5000)
+        self.assertEqual(picks[2], 0)
+        self.assertAlmostEqual(picks[1] / float(picks[0]), 3, delta=0.4)
+        self.assertAlmostEqual(picks[3] / float(picks[0]), 1, delta=0.2)
+
+    def test_weighted_strategy_rebuilds_when_tier_changes(self):
+        tier = make_tier({"weight": "0"}, {"weight": "1"})
+        strategy = WeightedStrategy()
+        self.assertEqual(set(self.pick(strategy, tier, 50)), set([1]))
+        tier.remove(tier.services[1])
+        self.assertEqual(set(self.pick(strategy, tier, 10)), set([0]))
+
+    def test_hash_strategy_is_sticky_and_moves_few_keys(self):
+        tier = make_tier(*[{}] * 5)
+        strategy = HashStrategy()
+        keys = ["node-{}".format(index) for index in range(500)]
+        before = dict((key, tier.services[strategy.select(tier, self.random, None, key)]) for key in keys)
+        self.assertEqual(len(set(before.values())), 5)
+        self.assertEqual(before, dict((key, tier.services[strategy.select(tier, self.random, None, key)])
+                                      for key in keys))
+
+        # Only the keys of the service which went away move
+        gone = tier.services[2]
+        tier.remove(gone)
+        after = dict((key, tier.services[strategy.select(tier, self.random, None, key)]) for key in keys)
+        for key in keys:
+            if before[key] is not gone:
+                self.assertIs(after[key], before[key])
@@ -14,14 +14,19 @@
 
 import unittest
 import mock
+import os
+import shutil
 import six
+import socket
+import tempfile
 from gevent import signal
 from cysystemd.daemon import Notification
 
 
 with mock.patch("mdnsbridge.mdnsbridgeservice.monkey"):
-    from mdnsbridge.mdnsbridgeservice import HOST, PORT, mDNSBridgeService
+    from mdnsbridge.mdnsbridgeservice import HOST, PORT, SOCKET_PATH, mDNSBridgeService
     from mdnsbridge.mdnsbridge import mDNSBridgeAPI, APINAME, APINAMESPACE, APIVERSION
+    from mdnsbridge.mdnsbridgeclient import BRIDGE_PORT, BRIDGE_SOCKET
 
 
 class TestmDNSBridgeService(unittest.TestCase):
@@ -32,6 +37,7 @@ class TestmDNSBridgeService(unittest.TestCase):
         Facade.assert_called_once_with("{}/{}".format(APINAME, APIVERSION))
         self.assertEqual(self.UUT.facade, Facade.return_value)
 
+    @mock.patch.dict('mdnsbridge.mdnsbridgeservice.nmoscommonconfig.config', {'mdnsbridge_socket': ""})
     @mock.patch('gevent.signal')
     @mock.patch('gevent.sleep')
     @mock.patch('mdnsbridge.mdnsbridgeservice.mDNSBridge')
@@ -89,6 +95,7 @@ class TestmDNSBridgeService(unittest.TestCase):
             self.UUT.facade.unregister_service.assert_called_once_with()
             HttpServer.return_value.stop.assert_called_once_with()
             mDNSBridge.return_value.stop.assert_called_once_with()
+        self.assertIsNone(self.UUT.unix_server)
 
     def test_run_one_iteration(self):
         self.assert_run_starts_runs_and_stops_as_expected(1)
@@ -112,3 +119,53 @@ class TestmDNSBridgeService(unittest.TestCase):
 
     def test_run_fails_if_webserver_fails_to_start(self):
         self.assert_run_starts_runs_and_stops_as_expected(1, http_server_fails_with_exception=Exception)
+
+    def test_client_bridge_port_matches_service(self):
+        self.assertEqual(BRIDGE_PORT, PORT)
+
+    def test_client_bridge_socket_matches_service(self):
+        self.assertEqual(BRIDGE_SOCKET, SOCKET_PATH)
+
+    @mock.patch('mdnsbridge.mdnsbridgeservice.WSGIServer')
+    def test_unix_server_serves_api_and_is_cleaned_up(self, WSGIServer):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        socket_path = os.path.join(tmpdir, "mdnsbridge.sock")
+        # A stale socket left behind by a previous run should be replaced
+        open(socket_path, "w").close()
+
+        self.UUT.http_server = mock.MagicMock()
+        self.UUT.mdns_bridge = mock.MagicMock()
+        self.UUT._start_unix_server(socket_path)
+        WSGIServer.assert_called_once_with(mock.ANY, self.UUT.http_server.api.app)
+        WSGIServer.return_value.start.assert_called_once_with()
+        self.assertEqual(self.UUT.socket_path, socket_path)
+        self.assertTrue(os.path.exists(socket_path))
+
+        self.UUT._cleanup()
+        WSGIServer.return_value.stop.assert_called_once_with()
+        self.assertFalse(os.path.exists(socket_path))
+
+    @mock.patch('mdnsbridge.mdnsbridgeservice.WSGIServer')
+    def test_unix_server_does_not_replace_socket_in_use(self, WSGIServer):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        socket_path = os.path.join(tmpdir, "mdnsbridge.sock")
+        running = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(running.close)
+        running.bind(socket_path)
+        running.listen(1)
+
+        self.UUT.http_server = mock.MagicMock()
+        self.UUT._start_unix_server(socket_path)
+        WSGIServer.assert_not_called()
+        self.assertIsNone(self.UUT.socket_path)
+        self.assertTrue(os.path.exists(socket_path))
+
+    @mock.patch('mdnsbridge.mdnsbridgeservice.WSGIServer')
+    def test_unix_server_failure_is_not_fatal(self, WSGIServer):
+        self.UUT.http_server = mock.MagicMock()
+        self.UUT._start_unix_server("/nonexistent/directory/mdnsbridge.sock")
+        WSGIServer.assert_not_called()
+        self.assertIsNone(self.UUT.unix_server)
+        self.assertIsNone(self.UUT.socket_path)
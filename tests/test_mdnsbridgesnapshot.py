@@ -0,0 +1,104 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from mdnsbridge.mdnsbridgesnapshot import SnapshotWriter, SnapshotReader, SEQ, SEQ_OFFSET, MIN_CAPACITY, _open
+
+
+def encode(representation, generation=0):
+    return json.dumps({"representation": representation, "generation": generation}).encode('utf-8')
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.directory = os.path.join(self.tmpdir, "snapshots")
+        self.writer = SnapshotWriter(self.directory)
+        self.reader = SnapshotReader(self.directory)
+        self.addCleanup(self.reader.close)
+
+    def test_read_returns_none_until_published(self):
+        self.assertIsNone(self.reader.read("nmos-query"))
+
+    def test_read_returns_published_representation(self):
+        self.writer.publish("nmos-query", encode([{"name": "a"}], 1))
+        self.assertEqual(self.reader.read("nmos-query"), {"representation": [{"name": "a"}], "generation": 1})
+        self.assertIsNone(self.reader.read("nmos-registration"))
+
+    def test_read_only_decodes_changed_snapshots(self):
+        self.writer.publish("nmos-query", encode([{"name": "a"}], 1))
+        first = self.reader.read("nmos-query")
+        self.assertIs(self.reader.read("nmos-query"), first)
+        self.writer.publish("nmos-query", encode([{"name": "b"}], 2))
+        second = self.reader.read("nmos-query")
+        self.assertEqual(second["representation"], [{"name": "b"}])
+        self.assertIsNot(second, first)
+
+    def test_read_follows_snapshot_when_it_outgrows_its_file(self):
+        self.writer.publish("nmos-query", encode([], 1))
+        self.assertEqual(self.reader.read("nmos-query")["generation"], 1)
+        large = [{"name": "x" * 1000} for _ in range(MIN_CAPACITY // 1000)]
+        self.writer.publish("nmos-query", encode(large, 2))
+        self.assertEqual(self.reader.read("nmos-query"), {"representation": large, "generation": 2})
+
+    def test_read_ignores_snapshot_being_written(self):
+        self.writer.publish("nmos-query", encode([], 1))
+        snapshot = self.writer._maps["nmos-query"]
+        seq = SEQ.unpack_from(snapshot, SEQ_OFFSET)[0]
+        SEQ.pack_into(snapshot, SEQ_OFFSET, seq + 1)
+        self.assertIsNone(self.reader.read("nmos-query"))
+        SEQ.pack_into(snapshot, SEQ_OFFSET, seq)
+        self.assertEqual(self.reader.read("nmos-query")["generation"], 1)
+
+    def test_close_withdraws_snapshots(self):
+        self.writer.publish("nmos-query", encode([], 1))
+        self.assertIsNotNone(self.reader.read("nmos-query"))
+        self.writer.close()
+        self.assertIsNone(self.reader.read("nmos-query"))
+
+    def test_new_writer_supersedes_and_continues_sequence(self):
+        self.writer.publish("nmos-query", encode([{"name": "a"}], 5))
+        self.assertEqual(self.reader.read("nmos-query")["generation"], 5)
+        old_seq = self.writer._seqs["nmos-query"]
+
+        writer = SnapshotWriter(self.directory)
+        writer.publish("nmos-query", encode([{"name": "b"}], 1))
+        self.assertGreater(writer._seqs["nmos-query"], old_seq)
+        self.assertEqual(self.reader.read("nmos-query"), {"representation": [{"name": "b"}], "generation": 1})
+
+    def test_read_does_not_mistake_restarted_writer_for_cached_snapshot(self):
+        self.writer.publish("nmos-query", encode(["OLD"], 1))
+        self.assertEqual(self.reader.read("nmos-query")["representation"], ["OLD"])
+        self.writer.close()
+
+        # The restarted writer starts counting again from the same sequence number
+        writer = SnapshotWriter(self.directory)
+        writer.publish("nmos-query", encode(["NEW"], 1))
+        self.assertEqual(self.reader.read("nmos-query")["representation"], ["NEW"])
+
+    def test_read_keys_cache_by_writer(self):
+        self.writer.publish("nmos-query", encode(["OLD"], 1))
+        self.assertEqual(self.reader.read("nmos-query")["representation"], ["OLD"])
+        # Another writer's file appearing at the path without the reader noticing the first was withdrawn
+        os.unlink(os.path.join(self.directory, "nmos-query"))
+        SnapshotWriter(self.directory).publish("nmos-query", encode(["NEW"], 1))
+        self.reader._maps["nmos-query"].close()
+        self.reader._maps["nmos-query"] = _open(os.path.join(self.directory, "nmos-query"))
+        self.assertEqual(self.reader.read("nmos-query")["representation"], ["NEW"])